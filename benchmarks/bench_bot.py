@@ -0,0 +1,63 @@
+"""
+Benchmark the autoplayer
+
+Plays headless games with the bot, with and without looking at the next block,
+and reports the pieces placed and the boards scored (nodes) per second.
+Games are played until game over or the maximum number of pieces.
+
+usage: python -m benchmarks.bench_bot [pieces] [--output FILE]
+"""
+import argparse
+import json
+import platform
+import time
+
+from pytris.bot import Bot
+from pytris.game import Game
+from pytris.grid import engines
+
+def bench(engine, lookahead, pieces, seed = 0):
+    """
+    :return: dict with pieces/s, nodes/s and the result of the game
+    """
+    bot = Bot(lookahead = lookahead)
+    game = Game(engine = engine, headless = True, seed = seed)
+    start = time.perf_counter()
+    game.run(bot, max_pieces = pieces)
+    elapsed = time.perf_counter() - start
+    return {
+        "time": elapsed / game.pieces,
+        "pieces_per_second": game.pieces / elapsed,
+        "nodes_per_second": bot.nodes / elapsed,
+        "pieces": game.pieces,
+        "lines": game.lines,
+        "gameover": game.gameover,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pieces", type = int, nargs = "?", default = 2000)
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON, see benchmarks.compare")
+    args = parser.parse_args()
+    results = {}
+    for engine_name, engine in engines.items():
+        for lookahead in (0, 1):
+            name = f"bot{'[preview]' if lookahead else ''}[{engine_name}]"
+            result = results[name] = bench(engine, lookahead, args.pieces)
+            print(f"{name:>20}: {result['pieces_per_second']:8.0f} pieces/s "
+                  f"{result['nodes_per_second']:9.0f} nodes/s "
+                  f"{result['pieces']:6} pieces {result['lines']:6} lines"
+                  f"{' GAME OVER' if result['gameover'] else ''}")
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
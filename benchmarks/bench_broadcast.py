@@ -0,0 +1,102 @@
+"""
+Benchmark broadcasting a game to spectators
+
+A headless game with random moves is broadcast at 30 frames per second to 1 up to 1000
+viewers on a unix socket, the viewers run in the same event loop. Reports per frame:
+    encode  : time to encode the frame, once for all viewers
+    fan-out : time to send it to all viewers, and per viewer
+    traffic : bytes per second sent to every viewer
+and the frames viewers skipped because they were behind.
+
+usage: python -m benchmarks.bench_broadcast [viewers ...] [--frames N] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import tempfile
+import time
+
+from pytris.block import Block
+from pytris.broadcast import Broadcaster, Viewer, view
+from pytris.game import Game
+from pytris.grid import BitGrid
+
+fps = 30
+
+async def bench(viewers, frames):
+    game = Game(engine = BitGrid, headless = True, seed = 0)
+    game.spawn()
+    broadcaster = Broadcaster(rate = fps)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "broadcast.sock")
+        await broadcaster.start(path)
+        clients = [Viewer() for _ in range(viewers)]
+        for client in clients:
+            await client.connect(path)
+        receivers = [asyncio.ensure_future(client.run()) for client in clients]
+        # Wait until all viewers are subscribed
+        while len(broadcaster.subscribers) < viewers:
+            await asyncio.sleep(0.01)
+        encode = fanout = 0.0
+        start = time.perf_counter()
+        for i in range(frames):
+            Block.random_move(game.block)
+            if i % 10 == 0:
+                game.block.down()
+            if not game.block.mobile:
+                game.land()
+                if game.gameover:
+                    game = Game(engine = BitGrid, headless = True, seed = i)
+                    game.spawn()
+            t0 = time.perf_counter()
+            encoder = broadcaster.encoder
+            kind, message = encoder.encode(game)
+            t1 = time.perf_counter()
+            broadcaster.publish(message, (encoder.key_sequence, encoder.key_message))
+            t2 = time.perf_counter()
+            encode += t1 - t0
+            fanout += t2 - t1
+            # Keep the frame rate
+            await asyncio.sleep(max(0, start + (i + 1) / fps - time.perf_counter()))
+        await asyncio.sleep(0.2)
+        synced = sum(client.cells == view(game) for client in clients)
+        await broadcaster.close()
+        await asyncio.gather(*receivers)
+    return {
+        "time": fanout / frames,
+        "encode": encode / frames,
+        "per_viewer": fanout / frames / viewers,
+        "traffic": broadcaster.sent / viewers / (frames / fps),
+        "skipped": broadcaster.skipped,
+        "dropped": broadcaster.dropped,
+        "synced": synced,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("viewers", type = int, nargs = "*", default = [1, 10, 100, 1000])
+    parser.add_argument("--frames", type = int, default = 300)
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON, see benchmarks.compare")
+    args = parser.parse_args()
+    results = {}
+    for viewers in args.viewers:
+        result = results[f"broadcast[{viewers}]"] = asyncio.run(bench(viewers, args.frames))
+        print(f"{viewers:5} viewers: encode {result['encode'] * 1e6:6.1f} us "
+              f"fan-out {result['time'] * 1e6:8.1f} us ({result['per_viewer'] * 1e6:5.2f} us/viewer) "
+              f"traffic {result['traffic']:6.0f} B/s per viewer "
+              f"skipped {result['skipped']:5} dropped {result['dropped']:3} in sync {result['synced']}/{viewers}")
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Micro and macro benchmarks of the engine hot paths
+
+Every case times a single operation, the setup of each operation is not timed.
+A case is set up `repeat` times and run for `number` operations each time,
+the best mean time per operation is kept. The garbage collector is off while timing.
+The screen cases draw to a fake curses window that only records what is written.
+
+Results are written as JSON, which benchmarks.compare can check against a baseline:
+    {"python": ..., "machine": ..., "results": {case: {"time": seconds per op, ...}}}
+
+usage: python -m benchmarks.bench_engine [--output FILE] [--filter TEXT] [--repeat N]
+"""
+import argparse
+import curses
+import gc
+import json
+import platform
+import time
+
+from pytris.block import Block, pieces
+from pytris.game import Game
+from pytris.grid import engines
+
+class Window():
+    """
+    Fake curses window that records everything that is written to it
+    """
+    def __init__(self):
+        self.writes = []
+    def addstr(self, y, x, s, attr = 0):
+        self.writes.append((y, x, s, attr))
+    def getkey(self):
+        raise curses.error("no input")
+    def nodelay(self, flag):
+        pass
+    def noutrefresh(self):
+        pass
+
+def fake_curses():
+    """
+    Replace the curses functions that need a terminal
+    """
+    for name in ("use_default_colors", "init_pair", "curs_set", "doupdate"):
+        setattr(curses, name, lambda *args: None)
+    curses.color_pair = lambda i: i << 8
+
+def new_game(engine, screen = False, seed = 0):
+    if screen:
+        return Game(screen = Window(), engine = engine, seed = seed)
+    return Game(engine = engine, headless = True, seed = seed)
+
+def block_at(game, x = 5, y = 30, piece = pieces[1]):
+    """
+    A mobile block in the middle of the (empty) grid
+    """
+    block = Block(game, piece = piece)
+    block.anchor = (x, y)
+    game.block = block
+    return block
+
+"""
+Cases, every case is a function of the engine that returns a setup function
+The setup function prepares a single operation and returns it
+"""
+def collision(engine):
+    block = block_at(new_game(engine))
+    return lambda: block.collision
+
+def move(name):
+    def case(engine):
+        game = new_game(engine)
+        def setup():
+            block = block_at(game)
+            return getattr(block, name)
+        return setup
+    return case
+
+def drop(engine):
+    game = new_game(engine)
+    def setup():
+        game.grid = engine(game)
+        return block_at(game, y = game.grid.top_buffer).drop
+    return setup
+
+def row_is_full(full):
+    def case(engine):
+        game = new_game(engine)
+        # Some blocks on top of the full rows
+        rest = [(x, game.grid.height - full - 1) for x in range(0, game.grid.width, 2)]
+        def setup():
+            game.grid = engine(game)
+            for y in range(game.grid.height - full, game.grid.height):
+                game.grid.set(1, [(x, y) for x in range(game.grid.width)])
+            game.grid.set(2, rest)
+            return game.grid.row_is_full
+        return setup
+    return case
+
+def queue_pop(engine):
+    game = new_game(engine)
+    return lambda: game.queue.pop
+
+def queue_fill(engine):
+    game = new_game(engine)
+    def setup():
+        game.queue.clear()
+        return game.queue.fill
+    return setup
+
+def screen_grid(engine):
+    game = new_game(engine, screen = True)
+    for x in range(game.grid.width):
+        game.grid.set(x % 7 + 1, [(x, y) for y in range(game.grid.height - 8, game.grid.height)])
+    def setup():
+        # Nothing on the terminal yet, so every pixel is written
+        game.screen.front.clear()
+        return game.screen.grid
+    return setup
+
+def screen_block(engine):
+    game = new_game(engine, screen = True)
+    # Draws game.block, block_at puts it in the middle of the grid
+    block_at(game)
+    return lambda: game.screen.block
+
+def screen_flush(engine):
+    game = new_game(engine, screen = True)
+    game.screen.grid()
+    game.screen.flush()
+    block = block_at(game)
+    moves = [block.left, block.right]
+    def setup():
+        moves.reverse()
+        moves[0]()
+        return game.screen.flush
+    return setup
+
+def headless_game(engine):
+    seeds = iter(range(10 ** 9))
+    # Every repeat plays the same games
+    def setup():
+        game = new_game(engine, seed = next(seeds))
+        return game.run
+    return setup
+
+# name: (case, number of operations per repeat)
+cases = {
+    "collision": (collision, 20000),
+    "down": (move("down"), 20000),
+    "left": (move("left"), 20000),
+    "right": (move("right"), 20000),
+    "clockwise": (move("clockwise"), 20000),
+    "countercw": (move("countercw"), 20000),
+    "drop": (drop, 1000),
+    "row_is_full[0]": (row_is_full(0), 2000),
+    "row_is_full[1]": (row_is_full(1), 2000),
+    "row_is_full[2]": (row_is_full(2), 2000),
+    "row_is_full[3]": (row_is_full(3), 2000),
+    "row_is_full[4]": (row_is_full(4), 2000),
+    "queue.pop": (queue_pop, 5000),
+    "queue.fill": (queue_fill, 2000),
+    "screen.grid": (screen_grid, 200),
+    "screen.block": (screen_block, 10000),
+    "screen.flush": (screen_flush, 5000),
+    "game": (headless_game, 10),
+}
+
+def measure(case, engine, number, repeat):
+    """
+    :return: best mean time per operation in seconds
+    """
+    clock = time.perf_counter
+    best = None
+    enabled = gc.isenabled()
+    for _ in range(repeat):
+        setup = case(engine)
+        total = 0.0
+        gc.disable()
+        try:
+            for _ in range(number):
+                op = setup()
+                start = clock()
+                op()
+                total += clock() - start
+        finally:
+            if enabled:
+                gc.enable()
+        if best is None or total < best:
+            best = total
+    return best / number
+
+def run(filter = None, repeat = 7):
+    """
+    Run all cases on every engine
+    :return: dict of results
+    """
+    fake_curses()
+    results = {}
+    for engine_name, engine in engines.items():
+        for name, (case, number) in cases.items():
+            name = f"{name}[{engine_name}]"
+            if filter and filter not in name:
+                continue
+            seconds = measure(case, engine, number, repeat)
+            results[name] = {"time": seconds, "number": number, "repeat": repeat}
+            print(f"{name:>24}: {seconds * 1e6:10.2f} us")
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON")
+    parser.add_argument("--filter", "-k", default = None,
+                        help = "only run cases with this in their name")
+    parser.add_argument("--repeat", type = int, default = 7)
+    args = parser.parse_args()
+    report = run(args.filter, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark the grid engines by placing blocks as fast as possible
+
+Every placement picks a random block, rotation and column, drops it
+straight down using grid.collision_at(), writes it with grid.set() and then
+clears full rows with grid.row_is_full().
+When the grid overflows it is replaced by a fresh one.
+Both engines get the exact same sequence of placements.
+
+usage: python -m benchmarks.bench_grid [placements]
+"""
+import random
+import sys
+import time
+
+from pytris.block import pieces
+from pytris.game import Game
+from pytris.grid import engines
+
+def placements(n, seed = 0):
+    """
+    Generate n random (color, rotation, column) placements
+    """
+    rng = random.Random(seed)
+    for _ in range(n):
+        piece = rng.choice(pieces)
+        rotation = rng.choice(piece.rotations)
+        left, top, right, bottom = rotation.bbox
+        yield piece.color, rotation, rng.randint(-left, 9 - right)
+
+def place(grid, color, rotation, column):
+    """
+    Drop a single block in a column
+    :return: False if the block doesn't fit anymore
+    """
+    y = 1
+    if grid.collision_at(column, y, rotation):
+        return False
+    while not grid.collision_at(column, y + 1, rotation):
+        y += 1
+    grid.set(color, [(column + dx, y + dy) for dx, dy in rotation.cells])
+    grid.row_is_full()
+    return y + rotation.bbox[1] > grid.top_buffer
+
+def bench(engine, trace):
+    """
+    :return: placements per second
+    """
+    game = Game(debug = True, engine = engine)
+    start = time.perf_counter()
+    for color, rotation, column in trace:
+        if not place(game.grid, color, rotation, column):
+            game.grid = engine(game)
+    return len(trace) / (time.perf_counter() - start)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    trace = list(placements(n))
+    results = {}
+    for name, engine in engines.items():
+        results[name] = bench(engine, trace)
+        print(f"{name:>6}: {results[name]:10.0f} placements/s")
+    print(f"speedup: {results['bit'] / results['list']:.2f}x")
+
+if __name__ == "__main__":
+    main()
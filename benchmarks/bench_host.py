@@ -0,0 +1,83 @@
+"""
+Load test of the game host (pytris-host, see pytris.telnet)
+
+Starts the host in its own process and connects simulated players to it
+(telnet.load), every player presses a random key 4 times per second on average.
+Reports for a number of concurrent sessions:
+    cpu     : CPU time of the host per second, 1.0 is a whole core
+    rss     : peak memory of the host
+    lag     : how late the host runs the gravity steps after their deadline
+    response: time between a key press and the next screen update arriving,
+              keys that don't change the screen wait for the next gravity step
+    traffic : bytes per second sent to every player
+
+The memory per session is the difference in peak memory between the smallest
+and the largest number of sessions.
+
+usage: python -m benchmarks.bench_host [sessions ...] [--duration S] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+
+from pytris.telnet import load
+
+def bench(sessions, duration):
+    with tempfile.TemporaryDirectory() as directory:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "pytris.telnet", "--bind", "127.0.0.1", "--port", "0", "--max-sessions", str(sessions * 2),
+             "--database", os.path.join(directory, "scores.db")],
+            stdout = subprocess.PIPE, text = True)
+        port = int(server.stdout.readline().split()[-1])
+        stats = asyncio.run(load("127.0.0.1", port, sessions, duration))
+        server.send_signal(signal.SIGINT)
+        host = json.loads(server.stdout.readline())
+        _, status, usage = os.wait4(server.pid, 0)
+        server.returncode = status
+    response = stats["response"].summary()
+    return {
+        "time": host["lag"]["p50"],
+        "p99": host["lag"]["p99"],
+        "response": response["p50"],
+        "cpu": (usage.ru_utime + usage.ru_stime) / duration,
+        "rss": usage.ru_maxrss * 1024,
+        "traffic": stats["bytes"] / duration / sessions,
+        "games": stats["sessions"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sessions", type = int, nargs = "*", default = [100, 500])
+    parser.add_argument("--duration", type = float, default = 10.0)
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON, see benchmarks.compare")
+    args = parser.parse_args()
+    results = {}
+    for sessions in args.sessions:
+        result = results[f"host[{sessions}]"] = bench(sessions, args.duration)
+        print(f"{sessions:5} sessions: cpu {result['cpu']:5.2f} rss {result['rss'] / 2 ** 20:6.1f} MB "
+              f"lag p50 {result['time'] * 1e3:5.2f} ms p99 {result['p99'] * 1e3:5.2f} ms "
+              f"response p50 {result['response'] * 1e3:5.2f} ms "
+              f"traffic {result['traffic']:6.0f} B/s per session")
+    if len(args.sessions) > 1:
+        low, high = min(args.sessions), max(args.sessions)
+        per_session = (results[f"host[{high}]"]["rss"] - results[f"host[{low}]"]["rss"]) / (high - low)
+        print(f"memory per session: {per_session / 1024:.0f} kB")
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark versus games on loopback
+
+Plays headless versus games with the autoplayer (see net.simulate) for 2 to 8 players,
+one block per frame at 60 frames per second, and reports the time between a player
+sending its board and the opponents receiving it through the server.
+A frame at 60 fps is 16.7 ms, the relay should stay well below that.
+
+usage: python -m benchmarks.bench_net [pieces] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import platform
+
+from pytris.net import simulate
+from pytris.stats import Histogram
+
+def bench(players, pieces):
+    """
+    :return: dict with the relay latency and the number of boards received
+    """
+    server, results = asyncio.run(simulate(players, pieces))
+    latency = Histogram()
+    for client, game in results:
+        latency.merge(client.latency)
+    summary = latency.summary()
+    return {
+        "time": summary["p50"],
+        "p99": summary["p99"],
+        "max": summary["max"],
+        "boards": latency.count,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pieces", type = int, nargs = "?", default = 300)
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON, see benchmarks.compare")
+    args = parser.parse_args()
+    results = {}
+    for players in (2, 4, 8):
+        result = results[f"relay[{players}]"] = bench(players, args.pieces)
+        print(f"{players} players: p50 {result['time'] * 1e3:6.2f} ms p99 {result['p99'] * 1e3:6.2f} ms "
+              f"max {result['max'] * 1e3:6.2f} ms {result['boards']:6} boards")
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
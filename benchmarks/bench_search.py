@@ -0,0 +1,77 @@
+"""
+Benchmark the transposition cache of the autoplayer
+
+Searches the same positions with and without a Cache and reports the time per search,
+the boards scored (nodes) per second and the hit rate of the cache.
+Searches found in the cache skip their boards, so compare the time per search.
+The positions come from a game played by the bot, so they look like real boards.
+
+usage: python -m benchmarks.bench_search [positions] [--lookahead N ...] [--beam N] [--output FILE]
+"""
+import argparse
+import json
+import platform
+import time
+
+from pytris.bot import Board, Bot, Cache
+from pytris.game import Game
+from pytris.grid import BitGrid
+
+def positions(count, seed = 0):
+    """
+    :return: list of (board, piece, preview) from a game of the bot
+    """
+    game = Game(engine = BitGrid, headless = True, seed = seed)
+    result = []
+    def policy(block):
+        if len(result) < count and block.anchor == (game.grid.width // 2, game.grid.top_buffer):
+            preview = game.queue.peek(3)
+            result.append((Board.from_grid(game.grid), block.piece, preview))
+        return bot(block)
+    bot = Bot(lookahead = 0)
+    game.run(policy, max_pieces = count)
+    return result
+
+def bench(boards, lookahead, beam, cache):
+    bot = Bot(lookahead = lookahead, beam = beam, cache = cache)
+    start = time.perf_counter()
+    for board, piece, preview in boards:
+        bot.search(board, piece, preview)
+    elapsed = time.perf_counter() - start
+    result = {
+        "time": elapsed / len(boards),
+        "nodes_per_second": bot.nodes / elapsed,
+        "nodes": bot.nodes,
+    }
+    if cache is not None:
+        result.update(hit_rate = cache.hit_rate(), cache_size = len(cache))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("positions", type = int, nargs = "?", default = 200)
+    parser.add_argument("--lookahead", type = int, nargs = "+", default = [2, 3])
+    parser.add_argument("--beam", type = int, default = 4)
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON, see benchmarks.compare")
+    args = parser.parse_args()
+    boards = positions(args.positions)
+    results = {}
+    for lookahead in args.lookahead:
+        for name, cache in (("search", None), ("search[cache]", Cache())):
+            result = results[f"{name}[lookahead={lookahead}]"] = bench(boards, lookahead, args.beam, cache)
+            print(f"{name:>14} lookahead {lookahead}: {result['time'] * 1e3:8.2f} ms/search "
+                  f"{result['nodes_per_second']:9.0f} nodes/s"
+                  + (f" {result['hit_rate']:6.1%} hits" if cache is not None else ""))
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark game snapshots and clones
+
+Games are played by the bot up to a number of pieces (with garbage rows pushed in
+to get higher stacks), then the size of a snapshot and the time to take it (dump),
+to restore it in a game (restore), to create a game from it (load) and to clone
+the game are reported, for both grid engines.
+
+usage: python -m benchmarks.bench_snapshot [--rows N ...] [--output FILE]
+"""
+import argparse
+import json
+import platform
+import timeit
+
+from pytris import snapshot
+from pytris.bot import bot
+from pytris.game import Game
+from pytris.grid import engines
+
+def played(engine, rows):
+    game = Game(engine = engine, headless = True, seed = 0)
+    game.run(policy = bot, max_pieces = 20)
+    game.spawn()
+    if rows:
+        game.grid.garbage(rows, 0)
+    return game
+
+def measure(function, number = 2000):
+    return min(timeit.repeat(function, number = number, repeat = 5)) / number
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, nargs = "*", default = [0, 10, 18],
+                        help = "garbage rows pushed in before the snapshot")
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON, see benchmarks.compare")
+    args = parser.parse_args()
+    results = {}
+    for name, engine in engines.items():
+        for rows in args.rows:
+            game = played(engine, rows)
+            data = snapshot.dump(game)
+            target = snapshot.load(data, headless = True)
+            result = {
+                "size": len(data),
+                "dump": measure(lambda: snapshot.dump(game)),
+                "restore": measure(lambda: snapshot.restore(target, data)),
+                "load": measure(lambda: snapshot.load(data, headless = True), 200),
+                "clone": measure(game.clone),
+            }
+            result["time"] = result["dump"]
+            results[f"{name}[{rows}]"] = result
+            stack = game.grid.height - min(game.grid.skyline)
+            print(f"{name:4} {stack:2} rows: {result['size']:4} bytes "
+                  f"dump {result['dump'] * 1e6:6.1f} us restore {result['restore'] * 1e6:6.1f} us "
+                  f"load {result['load'] * 1e6:6.1f} us clone {result['clone'] * 1e6:6.1f} us")
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark the time from starting the interpreter to the first frame on the terminal
+
+pytris is started in a pseudo terminal, the first frame is drawn when the
+side panel (the last static text, "exit     : x") shows up in the output.
+The game is killed right after. Every run is a fresh interpreter.
+Bytecode is cached in a temporary directory, like it would be after installing.
+
+usage: python -m benchmarks.bench_startup [runs] [--output FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import pty
+import select
+import signal
+import statistics
+import sys
+import tempfile
+import time
+
+marker = b"exit     : x"
+
+# Keep the bytecode of the runs out of the source tree
+pycache = tempfile.mkdtemp(prefix = "pytris-pycache-")
+
+def first_frame(timeout = 10.0):
+    """
+    Start pytris in a pty and wait for the first frame
+    :return: seconds from spawn to first frame
+    """
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.environ["TERM"] = "xterm-256color"
+        os.environ["LINES"] = "30"
+        os.environ["COLUMNS"] = "80"
+        os.environ.pop("PYTHONDONTWRITEBYTECODE", None)
+        os.environ["PYTHONPYCACHEPREFIX"] = pycache
+        os.execvp(sys.executable, [sys.executable, "-m", "pytris"])
+    out = b""
+    elapsed = None
+    try:
+        while time.perf_counter() - start < timeout:
+            ready, _, _ = select.select([fd], [], [], 0.01)
+            if ready:
+                try:
+                    out += os.read(fd, 65536)
+                except OSError:
+                    break
+                if marker in out:
+                    elapsed = time.perf_counter() - start
+                    break
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(fd)
+    if elapsed is None:
+        raise RuntimeError("pytris didn't draw a frame:\n" + out.decode(errors = "replace"))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("runs", type = int, nargs = "?", default = 50)
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON")
+    args = parser.parse_args()
+    # Warm up the bytecode cache
+    first_frame()
+    times = [first_frame() for _ in range(args.runs)]
+    result = {
+        "time": statistics.median(times),
+        "min": min(times),
+        "max": max(times),
+        "runs": args.runs,
+    }
+    print(f"start to first frame: median {result['time'] * 1000:.1f} ms, "
+          f"min {result['min'] * 1000:.1f} ms, max {result['max'] * 1000:.1f} ms")
+    if args.output:
+        # Same format as the other benchmarks, see benchmarks.compare
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": {"startup": result},
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark the vectorized environment against looping over Game instances
+
+Both sides play K games with random actions, one action and one gravity
+step per game per step. The Game side does the same work per game as
+Game.run(), one frame at a time.
+
+The speedup grows with K, numpy calls cost the same for every K.
+
+usage: python -m benchmarks.bench_vector [K ...] [--steps N] [--output FILE]
+"""
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+
+from pytris.game import Game
+from pytris.grid import BitGrid
+from pytris.vector import VectorEnv, actions
+
+def new_game(seed):
+    game = Game(engine = BitGrid, headless = True, seed = seed)
+    game.block = game.queue.pop()
+    return game
+
+def step(game, action):
+    """
+    Apply one action and gravity to a Game
+    :return: Game, a new one when the game is over
+    """
+    block = game.block
+    if action == 6:
+        block.drop()
+    elif action > 0:
+        getattr(block, actions[action])()
+    block.down()
+    if not block.mobile:
+        game.grid.row_is_full()
+        if game.gameover:
+            return new_game(game.seed + 1)
+        game.block = game.queue.pop()
+    return game
+
+def bench_games(k, steps, moves):
+    games = [new_game(seed) for seed in range(k)]
+    start = time.perf_counter()
+    for i in range(steps):
+        for j in range(k):
+            games[j] = step(games[j], moves[i, j])
+    return k * steps / (time.perf_counter() - start)
+
+def bench_vector(k, steps, moves):
+    env = VectorEnv(k, seed = 0)
+    start = time.perf_counter()
+    for i in range(steps):
+        env.step(moves[i])
+    return k * steps / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("k", type = int, nargs = "*", default = [512, 4096])
+    parser.add_argument("--steps", type = int, default = 100)
+    parser.add_argument("--output", "-o", metavar = "FILE", default = None,
+                        help = "write the results as JSON, see benchmarks.compare")
+    args = parser.parse_args()
+    results = {}
+    for k in args.k:
+        moves = np.random.default_rng(0).integers(0, len(actions), (args.steps, k))
+        games = bench_games(k, args.steps, moves)
+        vector = bench_vector(k, args.steps, moves)
+        print(f"K = {k}")
+        print(f"  Game: {games:12.0f} game steps/s")
+        print(f"vector: {vector:12.0f} game steps/s")
+        print(f"speedup: {vector / games:.1f}x")
+        results[f"vector[{k}]"] = {
+            "time": 1 / vector,
+            "game": 1 / games,
+            "speedup": vector / games,
+        }
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f_out:
+            json.dump(report, f_out, indent = 2)
+            f_out.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare benchmark results against a baseline
+
+Both files are JSON reports as written by the benchmarks with --output,
+every case that is in both reports is compared by its time.
+A case is a regression when it got slower by more than the threshold.
+
+usage: python -m benchmarks.compare BASELINE NEW [--threshold 0.1]
+exits with 1 when there are regressions
+"""
+import argparse
+import json
+import sys
+
+def load(path):
+    """
+    :return: dict of case -> seconds
+    """
+    with open(path) as f_in:
+        report = json.load(f_in)
+    return {name: result["time"] for name, result in report["results"].items()}
+
+def compare(baseline, new, threshold = 0.1):
+    """
+    :return: list of (case, baseline time, new time, ratio, verdict)
+    """
+    rows = []
+    for name in baseline:
+        if name not in new:
+            continue
+        ratio = new[name] / baseline[name]
+        if ratio > 1 + threshold:
+            verdict = "REGRESSION"
+        elif ratio < 1 - threshold:
+            verdict = "faster"
+        else:
+            verdict = ""
+        rows.append((name, baseline[name], new[name], ratio, verdict))
+    return rows
+
+def main(args = None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", "-t", type = float, default = 0.1,
+                        help = "relative change that is flagged (default 0.1 = 10%%)")
+    args = parser.parse_args(args)
+    baseline = load(args.baseline)
+    new = load(args.new)
+    rows = compare(baseline, new, args.threshold)
+    print(f"{'case':>24} {'baseline':>12} {'new':>12} {'ratio':>7}")
+    for name, old_time, new_time, ratio, verdict in rows:
+        print(f"{name:>24} {old_time * 1e6:10.2f}us {new_time * 1e6:10.2f}us {ratio:6.2f}x {verdict}")
+    missing = sorted(set(baseline) ^ set(new))
+    if missing:
+        print("only in one report: " + ", ".join(missing))
+    regressions = [row for row in rows if row[4] == "REGRESSION"]
+    print(f"{len(regressions)} regressions beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,16 @@
 # Code based on https://simpleaudio.readthedocs.io/en/latest/tutorial.html#waveobject-s
 # Song composition based on http://www.piano-keyboard-guide.com/how-to-play-the-tetris-theme-song-easy-piano-tutorial-korobeiniki/
 
-import numpy as np
-import simpleaudio as sa
+"""
+The theme song is only synthesized when audio is actually requested
+Rendered songs are cached on disk per song, tempo and sample rate,
+and read back as a memory map, so after the first game starting the music is instant.
+numpy is imported when it is needed. The song is played by a mixer.Mixer.
+"""
+
+import hashlib
+import os
+from pathlib import Path
 
 # Song improved by Lorenzo Gaifas
 song = ["E","B","C"] + ["D","C","B"] + ["A","A","C"] + ["E","D","C"] + ["B","B","C"] + ["D","E","C","A","A"] + \
@@ -26,31 +34,70 @@ note_to_freq = {
         for n, f in zip(notes, freqs)
         }
 
-# get timesteps for each sample, T is note duration in seconds
+# T is note duration in seconds
 sample_rate = 44100
 T = 0.25
-t = lambda factor: np.linspace(0, T*factor, T*factor * sample_rate, False)
-
-def note_to_sine(note, time):
-    f = note_to_freq[note]
-    return np.sin(f * t(time) * 2 * np.pi) 
-
-song_sines = [
-        note_to_sine(note, time)
-        for note, time in zip(song, timing)
-        ]
-
-# concatenate notes
-audio = np.hstack(song_sines)
-# normalize to 16-bit range
-audio *= 32767 / np.max(np.abs(audio))
-# dampen a bit
-audio *= 0.255555
-# convert to 16-bit data
-audio = audio.astype(np.int16)
-
-# start playback
-def start():
-    while True:
-        play_obj = sa.play_buffer(audio, 1, 2, sample_rate)
-        play_obj.wait_done()
+
+# Rendered songs are stored here
+cache_dir = Path.home() / ".cache" / "pytris"
+
+def level_tempo(level):
+    """
+    The music speeds up a little every level
+    :return: float, tempo factor
+    """
+    return min(1 + 0.1 * (level - 1), 2.0)
+
+def key(tempo = 1.0, rate = sample_rate):
+    """
+    Name of a rendered song in the cache
+    Changing the song or timing gives a new name
+    """
+    digest = hashlib.sha1(repr((song, timing)).encode()).hexdigest()[:12]
+    return f"korobeiniki-{digest}-{tempo:.3f}-{rate}.pcm"
+
+def synth(frequencies, durations, rate = sample_rate, volume = 0.255555):
+    """
+    Synthesize a sequence of sine tones, a frequency of 0 is silence
+    :param durations: duration of each tone in seconds
+    :return: int16 numpy array of mono samples
+    """
+    import numpy as np
+    # Samples per tone
+    lengths = [int(duration * rate) for duration in durations]
+    starts = np.repeat(np.cumsum([0] + lengths[:-1]), lengths)
+    f = np.repeat(frequencies, lengths)
+    # Time since the start of each tone
+    t = (np.arange(len(f)) - starts) / rate
+    audio = np.sin(f * t * 2 * np.pi)
+    # normalize to 16-bit range
+    audio *= 32767 / np.max(np.abs(audio))
+    # dampen a bit
+    audio *= volume
+    # convert to 16-bit data
+    return audio.astype(np.int16)
+
+def render(tempo = 1.0, rate = sample_rate):
+    """
+    Synthesize the song
+    :return: int16 numpy array of mono samples
+    """
+    return synth([note_to_freq[note] for note in song],
+                 [T * time / tempo for time in timing], rate)
+
+def load(tempo = 1.0, rate = sample_rate, directory = None):
+    """
+    Get a rendered song from the cache, rendering it the first time
+    :return: read only int16 numpy memmap
+    """
+    import numpy as np
+    if directory is None:
+        directory = cache_dir
+    path = Path(directory) / key(tempo, rate)
+    if not path.exists():
+        path.parent.mkdir(parents = True, exist_ok = True)
+        # Write to a temporary file first, so a half written song is never read
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        render(tempo, rate).tofile(tmp)
+        os.replace(tmp, path)
+    return np.memmap(path, dtype = np.int16, mode = "r")
@@ -20,15 +20,196 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
-import numpy as np
-import random
+from collections import deque, namedtuple
+
+"""
+Block definitions, every block has a color and a list of rotational states
+Each state is a list of (x, y) offsets relative to the anchor point
+
+Colors:
+    0: black
+    1: red
+    2: green
+    3: yellow
+    4: blue
+    5: magenta
+    6: cyan
+    7: white
+"""
+shapes = [
+    ("I", 1, [
+        [
+                            (0, 2),
+                            (0, 1),
+                            (0, 0),
+                            (0,-1)
+        ],
+        [
+                    (-1,0),(0,0),(1,0),(2,0)
+        ],
+        [
+                            (0, 2),
+                            (0, 1),
+                            (0, 0),
+                            (0,-1)
+        ],
+        [
+            (-2,0),(-1,0),(0,0),(1,0)
+        ]
+    ]),
+    ("T", 2, [
+        [
+                     (0, 1),
+            (-1, 0), (0, 0), (1, 0),
+        ],
+
+        [
+                     (0, 1),
+            (-1, 0), (0, 0),
+                     (0,-1)
+        ],
+        [
+            (-1, 0), (0, 0), (1, 0),
+                     (0, -1)
+        ],
+        [
+                     (0, 1),
+                     (0, 0), (1, 0),
+                     (0,-1)
+        ]
+    ]),
+    ("O", 3, [
+        [
+            (-1, 0), (0, 0),
+            (-1,-1), (0,-1)
+        ]
+    ]),
+    ("L", 4, [
+        [
+            (0, 1),
+            (0, 0),
+            (0,-1), (1,-1)
+        ],
+        [
+            (-1,0),(0,0),(1,0),
+            (-1,-1)
+        ],
+        [
+            (-1, 1), (0, 1),
+                     (0, 0),
+                     (0,-1)
+        ],
+        [
+                             (1, 1),
+            (-1, 0), (0, 0), (1, 0),
+        ]
+    ]),
+    ("J", 5, [
+        [
+                     (0, 1),
+                     (0, 0),
+            (-1,-1), (0,-1)
+        ],
+        [
+            (-1, 1),
+            (-1, 0), (0, 0), (1, 0),
+        ],
+        [
+                    (0, 1), (1, 1),
+                    (0, 0),
+                    (0,-1)
+        ],
+        [
+            (-1, 0), (0, 0), (1, 0),
+                             (1,-1)
+        ]
+    ]),
+    ("S", 6, [
+        [
+                    (0, 1), (1, 1),
+            (-1,0), (0, 0)
+        ],
+        [
+            (0, 1),
+            (0, 0), (1, 0),
+                    (1,-1)
+        ]
+    ]),
+    ("Z", 7, [
+        [
+            (-1,1), (0, 1),
+                    (0, 0), (1, 0)
+        ],
+        [
+                    (1, 1),
+            (0, 0), (1, 0),
+            (0,-1)
+        ]
+    ]),
+]
+
+"""
+Compiled block definitions, these are built once at import
+and shared by every block of the same kind
+
+Piece:
+    index       : position in the pieces tuple
+    name        : name of the block
+    color       : color of the block
+    states      : tuple of rotational states, each a tuple of (dx, dy) offsets
+    rotations   : tuple of compiled Rotation per state
+
+Rotation:
+    cells       : tuple of (dx, dy) offsets relative to the anchor
+    bbox        : (left, top, right, bottom) extremes of the offsets
+    rows        : tuple of (dy, mask) with bit (dx - left) set for each cell in row dy
+    bottoms     : tuple of (dx, dy) with the lowest (largest) dy of every column dx
+"""
+Piece = namedtuple("Piece", ["index", "name", "color", "states", "rotations"])
+Rotation = namedtuple("Rotation", ["cells", "bbox", "rows", "bottoms"])
+
+def compile_rotation(state):
+    """
+    Precompute the offsets, bounding box and row masks of a single state
+    :return: Rotation
+    """
+    cells = tuple((dx, dy) for dx, dy in state)
+    xs = [dx for dx, dy in cells]
+    ys = [dy for dx, dy in cells]
+    left, top = min(xs), min(ys)
+    bbox = (left, top, max(xs), max(ys))
+    rows = {}
+    bottoms = {}
+    for dx, dy in cells:
+        rows[dy] = rows.get(dy, 0) | 1 << (dx - left)
+        bottoms[dx] = max(bottoms.get(dx, dy), dy)
+    return Rotation(cells, bbox, tuple(sorted(rows.items())), tuple(sorted(bottoms.items())))
+
+def compile_pieces():
+    """
+    Compile all block definitions
+    :return: tuple of Piece
+    """
+    compiled = []
+    for index, (name, color, states) in enumerate(shapes):
+        rotations = tuple(compile_rotation(state) for state in states)
+        cells = tuple(rotation.cells for rotation in rotations)
+        compiled.append(Piece(index, name, color, cells, rotations))
+    return tuple(compiled)
+
+pieces = compile_pieces()
 
 class Block():
     """
     Base block class, is inherited from to form individual blocks
     Collisions are checked upon movement
     """
-    def __init__(self, game, *args, color = 0, states = [], name = "", **kwargs):
+    __slots__ = (
+        "piece", "color", "states", "rotations", "name", "game", "mobile",
+        "anchor", "rotation", "previous", "history"
+    )
+
+    def __init__(self, game, *args, piece = pieces[0], **kwargs):
         """
         Base block object
             init()                  : Spawns new block
@@ -46,43 +227,72 @@ class Block():
             anchor                  : tuple( y, x ) to define anchor point
             color                   : character to draw on the grid
             states                  : list of rotational states
+            rotations               : compiled rotational states (see Rotation)
             rotation                : Current relative rotation to anchor
+            previous                : ( anchor, rotation ) before the last move
+            history                 : ring buffer of the last game.history poses
+                                      or None when the game doesn't keep a history
 
         """
-        self.color = color
-        self.states = states
-        self.name = name
+        self.piece = piece
+        self.color = piece.color
+        self.states = piece.states
+        self.rotations = piece.rotations
+        self.name = piece.name
 
         self.game = game
         insert_point = (self.game.grid.width // 2, self.game.grid.top_buffer)
         self.mobile = True
 
         # Initialize block definition
-        self.anchor = [insert_point]
-        self.rotation = [0]
-
+        self.anchor = insert_point
+        self.rotation = 0
+        self.previous = (insert_point, 0)
+        self.history = None
+        if self.game.history:
+            self.history = deque([self.previous], maxlen = self.game.history)
 
     def __str__(self):
         return self.__class__.__name__
 
+    def clone(self, game):
+        """
+        Copy of the block for another game
+        :return: Block
+        """
+        block = Block.__new__(Block)
+        block.piece = self.piece
+        block.color = self.color
+        block.states = self.states
+        block.rotations = self.rotations
+        block.name = self.name
+        block.game = game
+        block.mobile = self.mobile
+        block.anchor = self.anchor
+        block.rotation = self.rotation
+        block.previous = self.previous
+        block.history = None
+        if self.history is not None:
+            block.history = self.history.copy()
+        return block
+
     def position(self, anchor = None):
         """
         Optional: set a custom anchor
         returns: an array of coordinates
         """
-        if anchor == None:
-            anchor = self.anchor[-1]
-        return np.add(anchor, self.states[self.rotation[-1]])
+        if anchor is None:
+            anchor = self.anchor
+        x, y = anchor
+        return [(x + dx, y + dy) for dx, dy in self.states[self.rotation]]
 
     def last(self):
         """
         Get the previous position, used for blanking old block position
-        only if len of anchor and rotation >= 2..
+        Before the first move this is the current position
         """
-        try:
-            return np.add(self.anchor[-2], self.states[self.rotation[-2]])
-        except IndexError:
-            return self.position() # Should be fine...
+        (x, y), rotation = self.previous
+        return [(x + dx, y + dy) for dx, dy in self.states[rotation]]
 
     def move(move_func):
         """
@@ -91,55 +301,56 @@ class Block():
         If block collided with the bottom of the grid or the
         top of a block, move the block to grid
         If block collided with a wall (sideways),
-        revert the move by popping the last item
+        revert the move by restoring the pose from before the move
         Finally automatically draw the block to the screen
         :param move_func: A function that moves the block
         :return: Boolean signifying collision
         """
+        is_down = move_func.__name__ == "down"
         def wrapper(self):
             if not self.mobile:
                 # Block is not mobile but trying to move block
                 return False
+            pose = (self.anchor, self.rotation)
             move_func(self)
             # First check if a collision has occurred
             if self.collision():
                 # If it has, revert the move
-                self.anchor.pop(-1)
-                self.rotation.pop(-1)
+                self.anchor, self.rotation = pose
                 # Check if the last move was downward
-                if move_func.__name__ == "down":
+                if is_down:
                     # If it was, it's a bottom collision
-                    self.to_grid()
-                    self.mobile = False
-                    # If the block was at the top of the screen, trigger game over
-                    self.game.gameover = self.is_gameover()
-                    self.game.screen.block()
+                    self.lock()
                     return False
+            else:
+                self.previous = pose
+                if self.history is not None:
+                    self.history.append((self.anchor, self.rotation))
 
-            self.game.screen.block()
+            if self.game.screen:
+                self.game.screen.block()
             return True
         return wrapper
 
+    def act(self, action):
+        """
+        Apply a move (see replay.actions) through Game.act when this is the mobile block
+        of the game, so moves of policies are recorded like the moves of the player
+        :return: result of the move
+        """
+        if self is self.game.block:
+            return self.game.act(action)
+        return getattr(self, action)()
+
     def random_move(self):
-        # Init all moves, used for picking a random move
-        self.moves = [
-            self.down,
-            self.left,
-            self.right,
-            self.clockwise,
-            self.countercw
-        ]
-        picked_move = self.moves[random.randint(0, len(self.moves) - 1)]
-        return picked_move()
+        return self.act(self.moves[self.game.random.randint(0, len(self.moves) - 1)])
 
     def is_gameover(self):
         """
         Test whether an y coord is above the buffer zone
         """
-        for x, y in self.position():
-            if y <= self.game.grid.top_buffer:
-                return True
-        return False
+        left, top, right, bottom = self.rotations[self.rotation].bbox
+        return self.anchor[1] + top <= self.game.grid.top_buffer
 
     def collision(self):
         """
@@ -147,217 +358,96 @@ class Block():
         the grid or a wall
         :return: Boolean
         """
-        for x, y in self.position():
-            if not 0 <= x < self.game.grid.width:
-                return True
-            if not 0 <= y < self.game.grid.height:
-                return True
-            if self.game.grid[x][y] != 0:
-                return True
-        return False
+        x, y = self.anchor
+        return self.game.grid.collision_at(x, y, self.rotations[self.rotation])
 
 
     def to_grid(self):
         self.game.grid.set(self.color, self.position())
 
+    def lock(self):
+        """
+        Move the block to the grid, after which it can't move anymore
+        """
+        self.to_grid()
+        self.mobile = False
+        # If the block was at the top of the screen, trigger game over
+        self.game.gameover = self.is_gameover()
+        if self.game.screen:
+            self.game.screen.block()
+
     @move
     def down(self):
-        now = self.anchor[-1]
-        next = tuple(np.add(now, (0, 1)))
-        self.anchor.append(next)
-        self.rotation.append(self.rotation[-1])
+        x, y = self.anchor
+        self.anchor = (x, y + 1)
 
     def drop(self):
-        while self.mobile:
-            self.down()
+        """
+        Hard drop, move the block straight to where it lands and lock it there
+        The landing position comes from the grid (see Grid.landing), so this
+        is a single move and a single redraw
+        """
+        if not self.mobile:
+            return False
+        x, y = self.anchor
+        pose = (self.anchor, self.rotation)
+        y = self.game.grid.landing(x, y, self.rotations[self.rotation])
+        if (x, y) != self.anchor:
+            self.anchor = (x, y)
+            self.previous = pose
+            if self.history is not None:
+                self.history.append((self.anchor, self.rotation))
+        self.lock()
+        return True
 
     @move
     def left(self):
-        now = self.anchor[-1]
-        next = tuple(np.subtract(now, (1, 0)))
-        self.anchor.append(next)
-        self.rotation.append(self.rotation[-1])
+        x, y = self.anchor
+        self.anchor = (x - 1, y)
 
     @move
     def right(self):
-        now = self.anchor[-1]
-        next = tuple(np.add(now, (1, 0)))
-        self.anchor.append(next)
-        self.rotation.append(self.rotation[-1])
+        x, y = self.anchor
+        self.anchor = (x + 1, y)
 
     @move
     def clockwise(self):
-        tmp = 0
-        if len(self.states) > 1:
-            tmp = self.rotation[-1] + 1
-            tmp = tmp % (len(self.states))
-        self.rotation.append(tmp)
-        self.anchor.append(self.anchor[-1])
+        self.rotation = (self.rotation + 1) % len(self.states)
 
     @move
     def countercw(self):
-        tmp = 0
-        if len(self.states) > 1:
-            tmp = self.rotation[-1] - 1
-            if tmp < 0:
-                tmp = len(self.states) - 1
-        self.rotation.append(tmp)
-        self.anchor.append(self.anchor[-1])
+        self.rotation = (self.rotation - 1) % len(self.states)
 
-    """
-    0: black
-    1: red
-    2: green
-    3: yellow
-    4: blue
-    5: magenta
-    6: cyan
-    7: white
-    """
+    # Moves to pick from in random_move
+    moves = ("down", "left", "right", "clockwise", "countercw")
 
     @classmethod
     def I(cls, *args, **kwargs):
-        states = [
-            [
-                                (0, 2),
-                                (0, 1),
-                                (0, 0),
-                                (0,-1)
-            ],
-            [
-                        (-1,0),(0,0),(1,0),(2,0)
-            ],
-            [
-                                (0, 2),
-                                (0, 1),
-                                (0, 0),
-                                (0,-1)
-            ],
-            [
-                (-2,0),(-1,0),(0,0),(1,0)
-            ]
-        ]
-        color = 1
-        return cls(*args, color=color, states=states, name=__name__, **kwargs)
+        return cls(*args, piece=pieces[0], **kwargs)
 
     @classmethod
     def T(cls, *args, **kwargs):
-        states = [
-            [
-                         (0, 1),
-                (-1, 0), (0, 0), (1, 0),
-            ],
-
-            [
-                         (0, 1),
-                (-1, 0), (0, 0),
-                         (0,-1)
-            ],
-            [
-                (-1, 0), (0, 0), (1, 0),
-                         (0, -1)
-            ],
-            [
-                         (0, 1),
-                         (0, 0), (1, 0),
-                         (0,-1)
-            ]
-        ]
-        color = 2
-        return cls(*args, color=color, states=states, name=__name__, **kwargs)
+        return cls(*args, piece=pieces[1], **kwargs)
 
     @classmethod
     def O(cls, *args, **kwargs):
-        states = [
-            [
-                (-1, 0), (0, 0),
-                (-1,-1), (0,-1)
-            ]
-        ]
-        color = 3
-        return cls(*args, color=color, states=states, name=__name__, **kwargs)
+        return cls(*args, piece=pieces[2], **kwargs)
 
     @classmethod
     def L(cls, *args, **kwargs):
-        states = [
-            [
-                (0, 1),
-                (0, 0),
-                (0,-1), (1,-1)
-            ],
-            [
-                (-1,0),(0,0),(1,0),
-                (-1,-1)
-            ],
-            [
-                (-1, 1), (0, 1),
-                         (0, 0),
-                         (0,-1)
-            ],
-            [
-                                 (1, 1),
-                (-1, 0), (0, 0), (1, 0),
-            ]
-        ]
-        color = 4
-        return cls(*args, color=color, states=states, name=__name__, **kwargs)
+        return cls(*args, piece=pieces[3], **kwargs)
 
     @classmethod
     def J(cls, *args, **kwargs):
-        states = [
-            [
-                         (0, 1),
-                         (0, 0),
-                (-1,-1), (0,-1)
-            ],
-            [
-                (-1, 1),
-                (-1, 0), (0, 0), (1, 0),
-            ],
-            [
-                        (0, 1), (1, 1),
-                        (0, 0),
-                        (0,-1)
-            ],
-            [
-                (-1, 0), (0, 0), (1, 0),
-                                 (1,-1)
-            ]
-        ]
-        color = 5
-        return cls(*args, color=color, states=states, name=__name__, **kwargs)
+        return cls(*args, piece=pieces[4], **kwargs)
 
     @classmethod
     def S(cls, *args, **kwargs):
-        states = [
-            [
-                        (0, 1), (1, 1),
-                (-1,0), (0, 0)
-            ],
-            [
-                (0, 1),
-                (0, 0), (1, 0),
-                        (1,-1)
-            ]
-        ]
-        color = 6
-        return cls(*args, color=color, states=states, name=__name__, **kwargs)
+        return cls(*args, piece=pieces[5], **kwargs)
 
     @classmethod
     def Z(cls, *args, **kwargs):
-        states = [
-            [
-                (-1,1), (0, 1),
-                        (0, 0), (1, 0)
-            ],
-            [
-                        (1, 1),
-                (0, 0), (1, 0),
-                (0,-1)
-            ]
-        ]
-        color = 7
-        return cls(*args, color=color, states=states, name=__name__, **kwargs)
+        return cls(*args, piece=pieces[6], **kwargs)
 
 blocks = [
     Block.I,
@@ -367,4 +457,4 @@ blocks = [
     Block.J,
     Block.S,
     Block.Z
-]
\ No newline at end of file
+]
@@ -0,0 +1,398 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Autoplayer that searches all placements of the current block and the next ones in the queue
+
+A placement is a rotation and a column. A placement is reachable when the block
+can be rotated at the spawn point, moved sideways to the column and then dropped.
+Every placement is scored on the board it leaves behind with a weighted sum of:
+    lines       : number of lines cleared
+    height      : aggregate height, the sum of the column heights
+    holes       : empty cells with an occupied cell somewhere above them
+    bumpiness   : sum of the height differences between neighbouring columns
+    wells       : sum of the depths of columns that are lower than both neighbours
+
+The search works on a copy of the grid as row bitmasks (see grid.BitGrid),
+so it is the same for both grid engines and doesn't touch the game.
+
+With a lookahead the same board can be reached through different placements.
+The values of those searches can be kept in a Cache, by the Zobrist hash of the
+board (see grid.Zobrist) and the pieces still to place. Scoring a single board is
+cheaper than hashing it, so only the values of searches are cached. The cache is
+off by default, it only breaks even on benchmarks/bench_search.py.
+"""
+
+# Relative imports
+from .grid import zobrist
+
+# Stdlib
+from collections import OrderedDict
+
+# Board features, in the order of Board.features()
+features = ("lines", "height", "holes", "bumpiness", "wells")
+
+# Default weights of the board features
+weights = {
+    "lines": 0.76,
+    "height": -0.51,
+    "holes": -0.36,
+    "bumpiness": -0.18,
+    "wells": 0.0,
+}
+
+def popcount(mask):
+    return bin(mask).count("1")
+
+class Board():
+    """
+    Immobile blocks as row bitmasks, with the top of every column and the number of holes
+    Boards are not changed, place() returns a new board
+    The Zobrist hash is only computed when it is asked for, a search without a cache doesn't pay for it
+    """
+    __slots__ = ("rows", "tops", "holes", "_hash", "width", "height", "full", "top_buffer")
+
+    def __init__(self, rows, width, height, top_buffer, tops = None, holes = None):
+        self.rows = rows
+        self.width = width
+        self.height = height
+        self.top_buffer = top_buffer
+        self.full = (1 << width) - 1
+        if tops is None:
+            tops, holes = self.scan()
+        self.tops = tops
+        self.holes = holes
+        self._hash = None
+
+    @property
+    def hash(self):
+        """
+        Zobrist hash of the rows, the same as the hash of a grid with these cells (see grid.Zobrist)
+        """
+        if self._hash is None:
+            self._hash = zobrist.rows(self.rows)
+        return self._hash
+
+    @classmethod
+    def from_grid(cls, grid):
+        """
+        Copy a grid of either engine
+        """
+        return cls(list(grid.masks()), grid.width, grid.height, grid.top_buffer)
+
+    def scan(self):
+        """
+        Compute the top of every column and the number of holes from the rows
+        :return: (tops, holes)
+        """
+        tops = [self.height] * self.width
+        covered = 0
+        holes = 0
+        for y, row in enumerate(self.rows):
+            holes += popcount(covered & ~row)
+            new = row & ~covered
+            while new:
+                low = new & -new
+                tops[low.bit_length() - 1] = y
+                new ^= low
+            covered |= row
+        return tops, holes
+
+    def collision(self, rotation, x, y):
+        """
+        Same as BitGrid.collision_at
+        """
+        left, top, right, bottom = rotation.bbox
+        if x + left < 0 or x + right >= self.width:
+            return True
+        if y + top < 0 or y + bottom >= self.height:
+            return True
+        rows = self.rows
+        shift = x + left
+        for dy, mask in rotation.rows:
+            if rows[y + dy] & (mask << shift):
+                return True
+        return False
+
+    def landing(self, rotation, x, y):
+        """
+        Same as Grid.landing, but on the tops of this board
+        """
+        tops = self.tops
+        land = self.height
+        for dx, bottom in rotation.bottoms:
+            top = tops[x + dx]
+            if y + bottom >= top:
+                break
+            if top - 1 - bottom < land:
+                land = top - 1 - bottom
+        else:
+            return land
+        while not self.collision(rotation, x, y + 1):
+            y += 1
+        return y
+
+    def place(self, rotation, x, y):
+        """
+        Place a block and clear the full rows
+        :return: (new Board, lines cleared)
+        """
+        rows = list(self.rows)
+        shift = x + rotation.bbox[0]
+        full = self.full
+        lines = 0
+        for dy, mask in rotation.rows:
+            rows[y + dy] |= mask << shift
+            if rows[y + dy] == full:
+                lines += 1
+        if lines:
+            kept = [row for row in rows if row != full]
+            rows = [0] * lines + kept
+            return Board(rows, self.width, self.height, self.top_buffer), lines
+        # Without cleared lines the holes under the block can be counted from the tops
+        tops = list(self.tops)
+        holes = self.holes
+        for dx, bottom in rotation.bottoms:
+            column = x + dx
+            holes += tops[column] - (y + bottom) - 1
+        for dx, dy in rotation.cells:
+            if y + dy < tops[x + dx]:
+                tops[x + dx] = y + dy
+        return Board(rows, self.width, self.height, self.top_buffer, tops, holes), 0
+
+    def features(self, lines):
+        """
+        :return: tuple of board features, in the order of bot.features
+        """
+        # Everything is computed on the tops (height - top is the column height),
+        # this is the hot path of the search so it avoids function calls
+        tops = self.tops
+        bumpiness = 0
+        wells = 0
+        # Walls count as full columns (top 0) for the wells
+        left = 0
+        top = tops[0]
+        for right in tops[1:]:
+            step = top - right
+            bumpiness += step if step > 0 else -step
+            wall = left if left > right else right
+            if top > wall:
+                wells += top - wall
+            left, top = top, right
+        if top > left:
+            wells += top - left
+        return (lines, self.height * self.width - sum(tops), self.holes, bumpiness, wells)
+
+    def placements(self, piece, x, y):
+        """
+        All reachable placements of a piece that spawns at (x, y)
+        :return: list of (rotation index, column)
+        """
+        result = []
+        rotations = piece.rotations
+        for index, rotation in enumerate(rotations):
+            # Rotations are reached by rotating clockwise at the spawn point
+            if self.collision(rotation, x, y):
+                break
+            result.append((index, x))
+            for step in (-1, 1):
+                column = x + step
+                while not self.collision(rotation, column, y):
+                    result.append((index, column))
+                    column += step
+        return result
+
+class Cache():
+    """
+    Transposition cache, a dict with a maximum size that drops the least recently used entries
+    Keeps track of the hits and misses
+    """
+    def __init__(self, size = 1 << 16):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        :return: the value or None when it's not in the cache
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate(),
+        }
+
+class Bot():
+    """
+    Policy that moves the block to the best placement
+    Called with the mobile block, like Block.random_move, see Game.run()
+
+    Contains:
+        weights     : dict of weights per board feature
+        lookahead   : number of blocks from the queue that are placed after the current one
+        beam        : number of best placements that are searched further at every block
+        cache       : Cache of search values by (board hash, pieces to place), or None
+        nodes       : number of boards scored so far, not counting the searches found in the cache
+    """
+    def __init__(self, weights = weights, lookahead = 1, beam = 4, cache = None):
+        self.weights = dict(weights)
+        # Weights in the order of the features
+        self.vector = tuple(self.weights.get(name, 0.0) for name in features)
+        self.lookahead = lookahead
+        self.beam = beam
+        self.cache = cache
+        self.nodes = 0
+
+    def static(self, board):
+        """
+        Weighted sum of the features of a board, without the lines
+        """
+        self.nodes += 1
+        a, b, c, d, e = self.vector
+        lines, height, holes, bumpiness, wells = board.features(0)
+        return b * height + c * holes + d * bumpiness + e * wells
+
+    def score(self, board, lines):
+        """
+        Weighted sum of the features of a board
+        """
+        return self.vector[0] * lines + self.static(board)
+
+    def options(self, board, piece, x, y):
+        """
+        Score all placements of a piece
+        :return: list of (score, rotation index, column, board after, lines)
+        """
+        options = []
+        for index, column in board.placements(piece, x, y):
+            rotation = piece.rotations[index]
+            land = board.landing(rotation, column, y)
+            after, lines = board.place(rotation, column, land)
+            if land + rotation.bbox[1] <= board.top_buffer:
+                # Placing the block here ends the game
+                score = float("-inf")
+            else:
+                score = self.score(after, lines)
+            options.append((score, index, column, after, lines))
+        return options
+
+    def expand(self, options, preview, x, y):
+        """
+        Search the best options further with the blocks in the preview
+        :return: list of (score, rotation index, column)
+        """
+        if not preview:
+            return [option[:3] for option in options]
+        options = sorted(options, key = lambda option: option[0], reverse = True)
+        result = []
+        for score, index, column, after, lines in options[:self.beam]:
+            if score != float("-inf"):
+                # Count the lines of all blocks
+                score = self.vector[0] * lines + self.value(after, preview, x, y)
+            result.append((score, index, column))
+        return result
+
+    def value(self, board, pieces, x, y):
+        """
+        Best score that can be reached by placing pieces one after the other
+        """
+        cache = self.cache
+        if cache is not None:
+            key = (board.hash, pieces)
+            value = cache.get(key)
+            if value is not None:
+                return value
+        options = self.options(board, pieces[0], x, y)
+        value = max((option[0] for option in self.expand(options, pieces[1:], x, y)),
+                    default = float("-inf"))
+        if cache is not None:
+            cache.put(key, value)
+        return value
+
+    def search(self, board, piece, preview = (), x = None, y = None):
+        """
+        Find the best placement of a piece, looking ahead at the pieces in the preview
+        :return: (score, rotation index, column) or None when the piece can't be placed at all
+        """
+        if x is None:
+            x, y = board.width // 2, board.top_buffer
+        options = self.options(board, piece, x, y)
+        if not options:
+            return None
+        return max(self.expand(options, tuple(preview[:self.lookahead]), x, y),
+                   key = lambda option: option[0])
+
+    def __call__(self, block):
+        """
+        Move the block to the best placement and drop it
+        :return: Boolean, False if the block couldn't be moved there
+        """
+        game = block.game
+        board = Board.from_grid(game.grid)
+        preview = game.queue.peek(self.lookahead)
+        x, y = block.anchor
+        best = self.search(board, block.piece, preview, x, y)
+        if best is None:
+            return block.act("drop")
+        score, index, column = best
+        # Moves that collide are reverted, so stop when the block doesn't move anymore
+        while block.rotation != index:
+            rotation = block.rotation
+            block.act("clockwise")
+            if block.rotation == rotation:
+                break
+        while block.anchor[0] != column:
+            x = block.anchor[0]
+            if column < x:
+                block.act("left")
+            else:
+                block.act("right")
+            if block.anchor[0] == x:
+                break
+        return block.act("drop")
+
+# Ready to use autoplayer with the default weights
+bot = Bot()
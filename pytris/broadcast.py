@@ -0,0 +1,366 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Broadcast a game to spectators
+
+Every frame the visible part of the board, with the mobile block in it, is encoded once
+as a list of cell colors and sent to all viewers over a local (unix) socket:
+
+    KEYFRAME    frame info and all 10 x 20 cells, one byte per cell
+    DELTA       frame info and (index, color) of the cells that are different from the last keyframe,
+                a 2 byte index and a byte color per cell
+    frame info  sequence number, score, lines and level
+
+Deltas are relative to the last keyframe, not to the previous frame, so a viewer only needs
+the last keyframe and the last delta to show the game. A viewer that can't keep up doesn't get
+frames until its connection catches up, it then gets the latest keyframe (if it doesn't have it)
+and the latest frame. Viewers that stay behind for longer than the timeout are dropped.
+Keyframes are sent every interval frames, which also bounds the size of the deltas.
+
+Messages use the framing of net (net.pack), the viewers never send anything.
+
+usage: pytris --broadcast PATH      play and broadcast on a unix socket
+       pytris --watch PATH          watch a broadcast
+"""
+
+# Relative imports
+from .net import pack, receive
+from .screen import level_color
+
+# Stdlib
+import asyncio
+import struct
+import threading
+import time
+
+# Message kinds
+KEYFRAME, DELTA = 1, 2
+
+frame_info = struct.Struct("!IIIB")
+# Index and color of a cell in a delta
+delta_cell = struct.Struct("!HB")
+
+def view(game):
+    """
+    Colors of the visible cells, row by row, with the mobile block drawn in
+    :return: bytearray of width * visible rows
+    """
+    grid = game.grid
+    top = grid.top_buffer
+    width = grid.width
+    colors = getattr(grid, "colors", None)
+    if colors is not None:
+        # BitGrid keeps the colors as rows already
+        cells = bytearray().join(colors[top:])
+    else:
+        cells = bytearray(column[y] for y in range(top, grid.height) for column in grid)
+    block = game.block
+    if block.mobile:
+        for x, y in block.position():
+            if y >= top:
+                cells[(y - top) * width + x] = block.color
+    return cells
+
+class Encoder():
+    """
+    Turns the frames of a game into KEYFRAME and DELTA messages
+
+    Contains:
+        interval    : number of frames between keyframes
+        sequence    : number of the last frame
+        keyframe    : cells of the last keyframe
+        key_message : the last keyframe message
+    """
+    def __init__(self, interval = 60):
+        self.interval = interval
+        self.sequence = 0
+        self.keyframe = None
+        self.key_sequence = None
+        self.key_message = None
+
+    def encode(self, game, key = False):
+        """
+        Encode the current frame of a game
+        :param key: force a keyframe
+        :return: (kind, message bytes)
+        """
+        self.sequence += 1
+        cells = view(game)
+        info = frame_info.pack(self.sequence, game.score, game.lines, game.level)
+        if key or self.keyframe is None or len(cells) != len(self.keyframe) or \
+                self.sequence - self.key_sequence >= self.interval:
+            self.keyframe = cells
+            self.key_sequence = self.sequence
+            self.key_message = pack(KEYFRAME, info + cells)
+            return KEYFRAME, self.key_message
+        keyframe = self.keyframe
+        changes = bytearray()
+        pack_cell = delta_cell.pack
+        for i, color in enumerate(cells):
+            if color != keyframe[i]:
+                changes += pack_cell(i, color)
+        return DELTA, pack(DELTA, info + changes)
+
+class Subscriber():
+    """
+    A single viewer
+
+    Contains:
+        writer  : asyncio stream to the viewer
+        key     : sequence of the last keyframe the viewer got
+        behind  : time.monotonic() since when the viewer can't keep up, None when it can
+    """
+    __slots__ = ("writer", "key", "behind")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.key = None
+        self.behind = None
+
+class Broadcaster():
+    """
+    Sends the frames of a game to all viewers, every frame is encoded once
+
+    Contains:
+        rate        : maximum number of frames per second
+        limit       : bytes that may wait for a viewer before it skips frames
+        timeout     : seconds a viewer may skip frames before it is dropped
+        subscribers : set of Subscriber
+        frames      : number of frames published
+        sent        : number of bytes sent to all viewers together
+        skipped     : number of frames that viewers skipped
+        dropped     : number of viewers that were dropped
+    """
+    def __init__(self, rate = 30, interval = 60, limit = 64 * 1024, timeout = 5.0):
+        self.rate = rate
+        self.limit = limit
+        self.timeout = timeout
+        self.encoder = Encoder(interval)
+        self.subscribers = set()
+        self.last = None
+        self.last_time = 0.0
+        self.last_version = None
+        self.frames = 0
+        self.sent = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.loop = None
+        self.server = None
+        # The event loop runs on another thread than the game, see start_thread()
+        self.threaded = False
+
+    async def start(self, path):
+        """
+        Listen on a unix socket
+        """
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_unix_server(self.handle, path, backlog = 1024)
+
+    async def close(self):
+        self.server.close()
+        for subscriber in list(self.subscribers):
+            subscriber.writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        subscriber = Subscriber(writer)
+        self.subscribers.add(subscriber)
+        if self.last is not None:
+            # Start at the latest frame
+            self.send(subscriber, *self.last)
+        try:
+            # Viewers don't send anything, wait until they leave
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            writer.close()
+
+    def send(self, subscriber, message, key):
+        """
+        Send a frame, preceded by its keyframe when the viewer doesn't have it yet
+        :param key: (sequence, message) of the keyframe the frame is relative to
+        """
+        writer = subscriber.writer
+        key_sequence, key_message = key
+        if subscriber.key != key_sequence:
+            subscriber.key = key_sequence
+            if message is not key_message:
+                writer.write(key_message)
+                self.sent += len(key_message)
+        writer.write(message)
+        self.sent += len(message)
+
+    def publish(self, message, key):
+        """
+        Send an encoded frame to all viewers, skipping the ones that are behind
+        :param key: (sequence, message) of the keyframe the frame is relative to
+        """
+        self.last = (message, key)
+        self.frames += 1
+        now = time.monotonic()
+        for subscriber in list(self.subscribers):
+            writer = subscriber.writer
+            if writer.transport.get_write_buffer_size() >= self.limit:
+                if subscriber.behind is None:
+                    subscriber.behind = now
+                elif now - subscriber.behind > self.timeout:
+                    self.dropped += 1
+                    self.subscribers.discard(subscriber)
+                    writer.close()
+                self.skipped += 1
+                continue
+            subscriber.behind = None
+            self.send(subscriber, message, key)
+
+    def frame(self, game, force = False):
+        """
+        Encode and publish the current frame of a game, at most rate times per second
+        and only when something changed. Can be called from another thread than the event loop.
+        """
+        now = time.monotonic()
+        if not force and now - self.last_time < 1 / self.rate:
+            return
+        block = game.block
+        version = (game.grid.version, block.anchor, block.rotation, block.mobile, game.score)
+        if version == self.last_version and not force:
+            return
+        self.last_time = now
+        self.last_version = version
+        encoder = self.encoder
+        kind, message = encoder.encode(game)
+        # The next frame may be encoded before the event loop publishes this one,
+        # so the keyframe goes along with it
+        key = (encoder.key_sequence, encoder.key_message)
+        if self.threaded:
+            self.loop.call_soon_threadsafe(self.publish, message, key)
+        else:
+            self.publish(message, key)
+
+    def start_thread(self, path):
+        """
+        Run the event loop on a background thread
+        :return: self, once it is listening
+        """
+        ready = threading.Event()
+        async def run():
+            await self.start(path)
+            ready.set()
+            await asyncio.Event().wait()
+        self.threaded = True
+        threading.Thread(target = asyncio.run, args = (run(),), daemon = True).start()
+        ready.wait()
+        return self
+
+class Viewer():
+    """
+    Receives a broadcast
+
+    Contains:
+        cells   : colors of the visible cells, row by row
+        score, lines, level, sequence : of the last frame
+        frames  : number of frames received
+        bytes   : number of bytes received
+    """
+    def __init__(self):
+        self.keyframe = None
+        self.cells = None
+        self.score = self.lines = self.sequence = 0
+        self.level = 1
+        self.frames = 0
+        self.bytes = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, path):
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+
+    def apply(self, kind, payload):
+        """
+        Update the state with a frame
+        """
+        self.sequence, self.score, self.lines, self.level = frame_info.unpack_from(payload)
+        data = payload[frame_info.size:]
+        if kind == KEYFRAME:
+            self.keyframe = bytes(data)
+            self.cells = bytearray(data)
+        elif self.keyframe is not None:
+            self.cells = bytearray(self.keyframe)
+            for i, color in delta_cell.iter_unpack(data):
+                self.cells[i] = color
+        self.frames += 1
+        self.bytes += len(payload) + 3
+
+    async def run(self, callback = None):
+        """
+        Receive frames until the broadcast ends
+        :param callback: called after every frame
+        """
+        try:
+            while True:
+                self.apply(*await receive(self.reader))
+                if callback:
+                    callback(self)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+
+def watch(screen, path):
+    """
+    Show a broadcast in a curses window
+    """
+    import curses
+    curses.use_default_colors()
+    for i in range(8):
+        curses.init_pair(i, -1, i)
+    curses.curs_set(0)
+    screen.addstr(0, 0, "+" + "-" * 10 + "+")
+    for y in range(1, 21):
+        screen.addstr(y, 0, "|" + " " * 10 + "|")
+    screen.addstr(21, 0, "+" + "-" * 10 + "+")
+    def draw(viewer):
+        if viewer.cells is None:
+            return
+        for y in range(20):
+            for x in range(10):
+                color = level_color(viewer.cells[y * 10 + x], viewer.level)
+                screen.addstr(y + 1, x + 1, " ", curses.color_pair(color))
+        screen.addstr(1, 13, f"SCORE: {viewer.score}")
+        screen.addstr(2, 13, f"LEVEL: {viewer.level}")
+        screen.addstr(3, 13, f"LINES: {viewer.lines}")
+        screen.refresh()
+    async def run():
+        viewer = Viewer()
+        try:
+            await viewer.connect(path)
+        except OSError:
+            return False
+        await viewer.run(draw)
+        return True
+    screen.addstr(5, 13, "Broadcast ended" if asyncio.run(run()) else f"No broadcast on {path}")
+    screen.refresh()
+    time.sleep(2)
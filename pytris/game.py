@@ -21,39 +21,186 @@
 #SOFTWARE.
 
 # Relative imports
+from .block import Block
 from .grid import Grid 
-from .screen import Screen
+from .scores import Leaderboard, LeaderboardError
+from .screen import Screen, read_bindings
 from .queue import Queue
+from .replay import Recorder, replay
 
 # Stdlib
+# Keep these cheap to import, pytris should start fast
 import argparse
 import curses
+import os
+import random
+import sys
 import time
-from pathlib import Path
-import getpass
 
-def main(screen = None, keytest = False):
+# Home directory of the user, for the leaderboard and the config file
+home = os.path.expanduser("~")
+
+def main(screen = None, keytest = False, record = None, replay_log = None, speed = 1, overlay = False,
+         bindings = None, audio = False, stats = None, bot = False, host = None, join = None, players = 2,
+         broadcast = None, watch = None, save = None, resume = None):
+    game = None
+    player = None
+    profiler = None
+    link = None
     try:
-        game = Game(screen = screen)
+        if watch:
+            from .broadcast import watch as watch_broadcast
+            watch_broadcast(screen, watch)
+            return
+        if replay_log:
+            game, score = replay(replay_log, screen = screen, speed = speed)
+            game.screen.print(f"Replay done, score {game.score}/{score}")
+            game.screen.flush()
+            time.sleep(3)
+            return
+        seed = None
+        if host or join:
+            # Only now the network code is loaded
+            from . import net
+            import getpass
+            if host:
+                net.host(players, host)
+                join = f"localhost:{host}"
+            if screen:
+                screen.addstr(0, 0, f"Waiting for {players if host else 'all'} players on {join}...")
+                screen.refresh()
+            address, _, port = join.partition(":")
+            link = net.Link(getpass.getuser()).start(address, int(port or net.port))
+            seed = link.seed
+            if screen:
+                screen.clear()
+        policy = None
+        if bot:
+            # Only now the search of the autoplayer is loaded
+            from .bot import bot as policy
+        if resume and os.path.exists(resume):
+            from . import snapshot
+            game = snapshot.resume(resume, screen = screen, overlay = overlay, bindings = bindings,
+                                   debug = bot, policy = policy)
+        else:
+            game = Game(screen = screen, overlay = overlay, bindings = bindings,
+                        debug = bot, policy = policy, seed = seed)
+        game.net = link
+        if broadcast:
+            from .broadcast import Broadcaster
+            game.broadcast = Broadcaster().start_thread(broadcast)
+        if audio:
+            # Only now the song is loaded (and rendered the first time)
+            from .mixer import Mixer, sink
+            try:
+                player = game.audio = Mixer(sink()).start(game.level)
+            except ImportError:
+                # Neither sounddevice nor simpleaudio is installed, play without sound
+                if game.screen:
+                    game.screen.print("No sound!")
+        if stats:
+            from .stats import Profiler
+            profiler = Profiler(game).install()
+        if record:
+            game.recorder = Recorder(record, game.seed)
         if keytest:
             game.screen.keytest()
         else:
             game.start()
     except KeyboardInterrupt:
         exit()
+    finally:
+        if player:
+            player.stop()
+        if profiler:
+            profiler.dump(stats)
+        if link:
+            link.close()
+        # Save an unfinished game to continue it later
+        if save and game is not None and not game.gameover and game.pieces:
+            from . import snapshot
+            snapshot.save(game, save)
+        # Also save the input log when the game is exited early
+        if game is not None and game.recorder:
+            game.recorder.close(game.score)
 
-def parse_args():
+def parse_args(args = None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--audio', '-a', action='store_true', default=False)
     parser.add_argument('--debug', '-d', action='store_true', default=True)
     parser.add_argument('--keytest', '-t', action='store_true', default=False)
-    return parser.parse_args()
+    parser.add_argument('--record', '-r', metavar='FILE', default=None,
+                        help='record an input log of the game')
+    parser.add_argument('--replay', metavar='FILE', default=None,
+                        help='replay an input log')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='speed factor of a replay')
+    parser.add_argument('--headless', action='store_true', default=False,
+                        help='replay at maximum speed without a screen and verify the score')
+    parser.add_argument('--overlay', '-o', action='store_true', default=False,
+                        help='show the input to screen latency')
+    parser.add_argument('--config', '-c', metavar='FILE', default=f"{home}/.pytris.cfg",
+                        help='key bindings, see screen.read_bindings')
+    parser.add_argument('--bot', '-b', action='store_true', default=False,
+                        help='let the autoplayer play at full speed')
+    parser.add_argument('--host', metavar='PORT', type=int, nargs='?', const=7210, default=None,
+                        help='host a versus game over the LAN and play in it (default port 7210)')
+    parser.add_argument('--join', metavar='HOST[:PORT]', default=None,
+                        help='join a versus game over the LAN')
+    parser.add_argument('--players', type=int, default=2,
+                        help='number of players of a hosted versus game')
+    parser.add_argument('--broadcast', metavar='PATH', default=None,
+                        help='let spectators watch the game on a unix socket')
+    parser.add_argument('--watch', metavar='PATH', default=None,
+                        help='watch a broadcast game')
+    parser.add_argument('--save', metavar='FILE', default=None,
+                        help='save the game when it is quit before it is over')
+    parser.add_argument('--resume', metavar='FILE', default=None,
+                        help='continue a saved game, a new game when the file does not exist')
+    parser.add_argument('--stats', '-s', metavar='FILE', nargs='?', const='pytris-stats.json', default=None,
+                        help='show frame statistics and write a JSON summary at exit (default pytris-stats.json)')
+    args = parser.parse_args(args)
+    if args.headless and not args.replay:
+        parser.error("--headless only works with --replay")
+    return args
 
 def wrap():
     args = parse_args()
-    kwargs = {}
+    if args.replay and args.headless:
+        game, score = replay(args.replay)
+        print(f"score    : {game.score}")
+        print(f"recorded : {score}")
+        print("verified" if game.score == score else "MISMATCH")
+        sys.exit(0 if game.score == score else 1)
+    kwargs = {'bindings': read_bindings(args.config)}
+    if args.audio:
+        kwargs['audio'] = True
+    if args.stats:
+        kwargs['stats'] = args.stats
+    if args.bot:
+        kwargs['bot'] = True
+    if args.host:
+        kwargs['host'] = args.host
+        kwargs['players'] = args.players
+    if args.join:
+        kwargs['join'] = args.join
+    if args.broadcast:
+        kwargs['broadcast'] = args.broadcast
+    if args.watch:
+        kwargs['watch'] = args.watch
+    if args.save:
+        kwargs['save'] = args.save
+    if args.resume:
+        kwargs['resume'] = args.resume
     if args.keytest:
         kwargs['keytest'] = True
+    if args.record:
+        kwargs['record'] = args.record
+    if args.overlay:
+        kwargs['overlay'] = True
+    if args.replay:
+        kwargs['replay_log'] = args.replay
+        kwargs['speed'] = args.speed
     curses.wrapper(main, **kwargs)
 
 class Game():
@@ -64,21 +211,48 @@ class Game():
     Contains:
         grid    : grid of immobile blocks
         block   : mobile block object
-        p_audio : audio process
+        audio   : mixer.Mixer playing the music and sound effects, or None
+        net     : net.Client of a versus game over the LAN, or None
+        broadcast: broadcast.Broadcaster that sends the game to spectators, or None
         queue   : queue of next blocks
         screen  : abstraction to curses
+        recorder: optional replay.Recorder that logs every action
+        leaderboard: scores.Leaderboard of all finished games
     """
-    def __init__(self, debug = False, screen = None):
+    def __init__(self, debug = False, screen = None, engine = Grid, history = 0, headless = False, seed = None,
+                 overlay = False, bindings = None, policy = None):
         """ 
         Initialize game state
+            debug   : play with random moves at maximum speed
+            screen  : curses window to draw on
+            engine  : grid class that stores the immobile blocks (Grid or BitGrid)
+            history : number of poses every block keeps for replays and debugging
+            headless: don't create a Screen at all, the game can only be played with run()
+            seed    : seed for the block queue and random moves, a random seed when None
+            overlay : show the input to screen latency on the side panel
+            bindings: dict of key -> action, the default Screen.actions when None
+            policy  : function that moves the block in debug mode, Block.random_move when None
+                      (e.g. bot.bot, the autoplayer)
 
         """
         # Move arguments to attributes
         self.debug = debug
+        self.policy = policy or Block.random_move
+        self.history = history
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), "little")
+        self.seed = seed
+        self.random = random.Random(seed)
 
         # Initialize some values
         self.gameover = False
         self.score = 0
+        self.lines = 0
+        self.pieces = 0
+        self.username = "Nobody"
+        self.highscore = 0
+        # Name on the leaderboard, the login name when None
+        self.player = None
         if self.debug:
             # When debugging just put maximum speed
             self.speed = 0.0
@@ -89,12 +263,20 @@ class Game():
         self.level = 1
         self.t = 0
         self.paused = False
+        self.recorder = None
+        self.audio = None
+        self.net = None
+        self.broadcast = None
+        self.started = None
+        self.leaderboard = Leaderboard(f"{home}/.pytris.db", legacy = f"{home}/.pytris_highscore")
 
         # Initialize screen
-        self.screen = Screen(self, screen)
+        self.screen = None
+        if not headless:
+            self.screen = Screen(self, screen, overlay = overlay, bindings = bindings)
 
         # Initialize grid
-        self.grid = Grid(self)
+        self.grid = engine(self)
 
         # Initialize block queue
         self.queue = Queue(self)
@@ -102,65 +284,192 @@ class Game():
         # Pop the first block
         self.block = self.queue.pop()
 
-        self.read_highscore()
-        self.screen.data()
+        if self.screen:
+            self.screen.data()
+
+    def clone(self):
+        """
+        Copy of the state of the game (see snapshot), for searching or trying moves
+        The copy has no screen, recorder, audio, network or broadcast.
+        Like a loaded snapshot it draws its random moves from the seed and the number of pieces,
+        copying the state of the generator would cost more than the rest of the game.
+        :return: Game
+        """
+        game = Game.__new__(Game)
+        # Field by field, methods replaced on the instance (stats.Profiler) stay bound to this game
+        game.debug = self.debug
+        game.policy = self.policy
+        game.history = self.history
+        game.seed = self.seed
+        game.gameover = self.gameover
+        game.score = self.score
+        game.lines = self.lines
+        game.pieces = self.pieces
+        game.username = self.username
+        game.highscore = self.highscore
+        game.player = self.player
+        game.speed = self.speed
+        game.factor = self.factor
+        game.level = self.level
+        game.t = self.t
+        game.paused = self.paused
+        game.started = self.started
+        game.leaderboard = self.leaderboard
+        game.screen = game.recorder = game.audio = game.net = game.broadcast = None
+        game.random = random.Random((self.seed << 32) | self.pieces)
+        game.grid = self.grid.clone(game)
+        game.queue = self.queue.clone(game)
+        game.block = self.block.clone(game)
+        return game
 
     def read_highscore(self):
+        """
+        Show the best game of the leaderboard on the side panel
+        The leaderboard caches it, so this only reads the database after a game was added
+        """
         try:
-            with open(f"{Path.home()}/.pytris_highscore") as f_high:
-                self.username = str(f_high.readline().strip())
-                self.highscore = int(f_high.readline().strip())
-        except:
-            self.username = "Nobody"
-            self.highscore = 0
+            best = self.leaderboard.best()
+        except LeaderboardError:
+            best = None
+        self.show_highscore(best)
+
+    def show_highscore(self, best):
+        """
+        Show a scores.Entry of the leaderboard on the side panel, nothing changes when it's None
+        """
+        if best is not None:
+            self.username = best.user
+            self.highscore = best.score
+        if self.screen:
+            self.screen.data()
+
+    def save_score(self):
+        """
+        Add the finished game to the leaderboard, without touching the screen
+        Games played in debug mode (random moves or the autoplayer) are not recorded
+        :return: Boolean, whether the game was recorded
+        """
+        if self.debug:
+            return False
+        player = self.player
+        if player is None:
+            import getpass
+            player = getpass.getuser()
+        duration = None if self.started is None else time.monotonic() - self.started
+        self.leaderboard.add(player, self.score, self.lines, self.level,
+                             self.pieces, self.seed, duration)
+        return True
 
     def write_highscore(self):
-        if self.score > self.highscore:
-            self.username = getpass.getuser()
-            try:
-                with open(f"{Path.home()}/.pytris_highscore", 'w') as f_high:
-                    f_high.write(str(self.username + "\n"))
-                    f_high.write(str(self.score))
-            except:
-                pass # Else just fuck it
+        """
+        Add the finished game to the leaderboard and show the new best game
+        """
+        try:
+            if not self.save_score():
+                return
+        except LeaderboardError:
+            if self.screen:
+                self.screen.print("Score not saved!")
+            return
+        self.read_highscore()
 
     def pause(self):
         """
         Toggle pause the game
         """
         self.block.mobile = not self.block.mobile
-        if not self.paused:
-            self.paused = True
+        self.paused = not self.paused
+        if self.screen:
             # Also print paused message
-            self.screen.print("PAUSED")
-        else:
-            self.paused = False
-            self.screen.print("")
+            self.screen.print("PAUSED" if self.paused else "")
         # Also reset tick time
-        self.t = time.time()
+        self.t = time.monotonic()
 
     def add_score(self, score_to_add):
         """
         Adds the score to the current score in game
         """
         self.score += score_to_add
+        self.sound("clear")
         if self.score // self.level >= 20:
             self.level += 1
             self.speed *= self.factor
             # Also redraw all pixels because they now change color
-            self.screen.grid()
-            self.screen.block()
-            self.screen.next()
+            if self.screen:
+                self.screen.level_up()
+            if self.audio:
+                self.audio.level(self.level)
+            self.sound("level")
         # Refresh the data on screen
-        self.screen.data()
+        if self.screen:
+            self.screen.data()
+
+    def sound(self, name):
+        """
+        Play a sound effect (see mixer.effects) if there is audio
+        """
+        if self.audio:
+            self.audio.trigger(name)
+
+    def act(self, action):
+        """
+        Apply an action (see replay.actions) to the game
+        Every action is recorded when there is a recorder,
+        except moves of a block that already landed, they do nothing
+        :return: result of the move
+        """
+        if action != "pause" and not self.block.mobile:
+            # A block that landed doesn't move, a replay already spawned the next one
+            return False
+        if self.recorder:
+            self.recorder.record(action)
+        if action == "pause":
+            return self.pause()
+        if action == "gravity":
+            action = "down"
+        return getattr(self.block, action)()
+
+    def step(self, action):
+        """
+        Apply an action and handle the block landing
+        :return: result of the move
+        """
+        result = self.act(action)
+        if not self.block.mobile and not self.paused:
+            self.land()
+        return result
+
+    def spawn(self):
+        """
+        Pop a new block from the queue
+        """
+        self.block = self.queue.pop()
+        self.pieces += 1
+        if self.screen:
+            self.screen.block()
+
+    def land(self):
+        """
+        After every collision:
+        Check if there is a full row in the grid and spawn the next block
+        """
+        lines = self.lines
+        self.grid.row_is_full()
+        if self.net:
+            self.net.land(self, self.lines - lines)
+        if self.gameover:
+            self.sound("gameover")
+        else:
+            self.sound("lock")
+            self.spawn()
 
     def tick(self):
         """
         Check if a tick has passed
         :return: Bool
         """
-        if time.time() - self.t > self.speed:
-            self.t = time.time()
+        if time.monotonic() - self.t > self.speed:
+            self.t = time.monotonic()
             return True
         else:
             return False
@@ -171,43 +480,85 @@ class Game():
         During a tick, allow the block to be moved by the user
         After each tick, the block is moved downward forcefully.
         If the bottom is hit, a new block is popped from the queue
+
+        Between events the loop sleeps until either a key is pressed
+        or the next tick is due, while paused it only wakes up for keys.
         """
+        if not self.pieces:
+            # A resumed game (see snapshot) continues with its block
+            self.spawn()
+        self.started = time.monotonic()
+        # Read the leaderboard after the first frame, opening it shouldn't delay the start
+        self.screen.flush()
+        self.read_highscore()
         while not self.gameover:
+            events = None
+            if self.debug:
+                # When debugging or testing, DON'T sleep but go asap
+                self.screen.command()
+                self.policy(self.block)
+                if self.tick():
+                    self.act("gravity")
+            else:
+                timeout = None
+                if not self.paused:
+                    timeout = max(0, self.t + self.speed - time.monotonic())
+                if self.screen.wait(timeout):
+                    # Handle all keys that were pressed during a tick
+                    events = self.screen.command()
+                # While paused, the block is not mobile so it isn't moved down
+                if not self.paused and self.tick():
+                    # After a tick passes, move the block down forcefully
+                    self.act("gravity")
 
-            # Pop a new block from queue
-            self.block = self.queue.pop()
-            self.screen.block()
-
-            while self.block.mobile:
-                # Try to get commands turing a tick
-                while not self.tick():
-                    self.screen.command()
-                    # Limit CPU cycles, IMPORTANT
-                    # When debugging or testing, DON'T sleep but go asap
-                    if not self.debug:
-                        time.sleep(0.01)
-                    else:
-                        self.block.random_move()
-
-                # While paused, the block is not mobile so move commands are ignored
-                while self.paused:
-                    self.screen.command()
-                    time.sleep(0.01)
-                    continue # So that the block isn't immediately moved down
-
-                # After a tick passes, move the block down forcefully
-                self.block.down()
-
-            # After every collision:
-            # Check if there is a full row in the grid
-            self.grid.row_is_full()
+            if not self.block.mobile and not self.paused:
+                self.land()
+            if self.net:
+                self.net.frame(self)
+            # Draw everything that changed during this frame at once
+            self.screen.flush()
+            if events:
+                # Latency of the oldest key press in this frame, the overlay shows it next frame
+                self.screen.latency(time.perf_counter() - events[0][0])
+            if self.broadcast:
+                self.broadcast.frame(self)
 
         # Game is now over
-        self.screen.print("Game over!")
+        if self.net:
+            self.net.lose()
+        self.screen.print(self.net.result() if self.net else "Game over!")
         self.write_highscore()
-        time.sleep(3)
+        self.screen.flush()
+        if self.broadcast:
+            self.broadcast.frame(self, force = True)
+        if not self.debug:
+            time.sleep(3)
 
         # There is not yet an endgame screen
         self.screen.endgame()
 
+    def run(self, policy = None, max_pieces = None):
+        """
+        Play the game without a screen, timing or user input
+        Every frame the policy gets to move the block,
+        after which the block is moved downward forcefully.
+        :param policy: function that is called with the mobile block, the policy of the game when None
+        :param max_pieces: stop after this many pieces, even if the game isn't over
+        :return: None
+        """
+        if policy is None:
+            policy = self.policy
+        if not self.pieces:
+            # The block popped in __init__ is the first piece
+            self.pieces = 1
+        # Start from the current block, it can come from a snapshot or a clone
+        while not self.gameover:
+            while self.block.mobile:
+                policy(self.block)
+                self.block.down()
 
+            # Check if there is a full row in the grid
+            self.grid.row_is_full()
+            if self.gameover or max_pieces is not None and self.pieces >= max_pieces:
+                break
+            self.spawn()
@@ -20,6 +20,93 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
+# Stdlib
+import random
+
+class Zobrist():
+    """
+    Zobrist hashing of grids
+    Every cell has a random 64 bit key, the hash of a grid is the XOR of the keys
+    of its occupied cells. Setting or clearing a cell is a single XOR.
+
+    For whole rows the keys are combined per chunk of 5 bits of the row mask,
+    so hashing a row is a few table lookups.
+
+    The tables are built the first time they are used, games that never hash
+    a grid (or start and only hash later) don't pay for them.
+    """
+    chunk = 5
+
+    def __init__(self, width, height, seed = 0x7e7215):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self._cells = None
+        self._chunks = None
+
+    def build(self):
+        rng = random.Random(self.seed)
+        cells = [[rng.getrandbits(64) for x in range(self.width)] for y in range(self.height)]
+        chunks = []
+        for keys in cells:
+            tables = []
+            for start in range(0, self.width, self.chunk):
+                table = []
+                for mask in range(1 << self.chunk):
+                    key = 0
+                    for bit, x in enumerate(range(start, min(start + self.chunk, self.width))):
+                        if mask >> bit & 1:
+                            key ^= keys[x]
+                    table.append(key)
+                tables.append(table)
+            chunks.append(tables)
+        self._chunks = chunks
+        self._cells = cells
+
+    @property
+    def cells(self):
+        """
+        Key of every cell as cells[y][x]
+        """
+        if self._cells is None:
+            self.build()
+        return self._cells
+
+    @property
+    def chunks(self):
+        """
+        Keys of the chunks of every row as chunks[y][chunk][mask]
+        """
+        if self._chunks is None:
+            self.build()
+        return self._chunks
+
+    def row(self, y, mask):
+        """
+        :return: hash of row y with the cells in mask occupied
+        """
+        key = 0
+        for table in self.chunks[y]:
+            key ^= table[mask & 31]
+            mask >>= 5
+        return key
+
+    def rows(self, rows):
+        """
+        :return: hash of a grid given as row masks (see BitGrid.rows)
+        """
+        key = 0
+        chunks = self.chunks
+        for y, mask in enumerate(rows):
+            if mask:
+                for table in chunks[y]:
+                    key ^= table[mask & 31]
+                    mask >>= 5
+        return key
+
+# Keys for the grid size of the game
+zobrist = Zobrist(10, 40)
+
 class Grid(list):
     """
     Grid now keeps track of the underlying grid of immobile blocks
@@ -34,6 +121,12 @@ class Grid(list):
         # Doing it in this way so that the grid is accessed as grid[x][y]
         for col in range(self.width):
             self.append([0 for row in range(self.height)])
+        # Highest occupied y per column, the height when the column is empty
+        self.skyline = [self.height] * self.width
+        # Changes every time the grid changes, to invalidate caches
+        self.version = 0
+        # Zobrist hash of the occupied cells, None until it is needed (see hash)
+        self._hash = None
 
     def row_is_full(self):
         """
@@ -71,13 +164,436 @@ class Grid(list):
                     # Insert a new row at the top
                     self[j].insert(0, 0)
         if full > 0:
+            self.update_skyline()
+            self.game.lines += full
             self.game.add_score(full)
             # Refresh the grid on the screen
+            if self.game.screen:
+                self.game.screen.grid()
+
+    def garbage(self, lines, hole, color = 7):
+        """
+        Push rows that are full except for one hole in at the bottom, sent by an opponent (see net)
+        All rows move up, the top ones are lost
+        :return: Boolean, True if occupied cells were pushed out at the top
+        """
+        overflow = any(self[x][y] for x in range(self.width) for y in range(lines))
+        for x, column in enumerate(self):
+            del column[:lines]
+            column.extend([0 if x == hole else color] * lines)
+        self.update_skyline()
+        if self.game.screen:
             self.game.screen.grid()
+        return overflow
 
     def set(self, value, iterable):
         """
         Set a value to a list of grid coordinates
         """
+        skyline = self.skyline
+        if self._hash is not None:
+            # Only the cells that change from empty to occupied or back change the hash
+            iterable = list(iterable)
+            keys = zobrist.cells
+            for x, y in iterable:
+                if bool(self[x][y]) != bool(value):
+                    self._hash ^= keys[y][x]
         for x, y in iterable:
             self[x][y] = value
+            if value:
+                if y < skyline[x]:
+                    skyline[x] = y
+            elif y == skyline[x]:
+                skyline[x] = self.column_top(x)
+        self.version += 1
+
+    def clone(self, game):
+        """
+        Copy of the grid for another game
+        :return: Grid
+        """
+        grid = Grid.__new__(Grid)
+        # Field by field, methods replaced on the instance (stats.Profiler) stay bound to this grid
+        grid.game = game
+        grid.gridsize = self.gridsize
+        grid.top_buffer = self.top_buffer
+        grid.width, grid.height = self.width, self.height
+        grid.extend(column[:] for column in self)
+        grid.skyline = self.skyline[:]
+        grid.version = self.version
+        grid._hash = self._hash
+        return grid
+
+    def dump(self, top = 0):
+        """
+        Colors of the rows from top down to the bottom, row by row
+        :return: bytes of width * (height - top)
+        """
+        return bytes(column[y] for y in range(top, self.height) for column in self)
+
+    def load(self, cells):
+        """
+        Replace the grid by the colors of the bottom rows, as returned by dump()
+        The rows above them are cleared
+        """
+        top = self.height - len(cells) // self.width
+        for x, column in enumerate(self):
+            column[:top] = [0] * top
+            column[top:] = cells[x::self.width]
+        self.update_skyline()
+
+    def masks(self):
+        """
+        :return: the grid as row masks, like BitGrid.rows
+        """
+        rows = [0] * self.height
+        for x, column in enumerate(self):
+            for y, value in enumerate(column):
+                if value:
+                    rows[y] |= 1 << x
+        return rows
+
+    def column_top(self, x):
+        """
+        :return: highest occupied y in column x, the height when it is empty
+        """
+        for y, value in enumerate(self[x]):
+            if value:
+                return y
+        return self.height
+
+    def update_skyline(self):
+        """
+        Recompute the skyline, needed after writing to grid[x][y] directly
+        All rows can have moved, so the hash is computed again when it is needed
+        """
+        self.skyline = [self.column_top(x) for x in range(self.width)]
+        self._hash = None
+        self.version += 1
+
+    @property
+    def hash(self):
+        """
+        Zobrist hash of the occupied cells (see Zobrist)
+        It is computed from the rows the first time it is asked for, from then on set() keeps
+        it up to date. After lines are cleared or rows are pushed in it is computed again.
+        """
+        if self._hash is None:
+            self._hash = zobrist.rows(self.masks())
+        return self._hash
+
+    def landing(self, x, y, rotation):
+        """
+        Find the y a compiled rotation anchored at (x, y) lands on when it drops straight down
+        When all its columns are above the skyline, it is computed from the skyline directly,
+        otherwise (below an overhang) the block is moved down one row at a time.
+        :return: anchor y of the landing position
+        """
+        skyline = self.skyline
+        land = self.height
+        for dx, bottom in rotation.bottoms:
+            top = skyline[x + dx]
+            if y + bottom >= top:
+                break
+            if top - 1 - bottom < land:
+                land = top - 1 - bottom
+        else:
+            return land
+        while not self.collision_at(x, y + 1, rotation):
+            y += 1
+        return y
+
+    def collision(self, iterable):
+        """
+        Check if any of the coordinates is outside of the grid
+        or intersects with an immobile block
+        :return: Boolean
+        """
+        for x, y in iterable:
+            if not 0 <= x < self.width:
+                return True
+            if not 0 <= y < self.height:
+                return True
+            if self[x][y] != 0:
+                return True
+        return False
+
+    def collision_at(self, x, y, rotation):
+        """
+        Check if a compiled rotation (see block.Rotation) anchored
+        at (x, y) is outside of the grid or intersects with an immobile block
+        :return: Boolean
+        """
+        left, top, right, bottom = rotation.bbox
+        if x + left < 0 or x + right >= self.width:
+            return True
+        if y + top < 0 or y + bottom >= self.height:
+            return True
+        for dx, dy in rotation.cells:
+            if self[x + dx][y + dy] != 0:
+                return True
+        return False
+
+# Translate colors to 1 for occupied cells, see BitGrid.load
+occupied = bytes([0] + [1] * 255)
+# Row mask of every row of occupied cells that was loaded, there are at most 2 ** width
+row_masks = {}
+
+class Column():
+    """
+    View on a single column of a BitGrid
+    Makes the bitboard readable (and writable) as grid[x][y]
+    """
+    __slots__ = ("grid", "x")
+
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.x = x
+
+    def __len__(self):
+        return self.grid.height
+
+    def __getitem__(self, y):
+        return self.grid.colors[y][self.x]
+
+    def __setitem__(self, y, value):
+        self.grid.set(value, [(self.x, y)])
+
+    def __iter__(self):
+        x = self.x
+        for colors in self.grid.colors:
+            yield colors[x]
+
+class BitGrid():
+    """
+    Alternative grid engine that stores the immobile blocks as bitboards
+    Every row is a single integer where bit x is set when column x is occupied,
+    the colors are kept in a parallel plane that is only used for drawing.
+
+    Collisions are bitwise ANDs and clearing lines is a slice shift,
+    the grid[x][y] read API of Grid is kept through Column views.
+
+         columns x
+         0 1 2 3 4 5 ...
+    rows[y] = 0b...000011  <- bit x set if grid[x][y] != 0
+    colors[y] = bytearray([color of x = 0, color of x = 1, ...])
+    """
+
+    def __init__(self, game):
+        # Initialize grid
+        self.game = game
+        self.gridsize = (10, 40)
+        self.top_buffer = 20 # Following tetris guidlines
+        self.width, self.height = self.gridsize
+        # Mask of a row that is completely filled
+        self.full = (1 << self.width) - 1
+        self.rows = [0] * self.height
+        self.colors = [bytearray(self.width) for row in range(self.height)]
+        self.columns = [Column(self, x) for x in range(self.width)]
+        # Highest occupied y per column, the height when the column is empty
+        self.skyline = [self.height] * self.width
+        # Changes every time the grid changes, to invalidate caches
+        self.version = 0
+        # Zobrist hash of the occupied cells, None until it is needed (see hash)
+        self._hash = None
+
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, x):
+        return self.columns[x]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def row_is_full(self):
+        """
+        Checks if a row is full (equal to the full mask)
+        If so, drop the row and shift all rows above it down by
+        prepending empty rows
+        Also redraw the grid to the screen
+        :return: None
+        """
+        full = self.rows.count(self.full)
+        if full > 0:
+            keep = [y for y, row in enumerate(self.rows) if row != self.full]
+            self.rows[:] = [0] * full + [self.rows[y] for y in keep]
+            self.colors[:] = [bytearray(self.width) for row in range(full)] + \
+                             [self.colors[y] for y in keep]
+            self.update_skyline()
+            self.game.lines += full
+            self.game.add_score(full)
+            # Refresh the grid on the screen
+            if self.game.screen:
+                self.game.screen.grid()
+
+    def garbage(self, lines, hole, color = 7):
+        """
+        Push rows that are full except for one hole in at the bottom, sent by an opponent (see net)
+        All rows move up, the top ones are lost
+        :return: Boolean, True if occupied cells were pushed out at the top
+        """
+        overflow = any(self.rows[:lines])
+        colors = bytearray([color] * self.width)
+        colors[hole] = 0
+        self.rows[:] = self.rows[lines:] + [self.full & ~(1 << hole)] * lines
+        self.colors[:] = self.colors[lines:] + [bytearray(colors) for row in range(lines)]
+        self.update_skyline()
+        if self.game.screen:
+            self.game.screen.grid()
+        return overflow
+
+    def set(self, value, iterable):
+        """
+        Set a value to a list of grid coordinates
+        """
+        rows = self.rows
+        colors = self.colors
+        skyline = self.skyline
+        if self._hash is not None:
+            # Only the cells that change from empty to occupied or back change the hash
+            iterable = list(iterable)
+            keys = zobrist.cells
+            for x, y in iterable:
+                if bool(rows[y] >> x & 1) != bool(value):
+                    self._hash ^= keys[y][x]
+        for x, y in iterable:
+            colors[y][x] = value
+            if value:
+                rows[y] |= 1 << x
+                if y < skyline[x]:
+                    skyline[x] = y
+            else:
+                rows[y] &= ~(1 << x)
+                if y == skyline[x]:
+                    skyline[x] = self.column_top(x)
+        self.version += 1
+
+    def column_top(self, x):
+        """
+        :return: highest occupied y in column x, the height when it is empty
+        """
+        bit = 1 << x
+        for y, row in enumerate(self.rows):
+            if row & bit:
+                return y
+        return self.height
+
+    def masks(self):
+        return self.rows
+
+    def clone(self, game):
+        """
+        Copy of the grid for another game
+        :return: BitGrid
+        """
+        grid = BitGrid.__new__(BitGrid)
+        # Field by field, methods replaced on the instance (stats.Profiler) stay bound to this grid
+        grid.game = game
+        grid.gridsize = self.gridsize
+        grid.top_buffer = self.top_buffer
+        grid.width, grid.height = self.width, self.height
+        grid.full = self.full
+        grid.rows = self.rows[:]
+        grid.colors = list(map(bytearray, self.colors))
+        grid.columns = [Column(grid, x) for x in range(self.width)]
+        grid.skyline = self.skyline[:]
+        grid.version = self.version
+        grid._hash = self._hash
+        return grid
+
+    def dump(self, top = 0):
+        """
+        Colors of the rows from top down to the bottom, row by row
+        :return: bytes of width * (height - top)
+        """
+        return b"".join(self.colors[top:])
+
+    def load(self, cells):
+        """
+        Replace the grid by the colors of the bottom rows, as returned by dump()
+        The rows above them are cleared
+        """
+        width = self.width
+        top = self.height - len(cells) // width
+        colors = [bytearray(width) for row in range(top)]
+        rows = [0] * top
+        # A byte per cell, 1 when it is occupied
+        occupancy = bytes(cells).translate(occupied)
+        for start in range(0, len(cells), width):
+            colors.append(bytearray(cells[start:start + width]))
+            key = occupancy[start:start + width]
+            mask = row_masks.get(key)
+            if mask is None:
+                mask = row_masks[key] = sum(1 << x for x, cell in enumerate(key) if cell)
+            rows.append(mask)
+        self.colors[:] = colors
+        self.rows[:] = rows
+        self.update_skyline()
+
+    def update_skyline(self):
+        """
+        Recompute the skyline from the rows, top down,
+        every column is settled by the first row that has its bit set
+        The hash is computed again when it is needed, see Grid.hash
+        """
+        skyline = [self.height] * self.width
+        remaining = self.full
+        for y, row in enumerate(self.rows):
+            new = row & remaining
+            while new:
+                low = new & -new
+                skyline[low.bit_length() - 1] = y
+                new ^= low
+            remaining &= ~row
+            if not remaining:
+                break
+        self.skyline = skyline
+        self._hash = None
+        self.version += 1
+
+    hash = Grid.hash
+
+    # The solver only needs the skyline and collision_at
+    landing = Grid.landing
+
+    def collision(self, iterable):
+        """
+        Check if any of the coordinates is outside of the grid
+        or intersects with an immobile block
+        :return: Boolean
+        """
+        rows = self.rows
+        for x, y in iterable:
+            if not 0 <= x < self.width:
+                return True
+            if not 0 <= y < self.height:
+                return True
+            if rows[y] & (1 << x):
+                return True
+        return False
+
+    def collision_at(self, x, y, rotation):
+        """
+        Check if a compiled rotation (see block.Rotation) anchored
+        at (x, y) is outside of the grid or intersects with an immobile block
+        Only needs one AND per row of the block
+        :return: Boolean
+        """
+        left, top, right, bottom = rotation.bbox
+        if x + left < 0 or x + right >= self.width:
+            return True
+        if y + top < 0 or y + bottom >= self.height:
+            return True
+        rows = self.rows
+        shift = x + left
+        for dy, mask in rotation.rows:
+            if rows[y + dy] & (mask << shift):
+                return True
+        return False
+
+# Available grid engines
+engines = {
+    "list": Grid,
+    "bit": BitGrid
+}
@@ -0,0 +1,388 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Real time audio mixer for the music and sound effects
+
+The mixer thread mixes fixed size blocks of samples into a ring buffer,
+ahead of a sink that pulls blocks out of it to play them.
+If the sink finds the ring buffer empty, it plays silence and counts an underrun.
+
+Sound effects are rendered once when the mixer is created.
+The game triggers them with trigger(), which only appends to a deque and wakes the mixer,
+so it never waits on the audio threads. The start of an effect is mixed into the samples
+that are already in the ring buffer, from the read cursor on, so it plays with the next
+block the sink takes instead of after the whole ring buffer.
+"""
+
+# Stdlib
+import threading
+import time
+import wave
+from collections import deque
+
+import numpy as np
+
+from . import audio
+
+"""
+Sound effects, every effect is a list of frequencies and a list of durations in seconds
+"""
+effects = {
+    "lock": ([220], [0.04]),
+    "clear": ([523, 659, 784], [0.05, 0.05, 0.08]),
+    "level": ([523, 659, 784, 1047], [0.08, 0.08, 0.08, 0.16]),
+    "gameover": ([392, 330, 262, 196], [0.15, 0.15, 0.15, 0.3]),
+}
+
+class Ring():
+    """
+    Ring buffer of int16 samples for a single writer and a single reader
+    head and tail count all samples ever read and written,
+    each is only changed by one side. The writer can also mix into the samples
+    that weren't read yet (see mix), only that and reading take the lock.
+    """
+    def __init__(self, size):
+        self.data = np.zeros(size, dtype = np.int16)
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def free(self):
+        return self.size - len(self)
+
+    def write(self, block):
+        """
+        :return: False if the block doesn't fit
+        """
+        n = len(block)
+        if n > self.free():
+            return False
+        i = self.tail % self.size
+        first = min(n, self.size - i)
+        self.data[i:i + first] = block[:first]
+        self.data[:n - first] = block[first:]
+        self.tail += n
+        return True
+
+    def read(self, n):
+        """
+        :return: n samples, or None if there are not enough
+        """
+        with self.lock:
+            if len(self) < n:
+                return None
+            i = self.head % self.size
+            first = min(n, self.size - i)
+            block = np.concatenate((self.data[i:i + first], self.data[:n - first]))
+            self.head += n
+            return block
+
+    def mix(self, samples):
+        """
+        Add samples to the samples that weren't read yet, from the read cursor on
+        Only the writer may call this
+        :return: number of samples that were mixed in
+        """
+        with self.lock:
+            n = min(len(samples), len(self))
+            i = self.head % self.size
+            first = min(n, self.size - i)
+            for start, offset, count in ((i, 0, first), (0, first, n - first)):
+                region = self.data[start:start + count]
+                mixed = region.astype(np.int32) + samples[offset:offset + count]
+                region[:] = np.clip(mixed, -32768, 32767)
+            return n
+
+class NullSink():
+    """
+    Discards all samples, optionally taking as long as playing them would
+    """
+    def __init__(self, rate = audio.sample_rate, realtime = False):
+        self.rate = rate
+        self.realtime = realtime
+        self.samples = 0
+
+    def write(self, block):
+        self.samples += len(block)
+        if self.realtime:
+            time.sleep(len(block) / self.rate)
+
+    def close(self):
+        pass
+
+class WavSink():
+    """
+    Writes all samples to a WAV file
+    """
+    def __init__(self, path, rate = audio.sample_rate):
+        self.rate = rate
+        self.wav = wave.open(str(path), "wb")
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(rate)
+
+    def write(self, block):
+        self.wav.writeframes(block.tobytes())
+
+    def close(self):
+        self.wav.close()
+
+class StreamSink():
+    """
+    Plays blocks on a single output stream of sounddevice (PortAudio)
+    write() only waits while the buffer of the stream is full,
+    the stream keeps playing in between so there are no gaps between blocks.
+    """
+    def __init__(self, rate = audio.sample_rate, block = 4096):
+        import sounddevice
+        self.rate = rate
+        self.stream = sounddevice.RawOutputStream(samplerate = rate, channels = 1, dtype = "int16",
+                                                  blocksize = block, latency = "low")
+        self.stream.start()
+
+    def write(self, block):
+        self.stream.write(block.tobytes())
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+class SimpleaudioSink():
+    """
+    Plays blocks with simpleaudio, one after the other
+    simpleaudio can't stream, so there is a short gap between blocks,
+    blocks should be fairly large (~0.1 s) to hide it. Prefer StreamSink (see sink()).
+    """
+    def __init__(self, rate = audio.sample_rate):
+        import simpleaudio
+        self.simpleaudio = simpleaudio
+        self.rate = rate
+
+    def write(self, block):
+        self.simpleaudio.play_buffer(block, 1, 2, self.rate).wait_done()
+
+    def close(self):
+        self.simpleaudio.stop_all()
+
+def sink(rate = audio.sample_rate, block = 4096):
+    """
+    Best sink that is installed: a StreamSink with sounddevice, a SimpleaudioSink otherwise
+    :return: sink
+    """
+    try:
+        return StreamSink(rate, block)
+    except ImportError:
+        return SimpleaudioSink(rate)
+
+class Mixer():
+    """
+    Mixes the music loop with the sound effects and feeds a sink
+
+    Contains:
+        sink        : where the mixed blocks go (NullSink, WavSink, StreamSink or SimpleaudioSink)
+        ring        : Ring buffer of mixed samples
+        music       : the song at the tempo of the current level, or None
+        voices      : sound effects that are playing as [samples, position]
+        underruns   : number of blocks the sink had to play silence for
+        cost        : seconds spent mixing the last block
+    """
+    def __init__(self, sink, rate = audio.sample_rate, block = 4096, blocks = 4, music = True, directory = None):
+        """
+        Initialize the mixer
+            sink        : object with write(block) and close()
+            rate        : sample rate
+            block       : number of samples per block
+            blocks      : number of blocks the ring buffer holds
+            music       : play the theme song
+            directory   : cache directory of the rendered songs, see audio.load
+        """
+        self.sink = sink
+        self.rate = rate
+        self.block = block
+        self.ring = Ring(block * blocks)
+        self.silence = np.zeros(block, dtype = np.int16)
+        self.sounds = {name: audio.synth(f, d, rate) for name, (f, d) in effects.items()}
+        self.directory = directory
+        self.music = None
+        self.position = 0
+        self.tempo = None
+        self.want_tempo = audio.level_tempo(1) if music else None
+        self.voices = []
+        self.triggers = deque()
+        # Statistics
+        self.blocks = 0
+        self.underruns = 0
+        self.cost = 0.0
+        self.max_cost = 0.0
+        self.total_cost = 0.0
+        self.threads = []
+        self.stopped = threading.Event()
+        self.wake = threading.Event()
+
+    def trigger(self, name):
+        """
+        Play a sound effect, safe to call from the game loop
+        """
+        self.triggers.append(name)
+        self.wake.set()
+
+    def start_voices(self):
+        """
+        Start the triggered sound effects
+        Their start is mixed into the samples that wait in the ring buffer,
+        the rest is mixed into the next blocks
+        """
+        while self.triggers:
+            samples = self.sounds[self.triggers.popleft()]
+            mixed = self.ring.mix(samples)
+            if mixed < len(samples):
+                self.voices.append([samples, mixed])
+
+    def level(self, level):
+        """
+        Switch the music to the tempo of a level
+        The song is loaded by the mixer thread, not by the caller
+        """
+        if self.want_tempo is not None:
+            self.want_tempo = audio.level_tempo(level)
+
+    def update_music(self):
+        if self.want_tempo == self.tempo:
+            return
+        music = audio.load(self.want_tempo, self.rate, self.directory)
+        if self.music is not None:
+            # Continue at the same place in the song
+            self.position = self.position * len(music) // len(self.music)
+        self.music = music
+        self.tempo = self.want_tempo
+
+    def mix(self):
+        """
+        Mix a single block
+        :return: int16 numpy array of block samples
+        """
+        start = time.perf_counter()
+        n = self.block
+        self.update_music()
+        self.start_voices()
+        out = np.zeros(n, dtype = np.int32)
+        if self.music is not None:
+            out += self.music.take(np.arange(self.position, self.position + n), mode = "wrap")
+            self.position = (self.position + n) % len(self.music)
+        for voice in self.voices:
+            samples, position = voice
+            chunk = samples[position:position + n]
+            out[:len(chunk)] += chunk
+            voice[1] += n
+        self.voices = [voice for voice in self.voices if voice[1] < len(voice[0])]
+        block = np.clip(out, -32768, 32767).astype(np.int16)
+        self.cost = time.perf_counter() - start
+        self.max_cost = max(self.max_cost, self.cost)
+        self.total_cost += self.cost
+        self.blocks += 1
+        return block
+
+    def fill(self):
+        """
+        Start triggered effects and mix blocks until the ring buffer is full
+        """
+        self.start_voices()
+        while self.ring.free() >= self.block:
+            self.ring.write(self.mix())
+
+    def pull(self):
+        """
+        Get the next block for the sink
+        :return: a block, silence on an underrun
+        """
+        block = self.ring.read(self.block)
+        if block is None:
+            self.underruns += 1
+            return self.silence
+        return block
+
+    def pump(self, blocks):
+        """
+        Mix and play a number of blocks without threads, for headless use
+        """
+        for _ in range(blocks):
+            self.fill()
+            self.sink.write(self.pull())
+
+    def stats(self):
+        """
+        :return: dict of mixer statistics, costs in seconds
+        """
+        return {
+            "blocks": self.blocks,
+            "underruns": self.underruns,
+            "cost": self.cost,
+            "max_cost": self.max_cost,
+            "mean_cost": self.total_cost / max(self.blocks, 1),
+            "budget": self.block / self.rate,
+        }
+
+    def start(self, level = 1):
+        """
+        Start the mixer and sink threads
+        :return: self
+        """
+        self.level(level)
+        self.stopped.clear()
+        # Don't start with an underrun
+        self.fill()
+        self.threads = [
+            threading.Thread(target = self.run_mixer, daemon = True),
+            threading.Thread(target = self.run_sink, daemon = True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def run_mixer(self):
+        # Check for room about twice per block, or right away when an effect is triggered
+        interval = self.block / self.rate / 2
+        while not self.stopped.is_set():
+            self.fill()
+            self.wake.wait(interval)
+            self.wake.clear()
+
+    def run_sink(self):
+        while not self.stopped.is_set():
+            self.sink.write(self.pull())
+
+    def stop(self):
+        """
+        Stop the threads and close the sink
+        """
+        self.stopped.set()
+        self.wake.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.sink.close()
@@ -0,0 +1,521 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Versus games over the LAN
+
+Every player runs their own Game, the server only relays. Clients send compact
+binary messages, every message is a header (kind, length of the payload) and a payload:
+
+    HELLO   client -> server    name of the player
+    START   server -> client    player id, number of players, seed and the names
+    BOARD   client -> server    time sent, changed rows of the grid as (y, mask)
+            server -> client    the same, prefixed with the id of the player
+    LINES   client -> server    number of lines cleared at once
+    GARBAGE server -> client    number of garbage rows and the place of their hole, in 256ths of
+                                the width of the grid, so the server needn't know the grids
+    LOST    client -> server    the game of the player is over
+            server -> client    id of the player that lost
+    END     server -> client    id of the winner
+
+All players get the same seed, so they play the same blocks. Clearing more than one
+line at once pushes garbage rows (see garbage_lines) at the bottom of an opponent,
+they are added when the next block lands. The boards are sent at most rate times
+per second and only the rows that changed since the last one.
+
+Client is the asyncio side of a connection, used directly by the loopback harness
+(simulate()). Link runs a Client on a background thread for the curses game,
+it wakes up Screen.wait() through a pipe when a message arrives.
+"""
+
+# Relative imports
+from .stats import Histogram
+
+# Stdlib
+from collections import deque, namedtuple
+import asyncio
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+# Message kinds
+HELLO, START, BOARD, LINES, GARBAGE, LOST, END = range(1, 8)
+
+header = struct.Struct("!BH")
+start_info = struct.Struct("!BBQ")
+board_time = struct.Struct("!d")
+row_delta = struct.Struct("!BH")
+garbage_info = struct.Struct("!BB")
+
+# Garbage rows sent per number of lines cleared at once
+garbage_lines = (0, 0, 1, 2, 4)
+
+# Winner id when nobody won
+nobody = 255
+
+port = 7210
+
+def pack(kind, payload = b""):
+    """
+    :return: bytes of a message
+    """
+    return header.pack(kind, len(payload)) + payload
+
+async def receive(reader):
+    """
+    Read a single message
+    :return: (kind, payload)
+    """
+    kind, size = header.unpack(await reader.readexactly(header.size))
+    payload = await reader.readexactly(size) if size else b""
+    return kind, payload
+
+def delta(old, new):
+    """
+    Encode the rows that are different between two lists of row masks
+    :return: bytes
+    """
+    return b"".join(row_delta.pack(y, mask) for y, (a, mask) in enumerate(zip(old, new)) if a != mask)
+
+def apply(rows, data):
+    """
+    Apply rows encoded by delta() to a list of row masks
+    """
+    for y, mask in row_delta.iter_unpack(data):
+        rows[y] = mask
+
+def nodelay(writer):
+    """
+    Send small messages right away instead of waiting to fill a packet
+    """
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+"""
+Player:
+    id      : index of the player, in order of joining
+    name    : name of the player
+    writer  : asyncio stream to the player
+"""
+Player = namedtuple("Player", ["id", "name", "writer"])
+
+class Server():
+    """
+    Relays the messages of a versus game and sends garbage rows
+
+    Contains:
+        players : number of players the game starts with
+        seed    : seed of the games of all players
+        clients : list of Player that joined
+        alive   : set of ids of the players that didn't lose yet
+        winner  : id of the winner when the game is over
+    """
+    def __init__(self, players = 2, seed = None):
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), "little")
+        self.players = players
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.clients = []
+        self.alive = set()
+        self.winner = None
+        # Opponent of every player that gets the next garbage
+        self.targets = {}
+        self.server = None
+        self.port = None
+        self.done = None
+        # Set when the server is listening, for servers on another thread
+        self.ready = threading.Event()
+
+    async def start(self, host = "", port = port):
+        """
+        Start listening, port 0 picks a free port
+        """
+        self.done = asyncio.Event()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+
+    async def serve(self, host = "", port = port):
+        """
+        Listen until the game is over
+        """
+        await self.start(host, port)
+        try:
+            await self.done.wait()
+        finally:
+            await self.close()
+
+    async def close(self):
+        for player in self.clients:
+            player.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def broadcast(self, data, skip = None):
+        """
+        Send the same bytes to every player, except the one with id skip
+        Players that left are skipped as well
+        """
+        for player in self.clients:
+            if player.id != skip and not player.writer.is_closing():
+                player.writer.write(data)
+
+    async def handle(self, reader, writer):
+        """
+        Connection of a single player
+        """
+        nodelay(writer)
+        try:
+            kind, payload = await receive(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        if kind != HELLO or len(self.clients) >= self.players:
+            writer.close()
+            return
+        player = Player(len(self.clients), payload.decode(errors = "replace"), writer)
+        self.clients.append(player)
+        self.alive.add(player.id)
+        if len(self.clients) == self.players:
+            self.begin()
+        try:
+            while True:
+                kind, payload = await receive(reader)
+                self.dispatch(player, kind, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # A player that leaves loses
+            writer.close()
+            self.lose(player)
+
+    def begin(self):
+        names = "\n".join(player.name for player in self.clients).encode()
+        for player in self.clients:
+            player.writer.write(pack(START, start_info.pack(player.id, self.players, self.seed) + names))
+            # The first garbage goes to the next player
+            self.targets[player.id] = (player.id + 1) % self.players
+
+    def dispatch(self, player, kind, payload):
+        if kind == BOARD:
+            # Encoded once for all opponents
+            self.broadcast(pack(BOARD, bytes([player.id]) + payload), skip = player.id)
+        elif kind == LINES:
+            lines = garbage_lines[min(payload[0], len(garbage_lines) - 1)]
+            target = self.target(player)
+            if lines and target is not None:
+                # Scaled to the width of its grid by the opponent, see Client.land()
+                hole = self.random.randrange(256)
+                self.clients[target].writer.write(pack(GARBAGE, garbage_info.pack(lines, hole)))
+        elif kind == LOST:
+            self.lose(player)
+
+    def target(self, player):
+        """
+        Next opponent that is still playing, in turns
+        :return: player id or None
+        """
+        for i in range(1, self.players + 1):
+            target = (self.targets[player.id] + i - 1) % self.players
+            if target != player.id and target in self.alive:
+                self.targets[player.id] = target + 1
+                return target
+        return None
+
+    def lose(self, player):
+        if player.id not in self.alive or self.winner is not None:
+            return
+        self.alive.discard(player.id)
+        self.broadcast(pack(LOST, bytes([player.id])))
+        if len(self.alive) <= 1:
+            self.winner = min(self.alive, default = nobody)
+            self.broadcast(pack(END, bytes([self.winner])))
+            self.done.set()
+
+class Client():
+    """
+    Connection of a local game to a Server
+
+    Contains:
+        name    : name of the player
+        id      : id of the player, known after connect()
+        seed    : seed of the game, known after connect()
+        names   : names of all players
+        boards  : dict of player id -> row masks of the opponents
+        lost    : set of ids of players that lost
+        winner  : id of the winner when the game is over, None while playing
+        latency : stats.Histogram of the time between sending and receiving a board
+                  (the clock is only shared by processes on the same host)
+        rate    : maximum number of boards sent per second
+    """
+    def __init__(self, name, rate = 20):
+        self.name = name
+        self.rate = rate
+        self.id = None
+        self.seed = None
+        self.names = []
+        self.boards = {}
+        self.lost = set()
+        self.winner = None
+        self.garbage = deque()
+        self.latency = Histogram()
+        self.reader = None
+        self.writer = None
+        # Last board that was sent
+        self.sent = None
+        self.sent_version = None
+        self.sent_time = 0.0
+        self.gave_up = False
+        self.changed = False
+
+    async def connect(self, host, port = port):
+        """
+        Join a server and wait for the game to start
+        """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        nodelay(self.writer)
+        self.writer.write(pack(HELLO, self.name.encode()))
+        kind, payload = await receive(self.reader)
+        if kind != START:
+            raise ConnectionError(f"expected START, got message {kind}")
+        self.id, players, self.seed = start_info.unpack_from(payload)
+        self.names = payload[start_info.size:].decode(errors = "replace").split("\n")
+        self.boards = {player: [0] * 40 for player in range(players) if player != self.id}
+        self.sent = [0] * 40
+
+    async def run(self):
+        """
+        Receive messages until the game is over or the connection is closed
+        """
+        try:
+            while self.winner is None:
+                self.received(*await receive(self.reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+
+    def received(self, kind, payload):
+        """
+        Called for every message, on the thread of the event loop
+        """
+        self.handle(kind, payload)
+
+    def handle(self, kind, payload):
+        """
+        Update the state with a message from the server
+        """
+        if kind == BOARD:
+            player = payload[0]
+            sent, = board_time.unpack_from(payload, 1)
+            self.latency.add(time.perf_counter() - sent)
+            apply(self.boards[player], payload[1 + board_time.size:])
+            self.changed = True
+        elif kind == GARBAGE:
+            self.garbage.append(garbage_info.unpack(payload))
+        elif kind == LOST:
+            self.lost.add(payload[0])
+            self.changed = True
+        elif kind == END:
+            self.winner = payload[0]
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def board(self, grid, force = False):
+        """
+        Send the changes of the grid, at most rate times per second
+        """
+        now = time.perf_counter()
+        if grid.version == self.sent_version:
+            return
+        if not force and now - self.sent_time < 1 / self.rate:
+            return
+        rows = list(grid.masks())
+        self.send(pack(BOARD, board_time.pack(now) + delta(self.sent, rows)))
+        self.sent = rows
+        self.sent_version = grid.version
+        self.sent_time = now
+
+    def land(self, game, lines):
+        """
+        Called when a block landed, after full rows are cleared
+        Sends the cleared lines and adds the garbage rows that were received
+        """
+        if lines:
+            self.send(pack(LINES, bytes([lines])))
+        while self.garbage and not game.gameover:
+            lines, hole = self.garbage.popleft()
+            if game.grid.garbage(lines, hole * game.grid.width >> 8):
+                game.gameover = True
+
+    def frame(self, game):
+        """
+        Called once per frame of the game
+        Sends the board, draws the opponents and ends the game when the server says so
+        """
+        self.board(game.grid)
+        if self.changed and game.screen:
+            game.screen.opponents(self)
+        self.changed = False
+        if self.winner is not None and not game.gameover:
+            game.gameover = True
+
+    def lose(self):
+        """
+        Tell the server the game is over
+        """
+        if not self.gave_up:
+            self.gave_up = True
+            self.send(pack(LOST))
+
+    def result(self):
+        """
+        :return: str, message for the end of the game
+        """
+        return "You win!" if self.winner == self.id else "Game over!"
+
+class Link(Client):
+    """
+    Client running on a background thread, for games that don't run in an event loop
+    Messages are handled on the thread of the game in frame(),
+    a pipe wakes up Screen.wait() when a message arrives (see fileno()).
+    """
+    def __init__(self, name, rate = 20):
+        super().__init__(name, rate)
+        self.loop = None
+        self.thread = None
+        self.inbox = deque()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+
+    def fileno(self):
+        return self.wake_read
+
+    def start(self, host, port = port):
+        """
+        Connect on a background thread and wait for the game to start
+        :return: self
+        """
+        connected = threading.Event()
+        errors = []
+        def run():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self.connect(host, port))
+            except (OSError, asyncio.IncompleteReadError) as e:
+                errors.append(e)
+                return
+            finally:
+                connected.set()
+            self.loop.run_until_complete(self.run())
+        self.thread = threading.Thread(target = run, daemon = True)
+        self.thread.start()
+        connected.wait()
+        if errors:
+            raise ConnectionError(f"can't join {host}:{port}: {errors[0]}")
+        return self
+
+    def send(self, data):
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def received(self, kind, payload):
+        self.inbox.append((kind, payload))
+        try:
+            os.write(self.wake_write, b"\0")
+        except BlockingIOError:
+            # The pipe is full, the game already has to wake up
+            pass
+
+    def frame(self, game):
+        try:
+            os.read(self.wake_read, 4096)
+        except BlockingIOError:
+            pass
+        while self.inbox:
+            self.handle(*self.inbox.popleft())
+        super().frame(game)
+
+    def close(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.writer.close)
+        if self.thread is not None:
+            self.thread.join(1)
+
+def host(players = 2, port = port, seed = None):
+    """
+    Run a server on a background thread
+    :return: Server, once it is listening
+    """
+    server = Server(players, seed)
+    thread = threading.Thread(target = asyncio.run, args = (server.serve("", port),), daemon = True)
+    thread.start()
+    server.ready.wait()
+    return server
+
+async def play(client, pieces, frame = 1 / 60, policy = None):
+    """
+    Play a headless game of a client with the autoplayer, one block per frame
+    :return: Game
+    """
+    from .bot import bot
+    from .game import Game
+    from .grid import BitGrid
+    policy = policy or bot
+    game = Game(engine = BitGrid, headless = True, seed = client.seed)
+    game.net = client
+    game.spawn()
+    while not game.gameover and game.pieces < pieces:
+        policy(game.block)
+        while game.block.mobile:
+            game.block.down()
+        game.land()
+        client.frame(game)
+        await asyncio.sleep(frame)
+    client.board(game.grid, force = True)
+    if game.gameover and client.winner is None:
+        client.lose()
+    return game
+
+async def simulate(players = 2, pieces = 200, frame = 1 / 60, rate = 20, seed = 0):
+    """
+    Loopback harness, a server and headless players with the autoplayer in one event loop
+    :return: (server, list of (client, game))
+    """
+    server = Server(players, seed)
+    await server.start("127.0.0.1", 0)
+    clients = [Client(f"bot{i}", rate) for i in range(players)]
+    await asyncio.gather(*(client.connect("127.0.0.1", server.port) for client in clients))
+    receivers = [asyncio.ensure_future(client.run()) for client in clients]
+    games = await asyncio.gather(*(play(client, pieces, frame) for client in clients))
+    # Give the last boards time to arrive
+    await asyncio.sleep(0.05)
+    for client in clients:
+        client.writer.close()
+    await asyncio.gather(*receivers)
+    await server.close()
+    return server, list(zip(clients, games))
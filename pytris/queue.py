@@ -1,25 +1,49 @@
-from .block import blocks
+from .block import Block, pieces
 
-import copy
+from collections import deque
+from itertools import islice
 import random
 
-class Queue(list):
+class Queue(deque):
     """
     The queue contains 1 copy of each block
     When the bag is depleted, it is again filled with blocks in random order
     Blocks are "popped" from the queue
+
+    Every bag is shuffled by its own random generator, seeded from
+    the game seed and the number of the bag, so the sequence of blocks
+    only depends on game.seed
+
+    The queue only holds piece indexes (see block.pieces),
+    a Block is created when it is popped to become the mobile block.
     """
     def __init__(self, game, *args, **kwargs):
+        super().__init__()
         self.game = game
+        self.bags = 0
         self.fill()
 
     def fill(self):
-        tmp = copy.deepcopy(blocks)
-        random.shuffle(tmp)
-        for b in tmp:
-            self.append(b(game = self.game))
+        """
+        Add a shuffled bag of all pieces
+        """
+        bag = list(range(len(pieces)))
+        random.Random((self.game.seed << 32) | self.bags).shuffle(bag)
+        self.bags += 1
+        self.extend(bag)
 
-    def pop(self, i = 0):
+    def clone(self, game):
+        """
+        Copy of the queue for another game
+        :return: Queue
+        """
+        queue = Queue.__new__(Queue)
+        queue.game = game
+        queue.bags = self.bags
+        queue.extend(self)
+        return queue
+
+    def pop(self):
         """
         Pop a block from the stack
         Automatically draw new block to screen
@@ -27,13 +51,24 @@ class Queue(list):
         """
         if len(self) <= 2:
             self.fill()
-        block = super().pop(i)
+        block = Block(self.game, piece = pieces[self.popleft()])
         # Draw the next block in the next box
-        self.game.screen.next()
+        if self.game.screen:
+            self.game.screen.next()
         return block
 
+    def peek(self, n = 1):
+        """
+        The next n pieces, bags are added when the queue is shorter
+        The order of the pieces doesn't depend on how far ahead is looked
+        :return: tuple of block.Piece
+        """
+        while len(self) < n:
+            self.fill()
+        return tuple(pieces[index] for index in islice(self, n))
+
     def next(self):
         """
-        Return the next block in the queue
+        Return the next piece in the queue
         """
-        return self[0]
\ No newline at end of file
+        return self.peek(1)[0]
@@ -0,0 +1,200 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+"""
+Compact input logs of games, used to reproduce bugs and audit highscores
+A game only depends on its seed and the actions applied to it,
+so the log stores those instead of the state of the grid.
+
+Log format, all integers are unsigned LEB128 varints:
+    magic       : b"PYTR"
+    version     : 2
+    seed        : game seed, zig-zag encoded (0, -1, 1, -2, ... as 0, 1, 2, 3, ...)
+                  version 1 logs store it unsigned
+    fps         : frames per second of the frame counter
+    events      : varint( frame delta << 4 | action code ) per action
+    end         : varint( frame delta << 4 | end code ), varint( score )
+
+Frame deltas are mostly small, so an event usually takes a single byte.
+"""
+
+# Stdlib
+import time
+
+magic = b"PYTR"
+version = 2
+# Versions that can be read
+versions = (1, 2)
+fps = 100
+
+# Actions that are recorded, the index is the action code in the log
+actions = ("gravity", "down", "left", "right", "clockwise", "countercw", "drop", "pause")
+codes = {action: code for code, action in enumerate(actions)}
+end = 15
+
+class LogError(ValueError):
+    """
+    The file isn't an input log that can be read
+    """
+
+def zigzag(value):
+    """
+    Map a signed integer on an unsigned one, small negative values stay small
+    """
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value):
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+def write_varint(buffer, value):
+    """
+    Append an unsigned integer to a bytearray as a varint
+    """
+    if value < 0:
+        raise ValueError(f"Can't write a negative varint {value}, see zigzag")
+    while value > 0x7f:
+        buffer.append(value & 0x7f | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def read_varint(data, i):
+    """
+    Read a varint from data starting at index i
+    :return: (value, next index)
+    """
+    value = 0
+    shift = 0
+    while True:
+        if i >= len(data):
+            raise LogError("Truncated input log")
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, i
+        shift += 7
+
+class Recorder():
+    """
+    Records the actions of a game to an input log
+    The log is kept in memory and written to the file on close()
+    """
+    def __init__(self, path, seed, clock = time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.start = clock()
+        self.frame = 0
+        self.buffer = bytearray(magic)
+        write_varint(self.buffer, version)
+        write_varint(self.buffer, zigzag(seed))
+        write_varint(self.buffer, fps)
+        self.closed = False
+
+    def delta(self):
+        """
+        Advance the frame counter to now
+        :return: number of frames since the last event
+        """
+        frame = int((self.clock() - self.start) * fps)
+        delta = frame - self.frame
+        self.frame = frame
+        return delta
+
+    def record(self, action):
+        write_varint(self.buffer, self.delta() << 4 | codes[action])
+
+    def close(self, score):
+        """
+        Write the final score and save the log
+        """
+        if self.closed:
+            return
+        self.closed = True
+        write_varint(self.buffer, self.delta() << 4 | end)
+        write_varint(self.buffer, score)
+        with open(self.path, 'wb') as f_log:
+            f_log.write(self.buffer)
+
+def read(path):
+    """
+    Read an input log
+    :return: (seed, fps, events, score)
+        events  : list of (frame, action)
+        score   : final score or None if the log was not closed
+    """
+    with open(path, 'rb') as f_log:
+        data = f_log.read()
+    if data[:len(magic)] != magic:
+        raise LogError(f"{path} is not a pytris input log")
+    i = len(magic)
+    log_version, i = read_varint(data, i)
+    if log_version not in versions:
+        raise LogError(f"Unsupported input log version {log_version}")
+    seed, i = read_varint(data, i)
+    if log_version >= 2:
+        seed = unzigzag(seed)
+    log_fps, i = read_varint(data, i)
+    events = []
+    frame = 0
+    score = None
+    while i < len(data):
+        value, i = read_varint(data, i)
+        frame += value >> 4
+        code = value & 0xf
+        if code == end:
+            score, i = read_varint(data, i)
+            break
+        events.append((frame, actions[code]))
+    return seed, log_fps, events, score
+
+def replay(path, screen = None, speed = 1):
+    """
+    Replay an input log
+    Without a screen the game is played headless at maximum speed,
+    otherwise it is drawn at speed times the recorded speed
+    :return: (game, recorded score)
+    """
+    # Avoid a circular import, game imports this module for recording
+    from .game import Game
+    seed, log_fps, events, score = read(path)
+    game = Game(screen = screen, seed = seed, headless = screen is None)
+    game.spawn()
+    start = time.monotonic()
+    for frame, action in events:
+        if game.gameover:
+            break
+        if screen is not None:
+            delay = start + frame / (log_fps * speed) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        game.step(action)
+        if game.screen:
+            game.screen.flush()
+    return game, score
+
+def verify(path):
+    """
+    Replay an input log headless and compare the score
+    :return: Boolean
+    """
+    game, score = replay(path)
+    return game.score == score
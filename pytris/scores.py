@@ -0,0 +1,205 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Leaderboard of finished games in an SQLite database
+
+The database is shared by everybody playing on the same host, so it runs in WAL mode:
+readers never block the writer and a writer waits (up to the timeout) for another one
+instead of failing. Every game is a single INSERT, which is atomic, so scores of
+sessions that end at the same moment are never lost.
+
+sqlite3 is only imported when the leaderboard is first used, not at startup.
+The best score for the side panel is cached, refresh() reads it again.
+
+An old ~/.pytris_highscore file (name and score on two lines) is imported once,
+when the database is created.
+"""
+
+# Stdlib
+from collections import namedtuple
+import os
+import time
+
+# Version of the schema, stored as PRAGMA user_version
+schema_version = 1
+
+# Seeds are unsigned 64 bit, too large for an INTEGER, so they are stored as text
+schema = """
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    lines INTEGER NOT NULL DEFAULT 0,
+    level INTEGER NOT NULL DEFAULT 1,
+    pieces INTEGER NOT NULL DEFAULT 0,
+    seed TEXT,
+    duration REAL,
+    played REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scores_score ON scores (score DESC);
+CREATE INDEX IF NOT EXISTS scores_user ON scores (user, score DESC);
+"""
+
+"""
+Entry:
+    user        : name of the player
+    score       : score of the game
+    lines       : number of cleared lines
+    level       : level at the end of the game
+    played      : unix time at the end of the game
+"""
+Entry = namedtuple("Entry", ["user", "score", "lines", "level", "played"])
+
+class LeaderboardError(Exception):
+    """
+    The leaderboard can't be read or written
+    """
+
+class Leaderboard():
+    """
+    Scores of all games, best first
+
+    Contains:
+        path    : path of the SQLite database
+        legacy  : path of an old highscore file to import, or None
+        timeout : seconds to wait for another session that is writing
+    """
+    def __init__(self, path, legacy = None, timeout = 5.0):
+        self.path = str(path)
+        self.legacy = legacy
+        self.timeout = timeout
+        self.db = None
+        self.cache = None
+
+    def connect(self):
+        """
+        Open the database, creating or migrating it when needed
+        :return: sqlite3.Connection
+        """
+        if self.db is not None:
+            return self.db
+        import sqlite3
+        try:
+            # Autocommit, transactions are explicit
+            db = sqlite3.connect(self.path, timeout = self.timeout, isolation_level = None)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            # Check and change the schema in a single write transaction, so only one session migrates
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                (version,), = db.execute("PRAGMA user_version")
+                if version < schema_version:
+                    self.migrate(db, version)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            raise LeaderboardError(f"{self.path}: {e}") from e
+        self.db = db
+        return db
+
+    def migrate(self, db, version):
+        """
+        Bring the schema up to date, inside the transaction of connect()
+        """
+        if version < 1:
+            for statement in schema.split(";"):
+                if statement.strip():
+                    db.execute(statement)
+            for user, score, played in self.read_legacy():
+                db.execute("INSERT INTO scores (user, score, played) VALUES (?, ?, ?)", (user, score, played))
+        db.execute(f"PRAGMA user_version = {schema_version}")
+
+    def read_legacy(self):
+        """
+        Read the old highscore file
+        :return: list of (user, score, time), empty when there is no (readable) file
+        """
+        if not self.legacy:
+            return []
+        try:
+            with open(self.legacy) as f_high:
+                user = f_high.readline().strip()
+                score = int(f_high.readline().strip())
+            played = os.path.getmtime(self.legacy)
+        except (OSError, ValueError):
+            return []
+        return [(user, score, played)]
+
+    def execute(self, query, args = ()):
+        """
+        Run a query, errors of the database are raised as LeaderboardError
+        :return: list of rows
+        """
+        import sqlite3
+        db = self.connect()
+        try:
+            return db.execute(query, args).fetchall()
+        except sqlite3.Error as e:
+            raise LeaderboardError(f"{self.path}: {e}") from e
+
+    def add(self, user, score, lines = 0, level = 1, pieces = 0, seed = None, duration = None):
+        """
+        Record a finished game
+        """
+        self.execute(
+            "INSERT INTO scores (user, score, lines, level, pieces, seed, duration, played) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user, score, lines, level, pieces, None if seed is None else str(seed), duration, time.time()))
+        self.cache = None
+
+    def top(self, n = 10, user = None):
+        """
+        Best games, overall or of one user
+        Games with the same score are ordered by who got there first
+        :return: list of Entry
+        """
+        columns = "user, score, lines, level, played"
+        if user is None:
+            rows = self.execute(f"SELECT {columns} FROM scores ORDER BY score DESC, played LIMIT ?", (n,))
+        else:
+            rows = self.execute(f"SELECT {columns} FROM scores WHERE user = ? ORDER BY score DESC, played LIMIT ?",
+                                (user, n))
+        return [Entry(*row) for row in rows]
+
+    def best(self):
+        """
+        Best game, cached until the next add() or refresh()
+        :return: Entry or None when there are no games yet
+        """
+        if self.cache is None:
+            self.cache = self.top(1) or [None]
+        return self.cache[0]
+
+    def refresh(self):
+        """
+        Read the best game again on the next best(), e.g. to see games of other sessions
+        """
+        self.cache = None
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
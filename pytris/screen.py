@@ -1,4 +1,12 @@
 import curses
+import os
+import selectors
+import sys
+import time
+from collections import deque
+from functools import partial
+
+from .replay import actions
 
 class Screen():
     """
@@ -38,12 +46,64 @@ class Screen():
     curses.LINES and curses.COLS variables to obtain the y and x sizes.
     Legal coordinates will then extend from (0,0) to (curses.LINES - 1, curses.COLS - 1)
 
+    Pixels are not written to curses directly but to a back buffer.
+    flush() compares it to what is on the terminal (the front buffer),
+    writes only the pixels that changed, with runs of the same color in one addstr,
+    and updates the terminal once per frame.
+
     """
 
-    def __init__(self, game, screen = None):
+    # Keys that trigger game actions (see replay.actions)
+    actions = {
+        " ": "down",
+        "KEY_LEFT": "left",
+        "KEY_RIGHT": "right",
+        "KEY_UP": "clockwise",
+        "KEY_DOWN": "countercw",
+        "p": "pause",
+        "\n": "drop"
+    }
+
+    # Names that can be used for keys in the bindings file
+    key_names = {
+        "space": " ",
+        "enter": "\n",
+        "tab": "\t",
+    }
+
+    # Maximum number of keys handled per frame, so holding a key can't stall the game
+    max_keys = 64
+
+    def __init__(self, game, screen = None, overlay = False, bindings = None):
         # Initialize some attributes
         self.game = game
         self.screen = screen
+        self.overlay = overlay
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        # Key presses as (timestamp, key), the most recent ones are kept for statistics
+        self.events = deque(maxlen = 1024)
+        # Build the key dispatch table once
+        if bindings is None:
+            bindings = self.actions
+        self.bindings = bindings
+        self.commands = self.dispatch(bindings)
+        # Frame buffers of pixels, (y, x) -> color attribute
+        self.back = {}
+        self.front = {}
+        self.dirty = set()
+        self.pending = False
+        # Statistics of the last flushed frame
+        self.frame_cells = 0
+        self.frame_bytes = 0
+        self.bytes = 0
+        # Landing position of the block, see ghost()
+        self.ghost_key = None
+        self.ghost_span = None
+        self.ghost_cache = []
+        # Ghost pixels that are on the screen and the ghost they belong to
+        self.ghost_cells = []
+        self.ghost_drawn = None
         # Draw static information to the screen
         try:
             self.static()
@@ -52,12 +112,42 @@ class Screen():
         self.print_count = 0
         # Only do this stuff if there is a screen
         if self.screen:
-            curses.use_default_colors()
-            for i in range(0, curses.COLORS):
-                # Initialize all the color pairs
-                curses.init_pair(i, -1, i)
-            curses.curs_set(0)
-            self.screen.nodelay(True)
+            self.setup()
+        # Used to sleep until a key is pressed, see wait()
+        self.selector = None
+
+    def setup(self):
+        """
+        Initialize the colors and the cursor of the terminal
+        """
+        curses.use_default_colors()
+        for i in range(0, 8):
+            # Initialize the color pairs of the 8 colors that are used
+            curses.init_pair(i, -1, i)
+        curses.curs_set(0)
+        self.screen.nodelay(True)
+        # Color attributes per color pair and per color at the current level
+        self.attrs = [self.pair(i) for i in range(8)]
+        self.palette = self.colors()
+
+    def pair(self, i):
+        """
+        :return: attribute of color pair i
+        """
+        return curses.color_pair(i)
+
+    def update(self):
+        """
+        Show everything that was written in this frame on the terminal
+        """
+        self.screen.noutrefresh()
+        curses.doupdate()
+
+    def exit(self):
+        """
+        Quit the game
+        """
+        exit()
 
     """
     Some wrappers to the screen
@@ -66,8 +156,10 @@ class Screen():
     def addstr(self, y, x, s, color = 0):
         if not self.screen:
             return
+        s = str(s)
+        self.bytes += len(s)
         try:
-            self.screen.addstr(y, x, str(s), curses.color_pair(color))
+            self.screen.addstr(y, x, s, self.pair(color))
         except curses.error:
             pass
     def getkey(self, *args, **kwargs):
@@ -75,53 +167,136 @@ class Screen():
             return
         return self.screen.getkey(*args, **kwargs)
     def refresh(self, *args, **kwargs):
+        """
+        Mark the screen for updating at the next flush()
+        """
+        self.pending = True
+    def wait(self, timeout = None):
+        """
+        Sleep until a key is pressed or the timeout (in seconds) has passed
+        Without a timeout, only a key press wakes up
+        :return: Boolean, True if a key is pressed
+        """
         if not self.screen:
-            return
-        self.screen.refresh(*args, **kwargs)
+            if timeout:
+                time.sleep(timeout)
+            return False
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(sys.stdin, selectors.EVENT_READ)
+            if self.game.net:
+                # Messages of the other players also wake up, see net.Link
+                self.selector.register(self.game.net, selectors.EVENT_READ)
+        return bool(self.selector.select(timeout))
 
     def pixel(self, x, y, color, y0 = 1, x0 = 1):
         """
         Method that draws a pixel to the grid
         Accepts coordinates as (x, y), abstracts away lame curses convention of using (y,x)
+        The pixel is only drawn to the back buffer, see flush()
         """
-        #if y < 0 or color == 0:
-        #    return False
-
-        self.addstr(
-            y + y0,
-            x + x0,
-            " ",
-            self.color(color)
-        )
+        if not self.screen:
+            return
+        key = (y + y0, x + x0)
+        attr = self.palette[color]
+        self.back[key] = attr
+        if self.front.get(key) != attr:
+            self.dirty.add(key)
+        else:
+            self.dirty.discard(key)
+
+    def flush(self):
+        """
+        Write the changed pixels to the screen and update the terminal
+        Horizontal runs of pixels with the same color are written at once
+        Also keeps track of the pixels and bytes written in this frame
+        """
+        if not self.screen:
+            return
+        if not (self.pending or self.dirty):
+            self.frame_cells = self.frame_bytes = 0
+            return
+        back = self.back
+        run = None
+        for y, x in sorted(self.dirty):
+            attr = back[(y, x)]
+            if run and run[0] == y and run[1] + run[2] == x and run[3] == attr:
+                run[2] += 1
+                continue
+            if run:
+                self.run(*run)
+            run = [y, x, 1, attr]
+        if run:
+            self.run(*run)
+        for key in self.dirty:
+            self.front[key] = back[key]
+        self.frame_cells = len(self.dirty)
+        self.frame_bytes = self.bytes
+        self.dirty.clear()
+        self.bytes = 0
+        self.pending = False
+        self.update()
+
+    def run(self, y, x, n, attr):
+        """
+        Write a horizontal run of n pixels of the same color
+        """
+        self.bytes += n
+        try:
+            self.screen.addstr(y, x, " " * n, attr)
+        except curses.error:
+            pass
 
     def resize(self):
         """
         Force a screen redraw when resizing
         """
+        # The terminal contents are gone, so redraw every pixel
+        self.front.clear()
         self.static()
         self.data()
         self.grid()
         self.block()
         self.next()
 
+    def dispatch(self, bindings):
+        """
+        Build the table of functions to call per key
+        Game actions go through game.act(), so they always move the current block
+        and can be recorded
+        :param bindings: dict of key -> action name (see replay.actions) or "exit"
+        :return: dict of key -> function
+        """
+        commands = {"KEY_RESIZE": self.resize}
+        if "exit" not in bindings.values():
+            commands["x"] = self.exit
+        for key, action in bindings.items():
+            if action == "exit":
+                commands[key] = self.exit
+            else:
+                commands[key] = partial(self.game.act, action)
+        return commands
+
     def keytest(self):
         """
         prints a key string to the screen
         for testing
         """
-        import time
         self.print("Testing keys")
+        self.flush()
         while True:
+            self.wait()
             try:
                 self.print(self.getkey())
             except curses.error:
                 pass # ignore when no key is pressed
-
-            time.sleep(0.01)
+            self.flush()
 
     def command(self):
         """
         Attempt to get a command and execute it
+        All keys that are waiting are handled at once, so a burst of key presses
+        doesn't lag behind the gravity tick
         Available commands:
         drop
         down
@@ -131,26 +306,50 @@ class Screen():
         counter clockwise
         pause
         exit
-        :return: a function to execute
+        :return: list of (timestamp, key) that were handled
         """
         if not self.screen:
-            return
-        commands = {
-            " ": self.game.block.down,
-            "KEY_LEFT": self.game.block.left,
-            "KEY_RIGHT": self.game.block.right,
-            "KEY_UP": self.game.block.clockwise,
-            "KEY_DOWN": self.game.block.countercw,
-            "x": exit,
-            "p": self.game.pause,
-            "KEY_RESIZE": self.resize,
-            "\n": self.game.block.drop
-        }
-        try:
-            return commands[self.getkey()]()
-        except (curses.error, KeyError):
-            pass
-        return None
+            return []
+        events = []
+        commands = self.commands
+        for _ in range(self.max_keys):
+            try:
+                key = self.getkey()
+            except curses.error:
+                break
+            event = (time.perf_counter(), key)
+            events.append(event)
+            self.events.append(event)
+            if key in commands:
+                commands[key]()
+        return events
+
+    def latency(self, seconds):
+        """
+        Keep track of the time between a key press and the screen being updated
+        and show it in the debug overlay
+        """
+        self.last_latency = seconds
+        self.max_latency = max(self.max_latency, seconds)
+        if self.overlay:
+            self.addstr(9, 13, f"input {seconds * 1000:5.2f} ms")
+            self.addstr(10, 13, f"max   {self.max_latency * 1000:5.2f} ms")
+            self.addstr(11, 25, f"frame {self.frame_cells:3} cells {self.frame_bytes:4} bytes")
+            if self.game.audio:
+                stats = self.game.audio.stats()
+                self.addstr(12, 25, f"audio {stats['underruns']:3} underruns {stats['mean_cost'] * 1000:5.2f} ms")
+            self.refresh()
+
+    def level_up(self):
+        """
+        Pixels change color every level, so update the palette
+        and redraw all pixels
+        """
+        if self.screen:
+            self.palette = self.colors()
+        self.grid()
+        self.block()
+        self.next()
 
     def block(self):
         """
@@ -158,11 +357,24 @@ class Screen():
         Only draw if block is beyond the buffer zone..
         :return:
         """
-        # First blank the previous position
+        grid = self.game.grid
+        ghost = None
+        if self.screen and self.game.block.mobile:
+            ghost = self.ghost()
+        if ghost is not self.ghost_drawn:
+            # First blank the previous ghost, it may be covered by a block that landed
+            for x, y in self.ghost_cells:
+                self.pixel(x, y - grid.top_buffer, grid[x][y])
+            self.ghost_drawn = ghost
+            self.ghost_cells = [(x, y) for x, y in ghost or () if y >= grid.top_buffer]
+        # Then blank the previous position
         for x, y in self.game.block.last():
             y -= self.game.grid.top_buffer
             if y >= 0:
                 self.pixel(x, y, 0)
+        # Then draw the ghost, under the block
+        for x, y in self.ghost_cells:
+            self.pixel(x, y - grid.top_buffer, self.ghost_color)
         # Then draw the new position
         for x, y in self.game.block.position():
             y -= self.game.grid.top_buffer
@@ -174,9 +386,21 @@ class Screen():
 
     def ghost(self):
         """
-        TODO draw a ghost block on the bottom of the grid
-        basically simulate falling and draw the final position
+        Get the position of the ghost block, where the block lands when it is dropped
+        The landing position is only solved again when the block moved sideways or rotated,
+        or the grid changed. Falling straight down doesn't change where the block lands.
+        :return: list of (x, y) grid coordinates, the same list as long as it is valid
         """
+        block = self.game.block
+        grid = self.game.grid
+        x, y = block.anchor
+        key = (block.piece.index, x, block.rotation, grid.version)
+        if key != self.ghost_key or not self.ghost_span[0] <= y <= self.ghost_span[1]:
+            landing = grid.landing(x, y, block.rotations[block.rotation])
+            self.ghost_key = key
+            self.ghost_span = (y, landing)
+            self.ghost_cache = block.position((x, landing))
+        return self.ghost_cache
 
     def next(self):
         """
@@ -195,28 +419,58 @@ class Screen():
         :return: None
         """
         # Blank the next box
-        for y in range(14, 18):
-            self.addstr(y, 14, " " * 4)
-        # Get the next block in the queue
+        for y in range(4):
+            for x in range(1, 5):
+                self.pixel(x, y, 0, y0 = 14, x0 = 13)
+        # Get the next piece in the queue
         next = self.game.queue.next()
-        for x, y in next.position(anchor = (2,1)):
-            self.pixel(x, y, next.color, y0 = 14, x0 = 13)
+        for dx, dy in next.states[0]:
+            self.pixel(2 + dx, 1 + dy, next.color, y0 = 14, x0 = 13)
         # Finally refresh the screen
         self.refresh()
 
+    def opponents(self, client):
+        """
+        Draw the boards of the other players of a versus game right of the side panel
+        Only which cells are occupied is sent, so they are drawn in a single color
+
+           58 ... 67    70 ... 79
+        0  name         name
+        1  0 0 .. 0     0 0 .. 0
+        ...
+        20 0 0 .. 0     0 0 .. 0
+
+        :param client: net.Client
+        """
+        grid = self.game.grid
+        for i, (player, rows) in enumerate(sorted(client.boards.items())):
+            x0 = 58 + 12 * i
+            name = client.names[player][:10]
+            if player in client.lost:
+                name = name[:6] + " out"
+            self.addstr(0, x0, name.ljust(10))
+            for y in range(grid.height - grid.top_buffer):
+                mask = rows[y + grid.top_buffer]
+                for x in range(grid.width):
+                    self.pixel(x, y, 7 if mask >> x & 1 else 0, y0 = 1, x0 = x0)
+        self.refresh()
+
+    # Palette index of the ghost block
+    ghost_color = 8
+
+    def colors(self):
+        """
+        Color attributes of the blocks at the current level, and of the ghost block
+        :return: list of attributes, indexed by block color
+        """
+        return [self.attrs[self.color(c)] for c in range(8)] + [curses.A_REVERSE | curses.A_DIM]
+
     def color(self, color):
         """
         Return a color offset by the current level
         :return: int
         """
-        if color == 0:
-            return 0
-        tmp = color
-        tmp += self.game.level
-        tmp = tmp % 7
-        if tmp == 0:
-            tmp += 1
-        return tmp
+        return level_color(color, self.game.level)
 
     def data(self):
         """
@@ -353,10 +607,8 @@ exit     : x"""
         21 + - - - - - - - - - -  +
 
         """
-        # Blank the grid
-        for y in range(1, 21):
-            self.addstr(y, 1, " " * 10)
-        # Draw the new grid
+        # Draw the new grid, every visible pixel is written
+        # but only the changed ones end up on the terminal
         for x, column in enumerate(self.game.grid):
             for y, color in enumerate(column):
                 y -= self.game.grid.top_buffer
@@ -372,3 +624,47 @@ exit     : x"""
         """
         # TODO Write something for an endgame screen
         pass
+
+def level_color(color, level):
+    """
+    Offset a block color by a level, the empty cell (0) keeps its color
+    :return: int
+    """
+    if color == 0:
+        return 0
+    tmp = color
+    tmp += level
+    tmp = tmp % 7
+    if tmp == 0:
+        tmp += 1
+    return tmp
+
+def read_bindings(path):
+    """
+    Read key bindings from a config file, keys that are not set keep their default
+
+        [keys]
+        left = KEY_LEFT, h
+        right = KEY_RIGHT, l
+        drop = enter
+        exit = q
+
+    Keys are curses key names, single characters or one of Screen.key_names
+    :return: dict of key -> action name
+    """
+    if not os.path.exists(path):
+        return dict(Screen.actions)
+    # Only import configparser when there is a config file, it is slow to import
+    import configparser
+    config = configparser.ConfigParser()
+    if not config.read(path) or not config.has_section("keys"):
+        return dict(Screen.actions)
+    bindings = {key: action for key, action in Screen.actions.items()
+                if not config.has_option("keys", action)}
+    for action, keys in config.items("keys"):
+        if action not in actions and action != "exit":
+            raise ValueError(f"{path}: unknown action {action!r}")
+        for key in keys.split(","):
+            key = key.strip()
+            bindings[Screen.key_names.get(key, key)] = action
+    return bindings
@@ -0,0 +1,194 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+"""
+Headless batch runner for pytris
+Plays complete games at full speed without a screen and reports
+the throughput, used for regression and load testing.
+
+Games are fanned out over a process pool, every game gets its own seed
+derived from the master seed so a run can be reproduced exactly.
+
+usage: pytris-sim [--games N] [--jobs N] [--seed S] [--policy random|gravity|bot] [--engine bit]
+"""
+
+# Relative imports
+from .block import Block
+from .bot import bot
+from .game import Game
+from .grid import engines
+
+# Stdlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import os
+import random
+import secrets
+import time
+
+def gravity(block):
+    """
+    Policy that never moves the block, it only falls down
+    """
+
+# Input policies, called with the mobile block every frame
+# Workers get the name of the policy, so they don't need to be pickled
+policies = {
+    "random": Block.random_move,
+    "gravity": gravity,
+    "bot": bot,
+}
+
+def derive_seeds(seed, games):
+    """
+    Derive an independent seed for every game from a master seed
+    :return: list of int
+    """
+    rng = random.Random(seed)
+    return [rng.getrandbits(64) for _ in range(games)]
+
+def play(seed, policy = "random", engine = "bit", max_pieces = None):
+    """
+    Play a single headless game
+    :return: dict with the seed, pieces, lines, score and time of the game
+    and the pid of the process that played it
+    """
+    start = time.perf_counter()
+    game = Game(engine = engines[engine], headless = True, seed = seed)
+    game.run(policies[policy], max_pieces = max_pieces)
+    return {
+        "seed": seed,
+        "pieces": game.pieces,
+        "lines": game.lines,
+        "score": game.score,
+        "time": time.perf_counter() - start,
+        "worker": os.getpid(),
+    }
+
+def play_many(seeds, *args):
+    """
+    Play a chunk of games in a worker
+    :return: list of results, see play()
+    """
+    return [play(seed, *args) for seed in seeds]
+
+def simulate(games, policy = "random", engine = "bit", max_pieces = None,
+             seed = None, jobs = 1, chunksize = None):
+    """
+    Play a number of headless games, in a process pool when jobs > 1
+    Games are sent to the workers in chunks to keep the overhead low.
+    :return: generator of results (see play()) in order of completion
+    """
+    seeds = derive_seeds(seed, games)
+    args = (policy, engine, max_pieces)
+    if jobs == 1:
+        for game_seed in seeds:
+            yield play(game_seed, *args)
+        return
+    if chunksize is None:
+        chunksize = max(1, games // (jobs * 8))
+    with ProcessPoolExecutor(max_workers = jobs) as pool:
+        futures = [
+            pool.submit(play_many, seeds[i:i + chunksize], *args)
+            for i in range(0, games, chunksize)
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
+
+def aggregate(results, elapsed):
+    """
+    Sum the results of all games, overall and per worker
+    :return: dict with the totals, the elapsed wall time and a dict of worker totals
+    """
+    totals = {"games": 0, "pieces": 0, "lines": 0, "score": 0, "time": elapsed, "workers": {}}
+    for result in results:
+        worker = totals["workers"].setdefault(
+            result["worker"], {"games": 0, "pieces": 0, "lines": 0, "time": 0.0})
+        for counts in (totals, worker):
+            counts["games"] += 1
+            counts["pieces"] += result["pieces"]
+            counts["lines"] += result["lines"]
+        totals["score"] += result["score"]
+        worker["time"] += result["time"]
+    return totals
+
+def summary(totals):
+    """
+    Format the throughput of a simulation, per worker and in aggregate
+    Per worker throughput is measured over the time spent playing
+    :return: str
+    """
+    lines = []
+    for pid, worker in sorted(totals["workers"].items()):
+        busy = worker["time"] or float("inf")
+        lines.append(
+            f"worker {pid:>7}: {worker['games']:6} games "
+            f"{worker['games'] / busy:10.1f} games/s "
+            f"{worker['pieces'] / busy:10.1f} pieces/s "
+            f"{worker['lines'] / busy:10.1f} lines/s"
+        )
+    elapsed = totals["time"] or float("inf")
+    lines += [
+        f"games    : {totals['games']} in {totals['time']:.3f} s on {len(totals['workers'])} workers",
+        f"pieces   : {totals['pieces']}",
+        f"lines    : {totals['lines']}",
+        f"games/s  : {totals['games'] / elapsed:.1f}",
+        f"pieces/s : {totals['pieces'] / elapsed:.1f}",
+        f"lines/s  : {totals['lines'] / elapsed:.1f}",
+    ]
+    return "\n".join(lines)
+
+def parse_args(args = None):
+    parser = argparse.ArgumentParser(prog = "pytris-sim")
+    parser.add_argument('--games', '-n', type=int, default=100)
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', '-s', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=None)
+    parser.add_argument('--policy', '-p', choices=policies.keys(), default="random")
+    parser.add_argument('--engine', '-e', choices=engines.keys(), default="bit")
+    parser.add_argument('--max-pieces', type=int, default=None)
+    parser.add_argument('--verbose', '-v', action='store_true', default=False)
+    return parser.parse_args(args)
+
+def main(args = None):
+    args = parse_args(args)
+    if args.seed is None:
+        args.seed = secrets.randbits(64)
+    print(f"seed     : {args.seed}")
+    results = []
+    start = time.perf_counter()
+    for result in simulate(
+            args.games,
+            policy = args.policy,
+            engine = args.engine,
+            max_pieces = args.max_pieces,
+            seed = args.seed,
+            jobs = args.jobs,
+            chunksize = args.chunksize):
+        results.append(result)
+        if args.verbose:
+            print(f"game {len(results):>6}: seed {result['seed']:>20} "
+                  f"pieces {result['pieces']:>6} lines {result['lines']:>5}")
+    print(summary(aggregate(results, time.perf_counter() - start)))
+
+if __name__ == "__main__":
+    main()
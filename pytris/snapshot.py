@@ -0,0 +1,190 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Compact binary snapshots of the state of a game
+
+A snapshot holds everything needed to continue a game: the grid, the pose of the block,
+the queue, the seed and the number of bags taken from it (the queue only depends on these),
+score, lines, pieces, level and speed. Only the rows from the highest occupied row down are
+stored, two cells per byte, so a snapshot is a few dozen to a few hundred bytes:
+
+    header      magic, version and the fields below (see header)
+    seed        signed, big endian, seed_length bytes
+    queue       piece index (see block.pieces) of every block in the queue
+    grid        colors of the rows from top down, a color per nibble
+
+The screen, recorder, audio and network of a game are not part of its state.
+The generator of the random moves (game.random) is not stored either,
+a loaded game draws its random moves from the seed and the number of pieces.
+"""
+
+# Relative imports
+from .block import Block, pieces
+from .grid import engines
+
+# Stdlib
+import os
+import random
+import struct
+import time
+
+magic = b"PYTS"
+version = 1
+
+"""
+flags   : gameover, paused, debug, block.mobile
+engine  : index in grid.engines
+"""
+header = struct.Struct("!4sBBBIIIIHddBbbBBBB")
+
+# Flags
+GAMEOVER, PAUSED, DEBUG, MOBILE = 1, 2, 4, 8
+
+engine_types = list(engines.values())
+
+# Split a byte in its high and low nibble, to unpack the grid
+high = bytes(i >> 4 for i in range(256))
+low = bytes(i & 15 for i in range(256))
+shift = bytes((i & 15) << 4 for i in range(256))
+
+class SnapshotError(Exception):
+    """
+    The data isn't a snapshot this version can read
+    """
+
+def dump(game):
+    """
+    Take a snapshot of a game
+    :return: bytes
+    """
+    grid = game.grid
+    block = game.block
+    x, y = block.anchor
+    top = min(grid.skyline)
+    cells = grid.dump(top)
+    if len(cells) % 2:
+        # Nibbles are stored in pairs
+        cells += b"\0"
+    grid_bytes = bytes(map(int.__or__, cells[0::2].translate(shift), cells[1::2]))
+    seed = game.seed.to_bytes((game.seed.bit_length() + 8) // 8, "big", signed = True)
+    queue = bytes(game.queue)
+    flags = (game.gameover and GAMEOVER) | (game.paused and PAUSED) | \
+            (game.debug and DEBUG) | (block.mobile and MOBILE)
+    return header.pack(magic, version, flags, engine_types.index(type(grid)),
+                       game.queue.bags, game.score, game.lines, game.pieces, game.level,
+                       game.speed, game.factor, block.piece.index, x, y, block.rotation,
+                       len(queue), grid.height - top, len(seed)) + seed + queue + grid_bytes
+
+def restore(game, data):
+    """
+    Put the state of a snapshot in a game, the game keeps its screen, recorder, etc.
+    The grid engine of the game is kept as well, the snapshot can come from either engine.
+    :return: game
+    """
+    fields = unpack(data)
+    (flags, engine, bags, score, lines, count, level, speed, factor,
+     piece, x, y, rotation, queue_length, rows, seed_length) = fields
+    offset = header.size
+    game.seed = int.from_bytes(data[offset:offset + seed_length], "big", signed = True)
+    offset += seed_length
+    queue = data[offset:offset + queue_length]
+    offset += queue_length
+    packed = data[offset:]
+    size = rows * game.grid.width
+    if len(packed) != (size + 1) // 2:
+        raise SnapshotError("Truncated snapshot")
+    cells = bytearray(len(packed) * 2)
+    cells[0::2] = packed.translate(high)
+    cells[1::2] = packed.translate(low)
+    game.grid.load(cells[:size])
+
+    game.gameover = bool(flags & GAMEOVER)
+    game.paused = bool(flags & PAUSED)
+    game.debug = bool(flags & DEBUG)
+    game.score = score
+    game.lines = lines
+    game.pieces = count
+    game.level = level
+    game.speed = speed
+    game.factor = factor
+    game.random = random.Random((game.seed << 32) | count)
+    game.t = time.monotonic()
+
+    game.queue.clear()
+    game.queue.bags = bags
+    game.queue.extend(queue)
+    block = game.block = Block(game, piece = pieces[piece])
+    block.anchor = (x, y)
+    block.rotation = rotation
+    block.previous = (block.anchor, rotation)
+    block.mobile = bool(flags & MOBILE)
+    if block.history is not None:
+        block.history[0] = block.previous
+    if game.screen:
+        game.screen.grid()
+        game.screen.next()
+        game.screen.block()
+        game.screen.data()
+    return game
+
+def unpack(data):
+    """
+    Check the header of a snapshot
+    :return: tuple of the fields after the magic and version
+    """
+    if len(data) < header.size or data[:4] != magic:
+        raise SnapshotError("Not a snapshot")
+    fields = header.unpack_from(data)
+    if fields[1] != version:
+        raise SnapshotError(f"Snapshot version {fields[1]} is not supported")
+    return fields[2:]
+
+def load(data, **kwargs):
+    """
+    Create a game from a snapshot
+    :param kwargs: passed on to Game, e.g. screen or headless
+    :return: Game
+    """
+    from .game import Game
+    fields = unpack(data)
+    kwargs.setdefault("engine", engine_types[fields[1]])
+    kwargs.setdefault("debug", bool(fields[0] & DEBUG))
+    return restore(Game(**kwargs), data)
+
+def save(game, path):
+    """
+    Write a snapshot to a file, atomically so a crash never leaves half a snapshot
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f_out:
+        f_out.write(dump(game))
+    os.replace(tmp, path)
+
+def resume(path, **kwargs):
+    """
+    Create a game from a snapshot file
+    :return: Game
+    """
+    with open(path, "rb") as f_in:
+        return load(f_in.read(), **kwargs)
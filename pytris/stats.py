@@ -0,0 +1,267 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Frame profiler for the game loop
+
+The profiler is installed by replacing methods of the game, the screen and the grid
+with timed wrappers on the instances. When it isn't installed nothing is wrapped,
+so profiling costs nothing at all when it is off.
+
+Timings are kept in histograms with a fixed number of log spaced buckets,
+so memory doesn't grow with the length of a session.
+"""
+
+# Stdlib
+import json
+import math
+import time
+
+class Histogram():
+    """
+    Histogram of durations in seconds with log spaced buckets
+    The buckets go from `low` to `high` with `per_decade` buckets per factor 10,
+    durations outside of that range end up in the first or last bucket.
+    """
+    def __init__(self, low = 1e-6, high = 10.0, per_decade = 20):
+        self.low = math.log10(low)
+        self.per_decade = per_decade
+        self.counts = [0] * (int((math.log10(high) - self.low) * per_decade) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > 0:
+            i = int((math.log10(seconds) - self.low) * self.per_decade)
+            i = min(max(i, 0), len(self.counts) - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """
+        Add the durations of another histogram with the same buckets
+        """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def edge(self, i):
+        """
+        :return: upper edge of bucket i in seconds
+        """
+        return 10 ** (self.low + (i + 1) / self.per_decade)
+
+    def percentile(self, p):
+        """
+        :param p: percentile between 0 and 100
+        :return: upper edge of the bucket of the percentile, capped by the maximum
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.edge(i), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        """
+        :return: dict of statistics in seconds
+        """
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "min": self.min if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+class Profiler():
+    """
+    Times the phases of every frame of Game.start()
+
+    Histograms:
+        frame       : from waking up for a key or tick until the frame is flushed
+        input       : Screen.command, handling the keys
+        gravity     : moving the block down on a tick
+        collision   : grid.collision_at
+        clear       : grid.row_is_full
+        render      : Screen.flush, writing to the terminal
+    Flushes that have nothing to draw are not counted as frames.
+    """
+    phases = ("frame", "input", "gravity", "collision", "clear", "render")
+
+    # Seconds between updates of the side panel
+    interval = 0.5
+
+    def __init__(self, game):
+        self.game = game
+        self.histograms = {phase: Histogram() for phase in self.phases}
+        self.moves = 0
+        self.start = time.perf_counter()
+        self.wake = None
+        self.drawn = 0.0
+        self.installed = False
+
+    def timed(self, func, histogram):
+        """
+        Wrap a function so every call is added to a histogram
+        """
+        clock = time.perf_counter
+        add = histogram.add
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(clock() - start)
+        return wrapper
+
+    def install(self):
+        """
+        Replace the methods of the game with timed ones
+        :return: self
+        """
+        game, screen, grid = self.game, self.game.screen, self.game.grid
+        h = self.histograms
+        clock = time.perf_counter
+        act, wait, flush = game.act, screen.wait, screen.flush
+        gravity = h["gravity"].add
+
+        def timed_act(action):
+            if action == "gravity":
+                start = clock()
+                try:
+                    return act(action)
+                finally:
+                    gravity(clock() - start)
+            self.moves += 1
+            return act(action)
+
+        def timed_wait(*args, **kwargs):
+            try:
+                return wait(*args, **kwargs)
+            finally:
+                self.wake = clock()
+
+        render = h["render"].add
+        frame = h["frame"].add
+        def timed_flush():
+            if not (screen.pending or screen.dirty):
+                # Nothing to draw, this is not a frame of its own
+                flush()
+                return
+            start = clock()
+            if start - self.drawn > self.interval:
+                # Goes out with this frame, a flush of its own would count as a frame
+                self.drawn = start
+                self.draw()
+                start = clock()
+            flush()
+            end = clock()
+            render(end - start)
+            # Without waiting (debug mode) a frame goes from flush to flush
+            frame(end - (start if self.wake is None else self.wake))
+            self.wake = end
+
+        game.act = timed_act
+        screen.wait = timed_wait
+        screen.flush = timed_flush
+        screen.command = self.timed(screen.command, h["input"])
+        grid.collision_at = self.timed(grid.collision_at, h["collision"])
+        grid.row_is_full = self.timed(grid.row_is_full, h["clear"])
+        # The key bindings hold on to game.act, so bind them again
+        screen.commands = screen.dispatch(screen.bindings)
+        self.start = clock()
+        self.installed = True
+        return self
+
+    def uninstall(self):
+        """
+        Restore the original methods
+        """
+        if not self.installed:
+            return
+        game, screen, grid = self.game, self.game.screen, self.game.grid
+        del game.act
+        for name in ("wait", "flush", "command"):
+            delattr(screen, name)
+        for name in ("collision_at", "row_is_full"):
+            delattr(grid, name)
+        screen.commands = screen.dispatch(screen.bindings)
+        self.installed = False
+
+    def moves_per_second(self):
+        elapsed = time.perf_counter() - self.start
+        return self.moves / elapsed if elapsed > 0 else 0.0
+
+    def draw(self):
+        """
+        Show the statistics on the side panel
+        """
+        frame = self.histograms["frame"]
+        render = self.histograms["render"]
+        screen = self.game.screen
+        screen.addstr(1, 25, f"frame p50 {frame.percentile(50) * 1000:6.2f} ms p99 {frame.percentile(99) * 1000:6.2f} ms")
+        screen.addstr(2, 25, f"render    {render.mean() * 1000:6.2f} ms max {render.max * 1000:6.2f} ms")
+        screen.addstr(3, 25, f"moves/s   {self.moves_per_second():6.1f}")
+        screen.refresh()
+
+    def summary(self):
+        """
+        :return: dict with a summary per phase
+        """
+        return {
+            "duration": time.perf_counter() - self.start,
+            "moves": self.moves,
+            "moves_per_second": self.moves_per_second(),
+            "pieces": self.game.pieces,
+            "score": self.game.score,
+            "phases": {phase: h.summary() for phase, h in self.histograms.items()},
+        }
+
+    def dump(self, path):
+        """
+        Write the summary as JSON
+        """
+        with open(path, 'w') as f_out:
+            json.dump(self.summary(), f_out, indent = 2)
+            f_out.write("\n")
@@ -0,0 +1,645 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Host many games in one process, for players that connect with telnet
+
+Every connection is a Session with its own Game. Its Screen doesn't draw on curses
+but on a Terminal, a window that turns addstr() into ANSI escape codes in a buffer,
+which is written to the connection once per frame. Players first type the name their
+games are kept under on the leaderboard, the game starts when they press return.
+
+All sessions share one event loop and one timer: the gravity deadlines of all games
+are kept in a single heap (see Host.schedule). The timer fires for the earliest deadline,
+runs every game that is due in order of deadline and is armed again for the next one,
+so idle sessions cost nothing and no session polls. A bounded number of games is run
+per callback, so a burst of deadlines doesn't hold up the keys of other players.
+
+Memory per session is bounded: keys are kept in a short queue, output that the connection
+can't take is dropped and the whole screen is redrawn once the connection catches up.
+
+usage: pytris-host [--bind ADDRESS] [--port N] [--max-sessions N]
+       telnet HOST 7211
+
+load() is a client that simulates many players, see benchmarks/bench_host.py.
+"""
+
+# Relative imports
+from .game import Game, home
+from .grid import BitGrid
+from .net import nodelay
+from .scores import Leaderboard, LeaderboardError
+from .screen import Screen
+from .stats import Histogram
+
+# Stdlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import curses
+import heapq
+import itertools
+import json
+import random
+import signal
+import time
+
+port = 7211
+
+# Telnet commands
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+ECHO, SUPPRESS_GO_AHEAD = 1, 3
+
+# Character at a time input without local echo, then clear the screen and hide the cursor
+hello = bytes([IAC, WILL, ECHO, IAC, WILL, SUPPRESS_GO_AHEAD]) + b"\x1b[0m\x1b[2J\x1b[?25l"
+goodbye = b"\x1b[0m\x1b[?25h\x1b[23;1H\r\n"
+
+# Longest name on the leaderboard, it fits the message line of the screen
+max_name = 12
+
+# Escape sequences of the arrow keys, by their last character
+arrows = {
+    ord("A"): "KEY_UP",
+    ord("B"): "KEY_DOWN",
+    ord("C"): "KEY_RIGHT",
+    ord("D"): "KEY_LEFT",
+}
+
+def sgr(attr):
+    """
+    ANSI escape code for a curses style attribute, see TerminalScreen.pair()
+    :return: bytes
+    """
+    codes = "0"
+    pair = (attr & curses.A_COLOR) >> 8
+    if pair:
+        codes += f";{40 + pair}"
+    if attr & curses.A_REVERSE:
+        codes += ";7"
+    if attr & curses.A_DIM:
+        codes += ";2"
+    return f"\x1b[{codes}m".encode()
+
+class Terminal():
+    """
+    Window that writes ANSI escape codes to a buffer instead of a terminal
+    Has the methods of a curses window that Screen uses
+
+    Contains:
+        out     : bytearray of output that wasn't sent yet
+        keys    : keys that were received but not handled yet, as curses key names
+    """
+    max_keys = 64
+
+    def __init__(self):
+        self.out = bytearray(hello)
+        self.keys = deque(maxlen = self.max_keys)
+        # Start of an escape sequence or telnet command that didn't arrive completely
+        self.rest = b""
+        self.return_pressed = False
+        self.attr = None
+        self.cursor = None
+
+    def addstr(self, y, x, s, attr = 0):
+        out = self.out
+        if self.cursor != (y, x):
+            out += b"\x1b[%d;%dH" % (y + 1, x + 1)
+        if attr != self.attr:
+            out += sgr(attr)
+            self.attr = attr
+        out += s.encode()
+        self.cursor = (y, x + len(s))
+
+    def getkey(self):
+        if not self.keys:
+            raise curses.error("no input")
+        return self.keys.popleft()
+
+    def nodelay(self, flag):
+        pass
+
+    def noutrefresh(self):
+        pass
+
+    def clear(self):
+        """
+        Clear the whole terminal
+        """
+        self.out += b"\x1b[0m\x1b[2J"
+        self.attr = self.cursor = None
+
+    def feed(self, data):
+        """
+        Decode the bytes of a connection into keys
+        Telnet commands are skipped, a return (\\r\\n or \\r\\0) is a single "\\n"
+        """
+        data = self.rest + data
+        keys = self.keys
+        i = 0
+        n = len(data)
+        while i < n:
+            byte = data[i]
+            if self.return_pressed and byte in (0, 10):
+                # Second half of a return
+                self.return_pressed = False
+                i += 1
+                continue
+            self.return_pressed = False
+            if byte == IAC:
+                if i + 1 >= n:
+                    break
+                command = data[i + 1]
+                if command in (WILL, WONT, DO, DONT):
+                    if i + 2 >= n:
+                        break
+                    i += 3
+                elif command == SB:
+                    end = data.find(bytes([IAC, SE]), i + 2)
+                    if end < 0:
+                        break
+                    i = end + 2
+                else:
+                    i += 2
+            elif byte == 0x1b:
+                if i + 2 >= n:
+                    break
+                if data[i + 1] in b"[O" and data[i + 2] in arrows:
+                    keys.append(arrows[data[i + 2]])
+                    i += 3
+                else:
+                    i += 1
+            elif byte == 13:
+                keys.append("\n")
+                self.return_pressed = True
+                i += 1
+            else:
+                keys.append(chr(byte))
+                i += 1
+        # Incomplete sequences are short, anything longer is garbage
+        self.rest = data[i:][:16]
+
+class TerminalScreen(Screen):
+    """
+    Screen of a Session, drawn on a Terminal
+    The output of every frame is written to the connection in one go
+    """
+    # Output that may be waiting for a connection before frames are dropped
+    limit = 64 * 1024
+
+    def __init__(self, game, session, **kwargs):
+        self.session = session
+        self.stale = False
+        super().__init__(game, session.terminal, **kwargs)
+
+    def setup(self):
+        # Color attributes per color pair and per color at the current level
+        self.attrs = [self.pair(i) for i in range(8)]
+        self.palette = self.colors()
+
+    def pair(self, i):
+        return i << 8
+
+    def flush(self):
+        writer = self.session.writer
+        if self.stale and writer.transport.get_write_buffer_size() < self.limit:
+            # The connection caught up, redraw everything that was dropped
+            self.stale = False
+            self.screen.clear()
+            self.resize()
+        super().flush()
+
+    def update(self):
+        terminal = self.screen
+        writer = self.session.writer
+        if writer.is_closing():
+            terminal.out.clear()
+        elif writer.transport.get_write_buffer_size() >= self.limit:
+            # Too slow, drop this frame
+            terminal.out.clear()
+            self.stale = True
+        else:
+            writer.write(bytes(terminal.out))
+            terminal.out.clear()
+
+    def exit(self):
+        self.session.close()
+
+class Session():
+    """
+    A single player connected to a Host
+
+    Contains:
+        game        : Game of the player, drawn on a TerminalScreen
+        terminal    : Terminal of the screen
+        deadline    : time.monotonic() of the next gravity step, None when there is none
+        typed       : name typed so far at the prompt, the game starts once it is entered
+    """
+    def __init__(self, host, reader, writer, seed = None, name = None):
+        self.host = host
+        self.reader = reader
+        self.writer = writer
+        self.deadline = None
+        self.closed = False
+        self.typed = ""
+        self.terminal = Terminal()
+        game = self.game = Game(engine = BitGrid, headless = True, seed = seed)
+        game.player = name
+        game.leaderboard = host.leaderboard
+        game.screen = TerminalScreen(game, self)
+        game.screen.data()
+
+    def start(self):
+        """
+        Ask for the name of the player, or play right away when it is known
+        """
+        if self.game.player is None:
+            self.prompt()
+        else:
+            self.play()
+
+    def prompt(self):
+        screen = self.game.screen
+        screen.print(f"Name: {self.typed}_")
+        screen.flush()
+
+    def enter(self):
+        """
+        Handle the keys typed at the name prompt, keys after the return are for the game
+        """
+        keys = self.terminal.keys
+        while keys:
+            key = keys.popleft()
+            if key == "\n":
+                self.game.player = self.typed.strip() or "guest"
+                self.game.screen.print("")
+                self.play()
+                return
+            if key in ("\x7f", "\x08"):
+                self.typed = self.typed[:-1]
+            elif len(key) == 1 and key.isprintable() and len(self.typed) < max_name:
+                self.typed += key
+        self.prompt()
+
+    def play(self):
+        game = self.game
+        game.spawn()
+        game.started = game.t = time.monotonic()
+        game.screen.flush()
+        self.schedule()
+        self.host.background(self.read_highscore())
+
+    async def read_highscore(self):
+        """
+        Show the best game, read from the leaderboard off the event loop
+        """
+        try:
+            best = await self.host.query(self.game.leaderboard.best)
+        except LeaderboardError:
+            return
+        if not self.closed:
+            self.game.show_highscore(best)
+            self.game.screen.flush()
+
+    def schedule(self):
+        """
+        Put the next gravity step of the game on the timer heap of the host
+        Only when it changed, so keys don't grow the heap
+        """
+        game = self.game
+        deadline = None if game.paused or self.closed else game.t + game.speed
+        if deadline != self.deadline:
+            self.deadline = deadline
+            if deadline is not None:
+                self.host.schedule(self, deadline)
+
+    def input(self, data):
+        """
+        Handle the bytes received from the player
+        """
+        if self.closed:
+            return
+        self.terminal.feed(data)
+        if self.game.player is None:
+            self.enter()
+            return
+        self.game.screen.command()
+        self.after()
+
+    def tick(self, deadline, now):
+        """
+        Move the block down at the gravity deadline
+        The next step is due an interval after this deadline, not after now, so a late step
+        doesn't delay all the steps after it. A game that fell behind by more than a step
+        continues from now instead of catching up in a burst.
+        """
+        game = self.game
+        game.t = deadline if now - deadline < game.speed else now
+        game.act("gravity")
+        self.after()
+
+    def after(self):
+        """
+        Handle the block landing and draw the frame, like an iteration of Game.start()
+        """
+        if self.closed:
+            return
+        game = self.game
+        if not game.block.mobile and not game.paused:
+            game.land()
+        if game.gameover:
+            self.end()
+            return
+        game.screen.flush()
+        self.schedule()
+
+    def end(self):
+        game = self.game
+        game.screen.print("Game over!")
+        game.screen.flush()
+        self.deadline = None
+        self.host.loop.call_later(3, self.close)
+        self.host.background(self.write_highscore())
+
+    async def write_highscore(self):
+        """
+        Add the game to the leaderboard off the event loop, like Game.write_highscore()
+        """
+        game = self.game
+        def save():
+            return game.leaderboard.best() if game.save_score() else None
+        try:
+            best = await self.host.query(save)
+        except LeaderboardError:
+            if not self.closed:
+                game.screen.print("Score not saved!")
+                game.screen.flush()
+            return
+        if not self.closed and best is not None:
+            game.show_highscore(best)
+            game.screen.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.deadline = None
+        if not self.writer.is_closing():
+            self.writer.write(goodbye)
+            self.writer.close()
+        self.host.sessions.discard(self)
+
+class Host():
+    """
+    Serves a Session per connection, all in one event loop
+
+    Contains:
+        sessions    : set of active sessions
+        heap        : (deadline, order, session) of the next gravity steps, entries of sessions
+                      whose deadline changed since are skipped when they come up
+        leaderboard : scores.Leaderboard shared by all sessions
+        database    : executor with the one thread that uses the leaderboard, so SQLite
+                      doesn't block the event loop
+        ticks       : number of gravity steps run
+        lag         : stats.Histogram of how late the gravity steps run after their deadline
+    """
+    def __init__(self, leaderboard = None, max_sessions = 1000, batch = 64, seed = None):
+        if leaderboard is None:
+            leaderboard = Leaderboard(f"{home}/.pytris.db")
+        self.leaderboard = leaderboard
+        self.database = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "leaderboard")
+        self.max_sessions = max_sessions
+        self.batch = batch
+        self.random = random.Random(seed)
+        self.sessions = set()
+        # Connections that are being handled and their leaderboard calls
+        self.tasks = set()
+        self.heap = []
+        self.order = itertools.count()
+        self.timer = None
+        self.timer_at = None
+        self.loop = None
+        self.server = None
+        self.port = None
+        self.ticks = 0
+        self.lag = Histogram()
+
+    def stats(self):
+        """
+        :return: dict with the sessions, gravity steps and their lag in seconds
+        """
+        return {"sessions": len(self.sessions), "ticks": self.ticks, "lag": self.lag.summary()}
+
+    async def start(self, host = "", port = port):
+        """
+        Start listening, port 0 picks a free port
+        """
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stop listening and end all sessions
+        """
+        self.server.close()
+        for session in list(self.sessions):
+            session.close()
+        if self.timer is not None:
+            self.timer.cancel()
+        # The connections end when the players see them closed
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout = 1)
+        await self.server.wait_closed()
+        # Let the scores that are being written finish
+        await self.loop.run_in_executor(None, self.database.shutdown)
+
+    def query(self, function, *args):
+        """
+        Run a blocking leaderboard call on the database thread
+        :return: asyncio.Future of its result
+        """
+        return self.loop.run_in_executor(self.database, function, *args)
+
+    def background(self, coroutine):
+        """
+        Run a coroutine of a session, close() waits for it
+        """
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, reader, writer):
+        """
+        Connection of a single player
+        """
+        if len(self.sessions) >= self.max_sessions:
+            writer.write(b"Server full, try again later\r\n")
+            writer.close()
+            return
+        nodelay(writer)
+        session = Session(self, reader, writer, seed = self.random.getrandbits(64))
+        self.sessions.add(session)
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            session.start()
+            while not session.closed:
+                data = await reader.read(256)
+                if not data:
+                    break
+                session.input(data)
+        except ConnectionError:
+            pass
+        finally:
+            session.close()
+            self.tasks.discard(task)
+
+    def schedule(self, session, deadline):
+        """
+        Run session.tick() at the deadline
+        """
+        heapq.heappush(self.heap, (deadline, next(self.order), session))
+        self.arm()
+
+    def arm(self):
+        """
+        Set the timer to the earliest deadline
+        """
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_at <= deadline:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_at(deadline, self.fire)
+        self.timer_at = deadline
+
+    def fire(self):
+        """
+        Run the games that are due, earliest deadline first
+        """
+        self.timer = None
+        heap = self.heap
+        now = time.monotonic()
+        for _ in range(self.batch):
+            if not heap or heap[0][0] > now:
+                break
+            deadline, order, session = heapq.heappop(heap)
+            if session.deadline != deadline:
+                # Rescheduled, paused or closed since
+                continue
+            session.deadline = None
+            self.ticks += 1
+            self.lag.add(now - deadline)
+            session.tick(deadline, now)
+        else:
+            if heap and heap[0][0] <= now:
+                # More games are due, let the keys of the players in first
+                self.timer = self.loop.call_soon(self.fire)
+                self.timer_at = now
+                return
+        self.arm()
+
+async def player(host, port, duration, rate, rng, stats, ramp = 1.0):
+    """
+    Simulated player for load(): enters a name, presses random keys at random times and reads the screen
+    A new game is started when the game is over
+    Players join at a random time during the first ramp seconds, like real players do
+    """
+    keys = [b"\x1b[D", b"\x1b[C", b"\x1b[A", b"\x1b[B", b" "]
+    end = time.monotonic() + duration
+    await asyncio.sleep(rng.uniform(0, ramp))
+    while time.monotonic() < end:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except ConnectionRefusedError:
+            # The backlog of the host is full
+            stats["refused"] += 1
+            await asyncio.sleep(0.1)
+            continue
+        nodelay(writer)
+        stats["sessions"] += 1
+        sent = []
+        async def read():
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                stats["bytes"] += len(data)
+                if sent:
+                    stats["response"].add(time.perf_counter() - sent.pop())
+        reading = asyncio.ensure_future(read())
+        writer.write(b"load\r\n")
+        try:
+            while time.monotonic() < end and not reading.done():
+                await asyncio.sleep(rng.expovariate(rate))
+                sent[:] = [time.perf_counter()]
+                writer.write(rng.choice(keys))
+        finally:
+            writer.close()
+            await asyncio.gather(reading, return_exceptions = True)
+
+async def load(host = "127.0.0.1", port = port, sessions = 500, duration = 10.0, rate = 4.0, seed = 0, ramp = 1.0):
+    """
+    Simulate many players at once
+    :param rate: key presses per second per player
+    :return: dict with the number of sessions, refused connections, bytes received
+    and a Histogram of the time between a key press and the next output
+    """
+    rng = random.Random(seed)
+    stats = {"sessions": 0, "refused": 0, "bytes": 0, "response": Histogram()}
+    await asyncio.gather(*(
+        player(host, port, duration, rate, random.Random(rng.getrandbits(64)), stats, ramp)
+        for _ in range(sessions)
+    ))
+    return stats
+
+def parse_args(args = None):
+    parser = argparse.ArgumentParser(prog = "pytris-host")
+    parser.add_argument('--bind', '-b', metavar='ADDRESS', default='',
+                        help='address to listen on, all addresses by default')
+    parser.add_argument('--port', '-p', type=int, default=port)
+    parser.add_argument('--max-sessions', '-n', type=int, default=1000)
+    parser.add_argument('--database', metavar='FILE', default=f"{home}/.pytris.db",
+                        help='leaderboard of the games')
+    return parser.parse_args(args)
+
+async def serve(args):
+    host = Host(Leaderboard(args.database), args.max_sessions)
+    await host.start(args.bind, args.port)
+    print(f"listening on port {host.port}", flush = True)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+    await host.close()
+    print(json.dumps(host.stats()), flush = True)
+
+def main(args = None):
+    asyncio.run(serve(parse_args(args)))
+
+if __name__ == "__main__":
+    main()
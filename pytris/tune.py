@@ -0,0 +1,278 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+"""
+Tune the weights of the autoplayer (see bot.weights) with the cross-entropy method
+
+Every generation a population of weight vectors is drawn from a normal distribution
+per feature. Each candidate plays the same fixed set of seeds, so all candidates get
+identical block sequences from the Queue and are compared fairly. The distribution is
+then refitted to the best candidates (the elite).
+
+Games are played in a process pool. The workers receive the seeds and game settings once,
+in the pool initializer, so a task is only a weight vector and the index of a seed.
+After every generation the state is written to a checkpoint, a run that is started
+again with the same checkpoint continues where it stopped.
+
+usage: pytris-tune [--generations N] [--population N] [--games N] [--jobs N] [--checkpoint FILE]
+"""
+
+# Relative imports
+from .bot import Bot, features, weights
+from .game import Game
+from .grid import engines
+from .sim import derive_seeds
+
+# Stdlib
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import random
+import time
+
+# Settings of the games, set in every worker by init_worker()
+worker = {}
+
+def init_worker(seeds, engine = "bit", max_pieces = 500, lookahead = 0):
+    """
+    Pool initializer, keeps the settings that are the same for every task
+    """
+    worker.update(seeds = seeds, engine = engine, max_pieces = max_pieces, lookahead = lookahead)
+
+def evaluate(task):
+    """
+    Play one game with a weight vector on one of the fixed seeds
+    :param task: (candidate index, weight vector, seed index)
+    :return: (candidate index, lines, pieces)
+    """
+    candidate, vector, seed = task
+    bot = Bot(dict(zip(features, vector)), lookahead = worker["lookahead"])
+    game = Game(engine = engines[worker["engine"]], headless = True, seed = worker["seeds"][seed])
+    game.run(bot, max_pieces = worker["max_pieces"])
+    return candidate, game.lines, game.pieces
+
+class Tuner():
+    """
+    Cross-entropy search over the weights of the board features
+
+    Contains:
+        mean        : mean weight per feature
+        std         : standard deviation per feature
+        generation  : number of finished generations
+        best        : (fitness, weights) of the best candidate so far
+        history     : report of every generation, see step()
+
+    The fitness of a candidate is the mean number of lines over the seeds,
+    games end at game over or after max_pieces blocks.
+    """
+    def __init__(self, population = 32, elite = 0.25, games = 8, seed = 0, std = 0.5,
+                 noise = 0.05, engine = "bit", max_pieces = 500, lookahead = 0):
+        self.population = population
+        self.elite = max(1, int(population * elite))
+        self.seed = seed
+        self.noise = noise
+        self.settings = {"engine": engine, "max_pieces": max_pieces, "lookahead": lookahead}
+        self.seeds = derive_seeds(seed, games)
+        self.mean = [weights[name] for name in features]
+        self.std = [std] * len(features)
+        self.generation = 0
+        self.best = None
+        self.history = []
+
+    def state(self):
+        """
+        :return: dict with everything needed to continue the search, see load()
+        """
+        return {
+            "generation": self.generation,
+            "seed": self.seed,
+            "seeds": self.seeds,
+            "features": list(features),
+            "settings": self.settings,
+            "mean": self.mean,
+            "std": self.std,
+            "best": self.best,
+            "history": self.history,
+        }
+
+    def save(self, path):
+        """
+        Write the state as JSON, through a temporary file so a checkpoint is never half written
+        """
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f_out:
+            json.dump(self.state(), f_out, indent = 2)
+            f_out.write("\n")
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """
+        Continue from a checkpoint written by save()
+        :return: True if there was a checkpoint
+        """
+        try:
+            with open(path) as f_in:
+                state = json.load(f_in)
+        except FileNotFoundError:
+            return False
+        if state["features"] != list(features):
+            raise ValueError(f"checkpoint {path} tunes other features: {state['features']}")
+        self.generation = state["generation"]
+        self.seed = state["seed"]
+        self.seeds = state["seeds"]
+        self.settings = state["settings"]
+        self.mean = state["mean"]
+        self.std = state["std"]
+        self.best = state["best"]
+        self.history = state["history"]
+        return True
+
+    def sample(self):
+        """
+        Draw the candidates of the current generation
+        The generator depends only on the seed and the generation, so a resumed run
+        draws the same candidates as one that didn't stop
+        :return: list of weight vectors
+        """
+        rng = random.Random(self.seed * 1000003 + self.generation)
+        return [
+            [rng.gauss(mean, std) for mean, std in zip(self.mean, self.std)]
+            for _ in range(self.population)
+        ]
+
+    def step(self, pool = None, jobs = 1):
+        """
+        Evaluate one generation and refit the distribution to the elite
+        :param pool: executor with jobs workers set up by init_worker(), the games are played here when None
+        :return: dict with the fitness and throughput of the generation
+        """
+        candidates = self.sample()
+        tasks = [
+            (candidate, vector, seed)
+            for candidate, vector in enumerate(candidates)
+            for seed in range(len(self.seeds))
+        ]
+        start = time.perf_counter()
+        if pool is None:
+            init_worker(self.seeds, **self.settings)
+            results = map(evaluate, tasks)
+        else:
+            # Small chunks keep all workers busy until the end of the generation
+            chunksize = max(1, len(tasks) // (jobs * 8))
+            results = pool.map(evaluate, tasks, chunksize = chunksize)
+        lines = [0] * len(candidates)
+        pieces = 0
+        for candidate, game_lines, game_pieces in results:
+            lines[candidate] += game_lines
+            pieces += game_pieces
+        elapsed = time.perf_counter() - start
+
+        fitness = [total / len(self.seeds) for total in lines]
+        ranked = sorted(zip(fitness, candidates), key = lambda pair: pair[0], reverse = True)
+        elite = [vector for score, vector in ranked[:self.elite]]
+        for i in range(len(features)):
+            values = [vector[i] for vector in elite]
+            self.mean[i] = sum(values) / len(values)
+            variance = sum((value - self.mean[i]) ** 2 for value in values) / len(values)
+            # Extra noise keeps the search from collapsing too early
+            self.std[i] = (variance + self.noise ** 2) ** 0.5
+        if self.best is None or ranked[0][0] > self.best[0]:
+            self.best = [ranked[0][0], dict(zip(features, ranked[0][1]))]
+        self.generation += 1
+        report = {
+            "generation": self.generation,
+            "best": ranked[0][0],
+            "mean": sum(fitness) / len(fitness),
+            "elite": sum(score for score, vector in ranked[:self.elite]) / self.elite,
+            "games": len(tasks),
+            "pieces": pieces,
+            "time": elapsed,
+            "games_per_second": len(tasks) / elapsed,
+            "pieces_per_second": pieces / elapsed,
+        }
+        self.history.append(report)
+        return report
+
+    def run(self, generations, jobs = 1, checkpoint = None, callback = None):
+        """
+        Run until the given number of generations is finished
+        :param checkpoint: path to save the state to after every generation
+        :param callback: called with the report of every generation
+        :return: (fitness, weights) of the best candidate
+        """
+        pool = None
+        if jobs > 1:
+            settings = self.settings
+            pool = ProcessPoolExecutor(
+                max_workers = jobs, initializer = init_worker,
+                initargs = (self.seeds, settings["engine"], settings["max_pieces"], settings["lookahead"]))
+        try:
+            while self.generation < generations:
+                report = self.step(pool, jobs)
+                if checkpoint:
+                    self.save(checkpoint)
+                if callback:
+                    callback(report)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return self.best
+
+def parse_args(args = None):
+    parser = argparse.ArgumentParser(prog = "pytris-tune")
+    parser.add_argument('--generations', '-g', type=int, default=20)
+    parser.add_argument('--population', '-n', type=int, default=32)
+    parser.add_argument('--elite', type=float, default=0.25,
+                        help='fraction of the population the distribution is refitted to')
+    parser.add_argument('--games', type=int, default=8,
+                        help='number of fixed seeds every candidate plays')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', '-s', type=int, default=0)
+    parser.add_argument('--engine', '-e', choices=engines.keys(), default="bit")
+    parser.add_argument('--max-pieces', type=int, default=500)
+    parser.add_argument('--lookahead', type=int, default=0)
+    parser.add_argument('--checkpoint', '-c', metavar='FILE', default=None,
+                        help='save the state after every generation and resume from it')
+    args = parser.parse_args(args)
+    if args.generations < 1:
+        parser.error("--generations must be at least 1")
+    return args
+
+def main(args = None):
+    args = parse_args(args)
+    tuner = Tuner(args.population, args.elite, args.games, args.seed, engine = args.engine,
+                  max_pieces = args.max_pieces, lookahead = args.lookahead)
+    if args.checkpoint and tuner.load(args.checkpoint):
+        print(f"resuming from generation {tuner.generation} of {args.checkpoint}")
+    def report(generation):
+        print(f"generation {generation['generation']:>4}: "
+              f"best {generation['best']:8.1f} elite {generation['elite']:8.1f} mean {generation['mean']:8.1f} lines "
+              f"{generation['games_per_second']:8.1f} games/s {generation['pieces_per_second']:10.0f} pieces/s")
+    fitness, best = tuner.run(args.generations, args.jobs, args.checkpoint, report)
+    print(f"best     : {fitness:.1f} lines")
+    for name in features:
+        print(f"{name:<9}: {best[name]:.3f}")
+
+if __name__ == "__main__":
+    main()
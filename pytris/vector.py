@@ -0,0 +1,268 @@
+#MIT License
+#
+#Copyright (c) 2019 Matthijs Tadema
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+"""
+Vectorized batch environment for bot training
+Holds K games as row bitmasks (see VectorEnv.grid, bit x of row y is grid[x][y])
+and steps all of them at once with numpy, without any per-game Python objects.
+The blocks are the compiled pieces from pytris.block and like pytris.queue.Queue
+every game draws them from its own shuffled 7-bag.
+
+Every step applies one action per game, followed by gravity.
+Blocks that hit the bottom are locked into the board, full rows are cleared,
+the next block is spawned from the game's 7-bag and games that are over
+are automatically reset.
+
+    env = VectorEnv(4096, seed = 0)
+    lines, done = env.step(actions)
+"""
+
+from .block import pieces
+
+import numpy as np
+
+# Actions, the index is the value passed to VectorEnv.step
+actions = ("none", "left", "right", "clockwise", "countercw", "down", "drop")
+
+def compile_tables():
+    """
+    Turn the compiled pieces into flat arrays indexed by piece * 4 + rotation
+    Pieces with less than 4 rotations repeat their rotations,
+    so the rotation can always be taken modulo 4
+    :return: (masks, lefts, tops)
+        masks   : (4, 28) row masks from the top of the bounding box, shifted by left
+        lefts   : (28,) left offset of the bounding box
+        tops    : (28,) top offset of the bounding box
+    """
+    masks = np.zeros((4, len(pieces) * 4), dtype = np.int64)
+    lefts = np.zeros(len(pieces) * 4, dtype = np.int64)
+    tops = np.zeros(len(pieces) * 4, dtype = np.int64)
+    for p, piece in enumerate(pieces):
+        for r in range(4):
+            rotation = piece.rotations[r % len(piece.rotations)]
+            left, top, right, bottom = rotation.bbox
+            lefts[p * 4 + r] = left
+            tops[p * 4 + r] = top
+            for dy, mask in rotation.rows:
+                masks[dy - top, p * 4 + r] = mask
+    return masks, lefts, tops
+
+masks, lefts, tops = compile_tables()
+
+# Moves per action, hard drops are handled separately
+action_dx = np.array([0, -1, 1, 0, 0, 0, 0])
+action_dy = np.array([0, 0, 0, 0, 0, 1, 0])
+action_dr = np.array([0, 0, 0, 1, -1, 0, 0])
+
+# Walls around the boards, so collisions don't need bounds checks
+# Every row has 3 wall bits on either side and there are 4 solid rows above and below
+pad_x = 3
+pad_y = 4
+
+class VectorEnv():
+    """
+    K games stepped in lock step
+    Methods take an array of game indices to act on
+
+    Contains:
+        boards  : (K, pad_y + height + pad_y) row bitmasks including the walls
+        piece   : (K,) index of the mobile block in block.pieces
+        rotation: (K,) rotation of the mobile block, modulo 4
+        x, y    : (K,) anchor of the mobile block
+        bag     : (K, 7) shuffled bag of pieces per game
+        bag_pos : (K,) index of the next piece in the bag
+        lines   : (K,) lines cleared in the current game
+        pieces  : (K,) pieces spawned in the current game
+    """
+    def __init__(self, k, seed = None, width = 10, height = 40, top_buffer = 20):
+        self.k = k
+        self.width = width
+        self.height = height
+        self.top_buffer = top_buffer
+        self.full = (1 << (width + 2 * pad_x)) - 1
+        self.empty = self.full ^ (((1 << width) - 1) << pad_x)
+        self.rng = np.random.default_rng(seed)
+        self.index = np.arange(k)
+        self.rows = np.arange(height)
+
+        self.boards = np.full((k, pad_y + height + pad_y), self.full, dtype = np.int64)
+        self.piece = np.zeros(k, dtype = np.int64)
+        self.rotation = np.zeros(k, dtype = np.int64)
+        self.x = np.zeros(k, dtype = np.int64)
+        self.y = np.zeros(k, dtype = np.int64)
+        self.bag = np.zeros((k, len(pieces)), dtype = np.int64)
+        self.bag_pos = np.zeros(k, dtype = np.int64)
+        self.lines = np.zeros(k, dtype = np.int64)
+        self.pieces = np.zeros(k, dtype = np.int64)
+        self.reset(self.index)
+
+    @property
+    def grid(self):
+        """
+        The boards without walls, bit x of row y is set when grid[x][y] is occupied
+        :return: (K, height) array
+        """
+        return (self.boards[:, pad_y:pad_y + self.height] >> pad_x) & ((1 << self.width) - 1)
+
+    def fill(self, idx):
+        """
+        Shuffle a new 7-bag for the given games
+        """
+        self.bag[idx] = np.argsort(self.rng.random((len(idx), len(pieces))), axis = 1)
+        self.bag_pos[idx] = 0
+
+    def spawn(self, idx):
+        """
+        Pop the next block from the bag for the given games
+        """
+        self.fill(idx[self.bag_pos[idx] >= len(pieces)])
+        self.piece[idx] = self.bag[idx, self.bag_pos[idx]]
+        self.bag_pos[idx] += 1
+        self.rotation[idx] = 0
+        self.x[idx] = self.width // 2
+        self.y[idx] = self.top_buffer
+        self.pieces[idx] += 1
+
+    def reset(self, idx):
+        """
+        Start new games for the given games
+        """
+        self.boards[idx, pad_y:pad_y + self.height] = self.empty
+        self.lines[idx] = 0
+        self.pieces[idx] = 0
+        self.fill(idx)
+        self.spawn(idx)
+
+    def collision(self, idx, shape, x, y):
+        """
+        Check if blocks intersect with the walls or the board
+        All arguments are arrays of the same length, idx selects the games
+        and shape is piece * 4 + rotation
+        :return: boolean array
+        """
+        row = y + tops[shape] + pad_y
+        shift = x + lefts[shape] + pad_x
+        boards = self.boards
+        hit = boards[idx, row] & (masks[0, shape] << shift)
+        for i in range(1, 4):
+            hit |= boards[idx, row + i] & (masks[i, shape] << shift)
+        return hit != 0
+
+    def move(self, idx, dx = 0, dy = 0, dr = 0):
+        """
+        Try to move the blocks of the given games
+        :return: boolean array, True where the move collided and was not done
+        """
+        rotation = (self.rotation[idx] + dr) & 3
+        x = self.x[idx] + dx
+        y = self.y[idx] + dy
+        hit = self.collision(idx, self.piece[idx] * 4 + rotation, x, y)
+        ok = ~hit
+        moved = idx[ok]
+        self.rotation[moved] = rotation[ok]
+        self.x[moved] = x[ok]
+        self.y[moved] = y[ok]
+        return hit
+
+    def drop(self, idx):
+        """
+        Move the blocks of the given games down as far as possible
+        All rows are tested at once instead of moving down one row at a time
+        """
+        shape = self.piece[idx] * 4 + self.rotation[idx]
+        shift = self.x[idx] + lefts[shape] + pad_x
+        boards = self.boards[idx]
+        n = boards.shape[1] - 3
+        # hit[j, r]: the block collides when the top of its bounding box is at row r
+        hit = boards[:, :n] & (masks[0, shape] << shift)[:, None]
+        for i in range(1, 4):
+            hit |= boards[:, i:n + i] & (masks[i, shape] << shift)[:, None]
+        hit = hit != 0
+        # Land just above the first collision below the current row
+        top = self.y[idx] + tops[shape] + pad_y
+        hit &= np.arange(n)[None, :] > top[:, None]
+        self.y[idx] += np.argmax(hit, axis = 1) - 1 - top
+
+    def lock(self, idx):
+        """
+        Write the blocks of the given games to their boards
+        :return: boolean array, True where the game is over
+        """
+        shape = self.piece[idx] * 4 + self.rotation[idx]
+        top = self.y[idx] + tops[shape]
+        shift = self.x[idx] + lefts[shape] + pad_x
+        for i in range(4):
+            self.boards[idx, top + pad_y + i] |= masks[i, shape] << shift
+        return top <= self.top_buffer
+
+    def clear(self, idx):
+        """
+        Clear full rows on the boards of the given games
+        Remaining rows keep their order and move to the bottom
+        :return: number of cleared lines per game
+        """
+        playfield = slice(pad_y, pad_y + self.height)
+        full = self.boards[idx, playfield] == self.full
+        cleared = full.sum(axis = 1)
+        games = cleared > 0
+        if games.any():
+            idx = idx[games]
+            boards = self.boards[idx, playfield]
+            # Stable sort puts the full rows first and keeps the order of the others
+            order = np.argsort(~full[games], axis = 1, kind = "stable")
+            boards = np.take_along_axis(boards, order, axis = 1)
+            boards[self.rows[None, :] < cleared[games, None]] = self.empty
+            self.boards[idx, playfield] = boards
+        return cleared
+
+    def step(self, action):
+        """
+        Apply one action (see actions) per game, then gravity
+        :param action: (K,) array of action indices
+        :return: (lines, done)
+            lines   : (K,) lines cleared during this step
+            done    : (K,) boolean, True where the game was over and has been reset
+        """
+        action = np.asarray(action)
+        moving = self.index[(action > 0) & (action < 6)]
+        act = action[moving]
+        self.move(moving, action_dx[act], action_dy[act], action_dr[act])
+        self.drop(self.index[action == 6])
+        # Gravity
+        landed = self.index[self.move(self.index, dy = 1)]
+        over = self.lock(landed)
+        lines = np.zeros(self.k, dtype = np.int64)
+        lines[landed] = self.clear(landed)
+        self.lines += lines
+        self.spawn(landed[~over])
+        self.reset(landed[over])
+        done = np.zeros(self.k, dtype = bool)
+        done[landed[over]] = True
+        return lines, done
+
+    def cells(self):
+        """
+        Expand the boards to a grid[x][y] like array
+        :return: (K, width, height) uint8 array
+        """
+        bits = np.arange(self.width)[None, :, None]
+        return ((self.grid[:, None, :] >> bits) & 1).astype(np.uint8)
@@ -27,7 +27,10 @@ setuptools.setup(
         python_requires='>=3',
         entry_points={
             'console_scripts': [
-                'pytris=pytris:main'
+                'pytris=pytris:main',
+                'pytris-sim=pytris.sim:main',
+                'pytris-tune=pytris.tune:main',
+                'pytris-host=pytris.telnet:main'
                 ]
             }
     )
@@ -1,12 +1,23 @@
 import pytest
 
-@pytest.fixture
-def game():
+from pytris.grid import engines
+
+@pytest.fixture(autouse = True)
+def home(tmp_path, monkeypatch):
+    """
+    Keep the leaderboard of the tests out of the real home directory
+    """
+    monkeypatch.setattr("pytris.game.home", str(tmp_path))
+    return tmp_path
+
+@pytest.fixture(params = engines.values(), ids = engines.keys())
+def game(request):
     """
     Initialize a game object with "debug" flag set
+    Every test runs on each grid engine
     """
     from pytris.game import Game
-    return Game(debug = True)
+    return Game(debug = True, engine = request.param)
 
 def test_queue(game):
     """
@@ -25,6 +36,17 @@ def test_queue(game):
             assert len(game.queue) == 8
         assert isinstance(game.queue.pop(), Block)
 
+def test_peek(game):
+    """
+    Looking ahead any number of pieces doesn't change the order of the blocks
+    """
+    from pytris.game import Game
+    preview = game.queue.peek(20)
+    assert len(preview) == 20 and game.queue.next() is preview[0]
+    assert [game.queue.pop().piece for _ in range(20)] == list(preview)
+    same = Game(debug = True, engine = type(game.grid), seed = game.seed)
+    assert [same.queue.pop().piece for _ in range(20)] == list(preview)
+
 class TestBlock():
     """
     Tests block functionality
@@ -74,14 +96,49 @@ class TestBlock():
         block = game.queue.pop()
         for _ in range(6):
             block.clockwise()
-        assert 0 <= block.rotation[-1] < len(block.states)
+        assert 0 <= block.rotation < len(block.states)
 
     def test_countercw(self, game):
         # Countercw
         block = game.queue.pop()
         for _ in range(6):
             block.countercw()
-        assert 0 <= block.rotation[-1] < len(block.states)
+        assert 0 <= block.rotation < len(block.states)
+
+    def test_revert(self, game):
+        # A move into a wall is reverted to the pose before the move
+        block = game.queue.pop()
+        for _ in range(10):
+            block.left()
+        pose = (block.anchor, block.rotation)
+        assert block.left()
+        assert (block.anchor, block.rotation) == pose
+        assert block.history is None
+
+    def test_history(self, game):
+        # Only the last game.history poses are kept
+        from pytris.block import Block
+        game.history = 3
+        block = Block.T(game = game)
+        for _ in range(5):
+            block.down()
+        assert len(block.history) == 3
+        assert block.history[-1] == (block.anchor, block.rotation)
+        assert block.history[0][0][1] == block.anchor[1] - 2
+
+    def test_drop(self, game):
+        """
+        A hard drop is a single move to the landing position
+        """
+        block = game.block
+        x, y = block.anchor
+        landing = game.grid.landing(x, y, block.rotations[block.rotation])
+        block.drop()
+        assert not block.mobile
+        assert block.anchor == (x, landing)
+        assert block.previous == ((x, y), 0)
+        for x, y in block.position():
+            assert game.grid[x][y] != 0
 
     def test_walls(self, game):
         # Test wall collisions
@@ -96,6 +153,26 @@ class TestBlock():
         for x, y in block.position():
             assert 0 <= x < block.game.grid.width
 
+    def test_pieces(self):
+        """
+        The compiled row masks and bounding boxes describe the same cells
+        """
+        from pytris.block import pieces
+        assert len(pieces) == 7
+        for piece in pieces:
+            for rotation in piece.rotations:
+                left, top, right, bottom = rotation.bbox
+                cells = {
+                    (left + bit, dy)
+                    for dy, mask in rotation.rows
+                    for bit in range(mask.bit_length())
+                    if mask >> bit & 1
+                }
+                assert cells == set(rotation.cells)
+                for dx, dy in rotation.cells:
+                    assert left <= dx <= right
+                    assert top <= dy <= bottom
+
     def test_bottom(self, game):
         # Test collision with bottom of grid
         block = game.queue.pop()
@@ -165,6 +242,47 @@ class TestGrid:
             row_sum += np.sum(row)
         assert row_sum != 0
 
+    def test_landing(self, game):
+        """
+        The landing position from the skyline is the same as moving down until a collision,
+        also below overhangs
+        """
+        import random
+        from pytris.block import pieces
+        rng = random.Random(0)
+        engine = type(game.grid)
+        for _ in range(200):
+            grid = game.grid = engine(game)
+            grid.set(1, [(x, y) for x in range(grid.width) for y in range(28, grid.height)
+                         if rng.random() < 0.3])
+            assert grid.skyline == [grid.column_top(x) for x in range(grid.width)]
+            rotation = rng.choice(rng.choice(pieces).rotations)
+            left, top, right, bottom = rotation.bbox
+            x, y = rng.randint(-left, grid.width - 1 - right), rng.randint(-top, 36)
+            if grid.collision_at(x, y, rotation):
+                continue
+            expected = y
+            while not grid.collision_at(x, expected + 1, rotation):
+                expected += 1
+            assert grid.landing(x, y, rotation) == expected
+
+    def test_engines_agree(self):
+        """
+        The same placements on both engines result in the same grid
+        """
+        from pytris.game import Game
+        from pytris.grid import Grid, BitGrid
+        grids = []
+        for engine in (Grid, BitGrid):
+            game = Game(debug = True, engine = engine, seed = 1)
+            for _ in range(30):
+                block = game.queue.pop()
+                while block.random_move() or block.down():
+                    pass
+                game.grid.row_is_full()
+            grids.append([list(column) for column in game.grid])
+        assert grids[0] == grids[1]
+
 class TestGame():
 
     def test_simulate_game(self, game):
@@ -196,4 +314,1011 @@ class TestGame():
         assert row_sum != 0
 
     def test_start_game(self,game):
-        game.start()
\ No newline at end of file
+        game.start()
+
+    def test_headless_game(self, game):
+        """
+        A headless game has no screen at all and runs until game over
+        """
+        from pytris.game import Game
+        headless = Game(engine = type(game.grid), headless = True)
+        assert headless.screen is None
+        headless.run()
+        assert headless.gameover
+        assert headless.pieces > 0
+
+    def test_run_current_block(self, game):
+        """
+        run() plays the current block first, also the block of a clone
+        """
+        from pytris.bot import bot
+        from pytris.game import Game
+        headless = Game(engine = type(game.grid), headless = True, seed = 1)
+        first = headless.block
+        headless.run(max_pieces = 1)
+        assert headless.block is first and not first.mobile and headless.pieces == 1
+        headless.spawn()
+        clone = headless.clone()
+        for continued in (headless, clone):
+            continued.run(policy = bot, max_pieces = 10)
+        assert clone.grid.masks() == headless.grid.masks() and clone.pieces == headless.pieces == 10
+
+    def test_run_policy(self, game):
+        """
+        Without a policy, run() plays with the policy of the game
+        """
+        from pytris.bot import bot
+        from pytris.game import Game
+        games = [Game(engine = type(game.grid), headless = True, seed = 2, policy = bot) for _ in range(2)]
+        games[0].run(max_pieces = 30)
+        games[1].run(policy = bot, max_pieces = 30)
+        assert games[0].grid.masks() == games[1].grid.masks()
+        assert games[0].lines == games[1].lines > 0
+
+    def test_seed(self, game):
+        """
+        The sequence of blocks only depends on the seed
+        """
+        from pytris.game import Game
+        def sequence(seed):
+            game = Game(headless = True, seed = seed)
+            return [game.queue.pop().name for _ in range(30)]
+        assert sequence(1) == sequence(1)
+        assert sequence(1) != sequence(2)
+
+    def test_replay(self, tmp_path):
+        """
+        A recorded game replays to the same grid and score
+        """
+        from pytris.game import Game
+        from pytris.replay import Recorder, actions, replay, verify
+        import random
+        path = tmp_path / "game.log"
+        game = Game(headless = True, seed = 3)
+        game.recorder = Recorder(path, game.seed)
+        game.spawn()
+        rng = random.Random(0)
+        while not game.gameover:
+            game.step(rng.choice(actions))
+        game.recorder.close(game.score)
+        assert path.stat().st_size < 4096
+        assert verify(path)
+        replayed, score = replay(path)
+        assert score == game.score
+        assert [list(c) for c in replayed.grid] == [list(c) for c in game.grid]
+
+    def test_headless_args(self):
+        from pytris.game import parse_args
+        assert parse_args(["--replay", "game.log", "--headless"]).headless
+        with pytest.raises(SystemExit):
+            parse_args(["--headless"])
+
+    def test_replay_log(self, tmp_path):
+        """
+        Negative seeds are stored, a truncated log gives a clear error
+        """
+        from pytris.replay import LogError, Recorder, read, zigzag, unzigzag
+        assert [zigzag(i) for i in (0, -1, 1, -2, 2)] == [0, 1, 2, 3, 4]
+        assert all(unzigzag(zigzag(i)) == i for i in (0, -1, 7, -(1 << 70), 1 << 64))
+        path = tmp_path / "game.log"
+        recorder = Recorder(path, -12345)
+        recorder.record("left")
+        recorder.close(3)
+        assert read(path)[0] == -12345
+        path.write_bytes(path.read_bytes()[:-1])
+        with pytest.raises(LogError):
+            read(path)
+
+    def test_record_policy(self, game, tmp_path):
+        """
+        The moves of a policy are recorded, its games replay to the same score
+        """
+        from pytris.block import Block
+        from pytris.replay import Recorder, replay
+        path = tmp_path / "game.log"
+        game.recorder = Recorder(path, game.seed)
+        game.policy = Block.random_move
+        game.start()
+        game.recorder.close(game.score)
+        replayed, score = replay(path)
+        assert replayed.score == score == game.score
+        assert replayed.grid.masks() == game.grid.masks()
+
+    def test_simulate(self):
+        from pytris.sim import simulate, aggregate
+        results = list(simulate(3, policy = "gravity", max_pieces = 5))
+        totals = aggregate(results, 1.0)
+        assert totals["games"] == 3
+        assert totals["pieces"] == 15
+
+    def test_simulate_parallel(self):
+        """
+        Games played in a process pool are the same as when played serially
+        """
+        from pytris.sim import simulate
+        serial = list(simulate(6, seed = 1))
+        parallel = list(simulate(6, seed = 1, jobs = 2, chunksize = 2))
+        key = lambda result: result["seed"]
+        strip = lambda result: (result["seed"], result["pieces"], result["lines"])
+        assert list(map(strip, sorted(serial, key = key))) == \
+               list(map(strip, sorted(parallel, key = key)))
+
+class TestSnapshot():
+    """
+    Snapshots and clones hold the full state of a game
+    """
+    def played(self, engine):
+        from pytris.bot import bot
+        from pytris.game import Game
+        game = Game(engine = engine, headless = True, seed = 5)
+        game.run(policy = bot, max_pieces = 30)
+        game.spawn()
+        game.block.left()
+        return game
+
+    def test_snapshot(self, game):
+        from pytris import snapshot
+        from pytris.grid import engines
+        played = self.played(type(game.grid))
+        data = snapshot.dump(played)
+        assert len(data) < 300
+        for engine in engines.values():
+            loaded = snapshot.load(data, engine = engine, headless = True)
+            # Also back from the other engine
+            assert snapshot.dump(snapshot.load(snapshot.dump(loaded), engine = type(game.grid),
+                                               headless = True)) == data
+            assert loaded.grid.masks() == played.grid.masks()
+            assert loaded.grid.hash == played.grid.hash
+            assert [list(c) for c in loaded.grid] == [list(c) for c in played.grid]
+            assert (loaded.block.name, loaded.block.anchor, loaded.block.rotation) == \
+                   (played.block.name, played.block.anchor, played.block.rotation)
+            assert list(loaded.queue) == list(played.queue)
+            assert (loaded.score, loaded.lines, loaded.pieces, loaded.level, loaded.speed, loaded.seed) == \
+                   (played.score, played.lines, played.pieces, played.level, played.speed, played.seed)
+        with pytest.raises(snapshot.SnapshotError):
+            snapshot.load(data[:-1])
+        with pytest.raises(snapshot.SnapshotError):
+            snapshot.load(b"nope" + data[4:])
+
+    def test_resume(self, game, tmp_path):
+        """
+        A saved game continues with the same blocks
+        """
+        from pytris import snapshot
+        from pytris.bot import bot
+        played = self.played(type(game.grid))
+        path = tmp_path / "game.snap"
+        snapshot.save(played, path)
+        resumed = snapshot.resume(path, headless = True)
+        for continued in (played, resumed):
+            continued.run(policy = bot, max_pieces = 60)
+        assert resumed.grid.masks() == played.grid.masks()
+        assert resumed.score == played.score
+
+    def test_clone(self, game):
+        from pytris import snapshot
+        played = self.played(type(game.grid))
+        played.grid.garbage(2, 3)
+        data = snapshot.dump(played)
+        clone = played.clone()
+        assert snapshot.dump(clone) == data
+        # Playing the clone leaves the game alone
+        clone.block.drop()
+        clone.land()
+        clone.grid.garbage(1, 0)
+        assert snapshot.dump(played) == data
+        assert clone.block.game is clone and clone.queue.game is clone and clone.grid.game is clone
+        assert clone.grid[0][clone.grid.height - 1] == 0 and played.grid[0][played.grid.height - 1] != 0
+
+class TestNet():
+    """
+    Versus games over the LAN, played on loopback
+    """
+    def test_garbage(self, game):
+        from pytris.grid import zobrist
+        grid = game.grid
+        grid.set(2, [(0, grid.height - 1)])
+        assert not grid.garbage(2, 3)
+        rows = grid.masks()
+        assert rows[-3] == 1
+        # Full rows except for the hole in column 3
+        assert rows[-2:] == [0b1111110111] * 2
+        assert grid.skyline[0] == grid.height - 3 and grid.skyline[3] == grid.height
+        assert grid.hash == zobrist.rows(rows)
+        grid.set(1, [(0, 1)])
+        assert grid.garbage(2, 0)
+
+    def test_hole(self, game):
+        """
+        The hole is sent as a part of the width, every grid puts it in one of its columns
+        """
+        from pytris.net import Client
+        client = Client("a")
+        width = game.grid.width
+        client.garbage.extend([(1, 0), (1, 255)])
+        client.land(game, 0)
+        full = (1 << width) - 1
+        # The first and the last column, the later garbage is pushed in below
+        assert game.grid.masks()[-2:] == [full ^ 1, full ^ 1 << width - 1]
+
+    def test_versus(self):
+        import asyncio
+        from pytris.net import simulate
+        server, players = asyncio.run(simulate(3, pieces = 40, frame = 0))
+        assert len({client.seed for client, game in players}) == 1
+        for client, game in players:
+            assert game.pieces == 40
+            # Every player sees the last board of the others
+            for other, other_game in players:
+                if other is not client:
+                    assert client.boards[other.id] == list(other_game.grid.masks())
+            assert client.latency.count > 0
+
+    def test_lines(self):
+        """
+        Clearing four lines sends four garbage rows to the opponent, losing ends the game
+        """
+        import asyncio
+        from pytris import net
+        async def run():
+            server = net.Server(2, seed = 0)
+            await server.start("127.0.0.1", 0)
+            a, b = net.Client("a"), net.Client("b")
+            await asyncio.gather(a.connect("127.0.0.1", server.port), b.connect("127.0.0.1", server.port))
+            a.send(net.pack(net.LINES, bytes([4])))
+            a.lose()
+            await asyncio.gather(a.run(), b.run())
+            await server.close()
+            return a, b
+        a, b = asyncio.run(run())
+        assert len(b.garbage) == 1 and b.garbage[0][0] == 4
+        assert not a.garbage
+        assert a.winner == b.winner == b.id
+        assert b.result() == "You win!" and a.result() == "Game over!"
+
+class TestTelnet():
+    """
+    Many games in one process, played over telnet
+    """
+    def test_terminal(self):
+        from pytris.telnet import Terminal, IAC, DO, SB, SE
+        terminal = Terminal()
+        terminal.feed(bytes([IAC, DO, 1]) + b"\x1b[Dx\r\n" + bytes([IAC, SB, 31, 0, 80, IAC, SE]) + b"\x1b")
+        terminal.feed(b"[A\r")
+        terminal.feed(b"\x00 ")
+        assert list(terminal.keys) == ["KEY_LEFT", "x", "\n", "KEY_UP", "\n", " "]
+        terminal.out.clear()
+        terminal.addstr(2, 3, "ab", 1 << 8)
+        terminal.addstr(2, 5, "c", 1 << 8)
+        assert bytes(terminal.out) == b"\x1b[3;4H\x1b[0;41mabc"
+
+    def test_host(self, tmp_path):
+        import asyncio
+        from pytris.scores import Leaderboard
+        from pytris.telnet import Host, load
+        async def run():
+            host = Host(Leaderboard(tmp_path / "scores.db"), seed = 0)
+            await host.start("127.0.0.1", 0)
+            stats = await load(port = host.port, sessions = 10, duration = 1.5, rate = 20, ramp = 0.1)
+            await host.close()
+            return host, stats
+        host, stats = asyncio.run(run())
+        assert stats["sessions"] >= 10 and stats["refused"] == 0
+        assert stats["response"].count > 0
+        # Gravity ran for every game at least once
+        assert host.ticks >= 10
+        assert host.lag.count == host.ticks
+        assert not host.sessions
+
+    def test_session(self, tmp_path):
+        import asyncio
+        import threading
+        from types import SimpleNamespace
+        from pytris.scores import Leaderboard
+        from pytris.telnet import Host, Session
+        sent = []
+        writer = SimpleNamespace(write = sent.append, is_closing = lambda: False, close = lambda: None,
+                                 transport = SimpleNamespace(get_write_buffer_size = lambda: 0))
+        async def run():
+            host = Host(Leaderboard(tmp_path / "scores.db"), seed = 0)
+            host.loop = asyncio.get_running_loop()
+            scheduled = []
+            host.schedule = lambda session, deadline: scheduled.append(deadline)
+            session = Session(host, None, writer, seed = 0, name = "ann")
+            game = session.game
+            game.spawn()
+            speed = game.speed
+            # Gravity keeps to its deadlines when it runs a little late
+            session.tick(10.0, 10.2)
+            assert scheduled[-1] == 10.0 + speed
+            # but doesn't catch up in a burst when it fell far behind
+            session.tick(20.0, 30.0)
+            assert scheduled[-1] == 30.0 + speed
+            # The score is written on the database thread, not on the event loop
+            users = []
+            add = host.leaderboard.add
+            def record(*args):
+                users.append(threading.current_thread())
+                return add(*args)
+            host.leaderboard.add = record
+            game.score = 50
+            session.end()
+            await asyncio.gather(*host.tasks)
+            assert users and users[0] is not threading.current_thread()
+            assert (game.username, game.highscore) == ("ann", 50)
+            best = await host.query(host.leaderboard.best)
+            host.database.shutdown()
+            return best
+        best = asyncio.run(run())
+        assert (best.user, best.score) == ("ann", 50)
+
+    def test_name(self, tmp_path):
+        """
+        The game starts once the player entered a name, the name goes to the leaderboard
+        """
+        from types import SimpleNamespace
+        from pytris.scores import Leaderboard
+        from pytris.telnet import Host, Session
+        sent = []
+        writer = SimpleNamespace(write = sent.append, is_closing = lambda: False, close = lambda: None,
+                                 transport = SimpleNamespace(get_write_buffer_size = lambda: 0))
+        host = Host(Leaderboard(tmp_path / "scores.db"), seed = 0)
+        host.schedule = lambda session, deadline: None
+        host.background = lambda coroutine: coroutine.close()
+        names = []
+        for *typing, enter in (b"bobx\x7f", b"\r\n"), (b"\r\0",), (b"a" * 20, b"\r"):
+            session = Session(host, None, writer, seed = 0)
+            session.start()
+            assert b"Name: _" in b"".join(sent)
+            for chunk in typing:
+                session.input(chunk)
+            assert session.game.player is None and not session.game.pieces
+            session.input(enter)
+            assert session.game.pieces == 1
+            names.append(session.game.player)
+        assert names == ["bob", "guest", "a" * 12]
+        host.database.shutdown()
+
+class TestBroadcast():
+    """
+    Frames are encoded once and reach every viewer
+    """
+    def test_encoder(self, game):
+        from pytris.broadcast import Encoder, Viewer, view, frame_info, KEYFRAME, DELTA
+        from pytris.net import receive
+        import asyncio
+        async def receive_message(message):
+            reader = asyncio.StreamReader()
+            reader.feed_data(message)
+            return await receive(reader)
+        decode = lambda message: asyncio.run(receive_message(message))
+        encoder = Encoder(interval = 3)
+        viewer = Viewer()
+        game.spawn()
+        kinds = []
+        for i in range(5):
+            kind, message = encoder.encode(game)
+            kinds.append(kind)
+            viewer.apply(*decode(message))
+            assert viewer.cells == view(game)
+            assert viewer.sequence == i + 1
+            game.block.down()
+        assert kinds == [KEYFRAME, DELTA, DELTA, KEYFRAME, DELTA]
+        # A delta only has the cells of the block that moved
+        kind, message = encoder.encode(game)
+        assert kind == DELTA and len(message) <= 3 + frame_info.size + 3 * 8
+        # A taller view, with indexes past the first 256 cells
+        game.grid.top_buffer = 10
+        viewer.apply(*decode(encoder.encode(game, key = True)[1]))
+        assert len(viewer.cells) == 300
+        game.grid.set(5, [(9, game.grid.height - 1)])
+        kind, message = encoder.encode(game)
+        viewer.apply(*decode(message))
+        assert kind == DELTA and viewer.cells == view(game) and viewer.cells[-1] == 5
+
+    def test_watch(self, window, monkeypatch, tmp_path):
+        from pytris import broadcast
+        monkeypatch.setattr(broadcast.time, "sleep", lambda seconds: None)
+        path = str(tmp_path / "missing.sock")
+        broadcast.watch(window, path)
+        assert (5, 13, f"No broadcast on {path}", 0) in window.writes
+
+    def test_threaded(self, game):
+        import asyncio
+        from types import SimpleNamespace
+        from pytris.broadcast import Broadcaster, Subscriber, Viewer, view
+        from pytris.net import receive
+        async def receive_all(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            messages = []
+            while not reader.at_eof():
+                messages.append(await receive(reader))
+            return messages
+        # The game thread encodes frames faster than the event loop publishes them
+        queued = []
+        broadcaster = Broadcaster(interval = 2)
+        broadcaster.threaded = True
+        broadcaster.loop = SimpleNamespace(call_soon_threadsafe = lambda *call: queued.append(call))
+        sent = bytearray()
+        broadcaster.subscribers.add(Subscriber(SimpleNamespace(
+            write = sent.extend, transport = SimpleNamespace(get_write_buffer_size = lambda: 0))))
+        viewer = Viewer()
+        def publish(cells):
+            call, *args = queued.pop(0)
+            call(*args)
+            for message in asyncio.run(receive_all(bytes(sent))):
+                viewer.apply(*message)
+            sent.clear()
+            assert viewer.cells == cells
+        game.spawn()
+        broadcaster.frame(game, force = True)
+        publish(view(game))
+        # A delta to the first keyframe is still queued when the next keyframe is encoded
+        frames = []
+        for i in range(2):
+            game.block.down()
+            broadcaster.frame(game, force = True)
+            frames.append(view(game))
+        for cells in frames:
+            publish(cells)
+
+    def test_broadcast(self, tmp_path):
+        import asyncio
+        from types import SimpleNamespace
+        from pytris.broadcast import Broadcaster, Subscriber, Viewer, view
+        from pytris.game import Game
+        path = str(tmp_path / "broadcast.sock")
+        # A viewer that never reads, its connection stays full
+        stalled = Subscriber(SimpleNamespace(
+            transport = SimpleNamespace(get_write_buffer_size = lambda: 1 << 20),
+            close = lambda: None))
+        game = Game(headless = True, seed = 0)
+        game.spawn()
+        async def run():
+            broadcaster = Broadcaster(timeout = 0.05)
+            await broadcaster.start(path)
+            viewers = [Viewer() for _ in range(3)]
+            for viewer in viewers:
+                await viewer.connect(path)
+            tasks = [asyncio.ensure_future(viewer.run()) for viewer in viewers]
+            while len(broadcaster.subscribers) < 3:
+                await asyncio.sleep(0.01)
+            broadcaster.subscribers.add(stalled)
+            for i in range(10):
+                game.block.down()
+                broadcaster.frame(game, force = True)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            await broadcaster.close()
+            await asyncio.gather(*tasks)
+            return broadcaster, viewers
+        broadcaster, viewers = asyncio.run(run())
+        assert broadcaster.frames == 10
+        # The stalled viewer skipped frames until it was dropped
+        assert broadcaster.skipped >= 2 and broadcaster.dropped == 1
+        assert stalled not in broadcaster.subscribers
+        for viewer in viewers:
+            assert viewer.cells == view(game)
+            assert viewer.frames == 10
+
+class TestTune():
+    """
+    Weight tuning is reproducible, in parallel and after resuming from a checkpoint
+    """
+    def tuner(self):
+        from pytris.tune import Tuner
+        return Tuner(population = 4, games = 2, seed = 1, max_pieces = 20)
+
+    def test_parallel(self):
+        serial, parallel = self.tuner(), self.tuner()
+        serial.run(1)
+        parallel.run(1, jobs = 2)
+        assert serial.state() == {**parallel.state(), "history": serial.history}
+        assert serial.history[0]["games"] == 8
+
+    def test_checkpoint(self, tmp_path):
+        path = tmp_path / "tune.json"
+        straight = self.tuner()
+        straight.run(2)
+        resumed = self.tuner()
+        resumed.run(1, checkpoint = path)
+        resumed = self.tuner()
+        assert resumed.load(path) and resumed.generation == 1
+        resumed.run(2, checkpoint = path)
+        strip = lambda state: {key: value for key, value in state.items() if key != "history"}
+        assert strip(resumed.state()) == strip(straight.state())
+
+    def test_generations(self):
+        from pytris.tune import parse_args
+        assert parse_args(["-g", "1"]).generations == 1
+        with pytest.raises(SystemExit):
+            parse_args(["-g", "0"])
+
+class TestZobrist():
+    """
+    The hash of the grid is kept up to date by every change
+    """
+    def test_hash(self, game):
+        import random
+        from pytris.grid import zobrist
+        rng = random.Random(0)
+        assert game.grid.hash == 0
+        for _ in range(60):
+            block = game.block
+            for _ in range(rng.randrange(4)):
+                rng.choice((block.left, block.right, block.clockwise))()
+            block.drop()
+            game.land()
+            assert game.grid.hash == zobrist.rows(game.grid.masks())
+            if game.gameover:
+                break
+        assert game.grid.hash != 0 or game.grid.masks() == [0] * game.grid.height
+
+    def test_lazy(self):
+        """
+        The tables are only built when a hash is needed, not at import or by playing
+        """
+        import subprocess
+        import sys
+        code = ("import pytris.grid as grid, pytris.game as game; "
+                "g = game.Game(headless = True, seed = 0); g.run(max_pieces = 20); "
+                "print(grid.zobrist._cells is None, g.grid.hash == grid.zobrist.rows(g.grid.masks()))")
+        out = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, check = True)
+        assert out.stdout.split() == ["True", "True"]
+
+class TestBot():
+    """
+    The autoplayer searches all placements and survives long games
+    """
+    def test_placements(self, game):
+        from pytris.block import pieces
+        from pytris.bot import Board
+        board = Board.from_grid(game.grid)
+        x, y = game.block.anchor
+        counts = {piece.name: len(board.placements(piece, x, y)) for piece in pieces}
+        assert counts == {"I": 34, "T": 34, "O": 9, "L": 34, "J": 34, "S": 17, "Z": 17}
+
+    def test_board(self, game):
+        """
+        Placing on a board gives the same board as placing on the grid
+        """
+        import random
+        from pytris.bot import Board
+        rng = random.Random(0)
+        board = Board.from_grid(game.grid)
+        for _ in range(30):
+            block = game.queue.pop()
+            block.rotation = rng.randrange(len(block.states))
+            rotation = block.rotations[block.rotation]
+            x, y = block.anchor
+            if board.collision(rotation, x, y):
+                break # The game is over
+            y = board.landing(rotation, x, y)
+            board, lines = board.place(rotation, x, y)
+            block.drop()
+            game.grid.row_is_full()
+            assert board.rows == Board.from_grid(game.grid).rows
+            assert (board.tops, board.holes) == board.scan()
+            assert board.hash == game.grid.hash
+
+    def test_bot(self, game):
+        from pytris.bot import Bot
+        from pytris.game import Game
+        game = Game(engine = type(game.grid), headless = True, seed = 0)
+        game.run(Bot(), max_pieces = 300)
+        assert not game.gameover
+        assert game.lines > 100
+
+    def test_cache(self):
+        from pytris.bot import Cache
+        cache = Cache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        # b is now the least recently used entry
+        cache.put("c", 3)
+        assert cache.get("b") is None
+        assert (cache.get("a"), cache.get("c")) == (1, 3)
+        assert len(cache) == 2
+        assert cache.hit_rate() == 0.75
+
+    def test_cached_search(self, game):
+        """
+        The transposition cache doesn't change the moves of the bot
+        """
+        from pytris.bot import Bot, Cache
+        from pytris.game import Game
+        engine = type(game.grid)
+        games = []
+        for cache in (None, Cache()):
+            bot = Bot(lookahead = 2, beam = 3, cache = cache)
+            games.append(Game(engine = engine, headless = True, seed = 3))
+            games[-1].run(bot, max_pieces = 40)
+        assert games[0].grid.masks() == games[1].grid.masks()
+        assert games[0].lines == games[1].lines
+        assert bot.cache.hits > 0
+
+class TestVector():
+    """
+    The vectorized environment plays K games at once
+    """
+    def test_drop(self):
+        from pytris.vector import VectorEnv, actions
+        env = VectorEnv(8, seed = 0)
+        lines, done = env.step(np.full(8, actions.index("drop")))
+        assert not done.any()
+        assert (env.pieces == 2).all()
+        # Every board now holds exactly one block of 4 cells touching the bottom
+        cells = env.cells()
+        assert (cells.sum(axis = (1, 2)) == 4).all()
+        assert (cells[:, :, -1].sum(axis = 1) > 0).all()
+
+    def test_clear(self):
+        from pytris.vector import VectorEnv, actions, pad_x, pad_y
+        env = VectorEnv(4, seed = 0)
+        bottom = pad_y + env.height - 1
+        # Bottom row full except for the spawn column, with an I block to fill it
+        env.boards[:, bottom] |= env.full ^ (1 << (env.width // 2 + pad_x))
+        env.piece[:] = 0
+        # And a single cell in the first column on top of it
+        env.boards[:, bottom - 1] |= 1 << pad_x
+        lines, done = env.step(np.full(4, actions.index("drop")))
+        assert (lines == 1).all()
+        assert (env.lines == 1).all()
+        # The cell above the cleared row moved down
+        assert (env.cells()[:, 0, -1] == 1).all()
+
+    def test_random(self):
+        from pytris.vector import VectorEnv, actions
+        env = VectorEnv(64, seed = 0)
+        rng = np.random.default_rng(0)
+        resets = 0
+        for _ in range(500):
+            lines, done = env.step(rng.integers(0, len(actions), env.k))
+            resets += done.sum()
+        assert resets > 0
+        assert env.cells().max() <= 1
+        assert ((env.x >= 0) & (env.x < env.width)).all()
+
+class Window():
+    """
+    Fake curses window that records everything that is written to it
+    """
+    def __init__(self):
+        self.writes = []
+        self.keys = []
+    def addstr(self, y, x, s, attr = 0):
+        self.writes.append((y, x, s, attr))
+    def getkey(self):
+        import curses
+        if not self.keys:
+            raise curses.error("no input")
+        return self.keys.pop(0)
+    def nodelay(self, flag):
+        pass
+    def noutrefresh(self):
+        pass
+    def refresh(self):
+        pass
+
+@pytest.fixture
+def window(monkeypatch):
+    """
+    Fake window, with the curses functions that need a terminal stubbed out
+    """
+    import curses
+    for name in ("use_default_colors", "init_pair", "curs_set", "doupdate"):
+        monkeypatch.setattr(curses, name, lambda *args: None)
+    monkeypatch.setattr(curses, "color_pair", lambda i: i << 8)
+    return Window()
+
+class TestScreen():
+    """
+    The screen only writes pixels that changed since the last frame
+    """
+    def test_flush(self, window):
+        from pytris.game import Game
+        game = Game(screen = window, seed = 0)
+        game.spawn()
+        game.screen.grid()
+        game.screen.flush()
+        # Rows of the same color are written at once
+        assert len(window.writes) < 200
+        window.writes.clear()
+        # Nothing changed, so nothing is written
+        game.screen.grid()
+        game.screen.flush()
+        assert window.writes == []
+        # Moving a block only writes the pixels that changed
+        for _ in range(10):
+            game.block.down()
+        game.screen.flush()
+        window.writes.clear()
+        game.block.left()
+        game.screen.flush()
+        # The block and its ghost
+        assert 0 < game.screen.frame_cells <= 16
+        assert sum(len(s) for y, x, s, attr in window.writes) == game.screen.frame_cells
+
+    def test_command(self, window):
+        """
+        All pending keys are handled in one frame
+        """
+        from pytris.game import Game
+        game = Game(screen = window, seed = 0)
+        x, y = game.block.anchor
+        window.keys = ["KEY_LEFT"] * 3 + ["?"]
+        events = game.screen.command()
+        assert [key for t, key in events] == ["KEY_LEFT"] * 3 + ["?"]
+        assert game.block.anchor == (x - 3, y)
+        assert game.screen.command() == []
+
+    def test_frame(self, window, monkeypatch):
+        """
+        Every frame is flushed once, also when keys were handled in it
+        """
+        import pytris.game
+        from pytris.game import Game
+        monkeypatch.setattr(pytris.game.time, "sleep", lambda seconds: None)
+        game = Game(screen = window, seed = 0)
+        game.speed = 0.0
+        window.keys = ["KEY_LEFT"] * 3
+        game.screen.wait = lambda timeout = None: bool(window.keys)
+        calls = {"flush": 0, "tick": 0}
+        def counted(name, func):
+            def wrapper():
+                calls[name] += 1
+                return func()
+            return wrapper
+        game.screen.flush = counted("flush", game.screen.flush)
+        game.tick = counted("tick", game.tick)
+        game.start()
+        # A flush per frame, the first frame and the game over message
+        assert calls["flush"] == calls["tick"] + 2
+        assert game.screen.last_latency > 0
+
+    def test_bindings(self, window, tmp_path):
+        from pytris.game import Game
+        from pytris.screen import read_bindings
+        path = tmp_path / "pytris.cfg"
+        path.write_text("[keys]\nleft = h, KEY_LEFT\ndrop = space\n")
+        bindings = read_bindings(path)
+        assert bindings["h"] == "left"
+        assert bindings[" "] == "drop"
+        assert "\n" not in bindings
+        game = Game(screen = window, seed = 0, bindings = bindings)
+        x, y = game.block.anchor
+        window.keys = ["h"]
+        game.screen.command()
+        assert game.block.anchor == (x - 1, y)
+        path.write_text("[keys]\njump = j\n")
+        with pytest.raises(ValueError):
+            read_bindings(path)
+
+    def test_ghost(self, window):
+        """
+        The ghost is drawn where the block lands, and only solved again when something moved
+        """
+        from pytris.game import Game
+        game = Game(screen = window, seed = 0)
+        game.spawn()
+        game.block.down()
+        block = game.block
+        x, y = block.anchor
+        landing = game.grid.landing(x, y, block.rotations[block.rotation])
+        assert game.screen.ghost_cells == block.position((x, landing))
+        cache = game.screen.ghost_cache
+        game.screen.block()
+        block.down()
+        # Falling doesn't change where the block lands
+        assert game.screen.ghost_cache is cache
+        block.left()
+        assert game.screen.ghost_cache is not cache
+        block.drop()
+        assert game.screen.ghost_cells == []
+
+
+def test_audio_cache(tmp_path):
+    """
+    The song is rendered once and read back from the cache
+    """
+    import numpy as np
+    from pytris import audio
+    song = audio.load(1.0, 8000, tmp_path)
+    assert list(tmp_path.iterdir()) == [tmp_path / audio.key(1.0, 8000)]
+    assert isinstance(song, np.memmap)
+    assert np.array_equal(song, audio.render(1.0, 8000))
+    assert len(audio.load(2.0, 8000, tmp_path)) < len(song)
+    # The mixer plays the song from the cache, at the tempo of the level
+    from pytris.mixer import Mixer, NullSink
+    mixer = Mixer(NullSink(8000), rate = 8000, block = 256, directory = tmp_path)
+    mixer.level(3)
+    mixer.mix()
+    assert isinstance(mixer.music, np.memmap) and len(mixer.music) < len(song)
+    assert (tmp_path / audio.key(audio.level_tempo(3), 8000)).exists()
+
+class TestMixer():
+    """
+    The mixer writes blocks to a sink, with the effects mixed into the music
+    """
+    def test_ring(self):
+        import numpy as np
+        from pytris.mixer import Ring
+        ring = Ring(8)
+        assert ring.write(np.arange(6))
+        assert not ring.write(np.arange(3))
+        assert list(ring.read(4)) == [0, 1, 2, 3]
+        assert ring.write(np.arange(6, 12))
+        assert list(ring.read(8)) == list(range(4, 12))
+        assert ring.read(1) is None
+        # Mixing only touches the samples that weren't read, across the wrap
+        ring.write(np.arange(6))
+        ring.read(2)
+        assert ring.mix(np.full(10, 100)) == 4
+        assert list(ring.read(4)) == [102, 103, 104, 105]
+
+    def test_wav(self, tmp_path):
+        import wave
+        import numpy as np
+        from pytris.mixer import Mixer, WavSink
+        path = tmp_path / "out.wav"
+        mixer = Mixer(WavSink(path, 8000), rate = 8000, block = 256, directory = tmp_path)
+        mixer.pump(4)
+        mixer.trigger("clear")
+        mixer.pump(4)
+        mixer.sink.close()
+        assert mixer.underruns == 0
+        assert mixer.stats()["blocks"] >= 8
+        with wave.open(str(path)) as wav:
+            assert wav.getnframes() == 8 * 256
+            samples = np.frombuffer(wav.readframes(8 * 256), dtype = np.int16)
+        # The effect starts in the first block played after the trigger,
+        # it is mixed into the blocks that were already in the ring buffer
+        music = mixer.music.take(np.arange(8 * 256), mode = "wrap")
+        assert np.array_equal(samples[:4 * 256], music[:4 * 256])
+        assert not np.array_equal(samples[4 * 256:5 * 256], music[4 * 256:5 * 256])
+        effect = mixer.sounds["clear"].astype(np.int32)
+        expected = np.clip(music[4 * 256:].astype(np.int32) + effect[:4 * 256], -32768, 32767)
+        assert np.array_equal(samples[4 * 256:], expected)
+
+    def test_threads(self, tmp_path):
+        import time
+        from pytris.mixer import Mixer, NullSink
+        mixer = Mixer(NullSink(8000, realtime = True), rate = 8000, block = 256, directory = tmp_path)
+        mixer.start()
+        mixer.trigger("lock")
+        time.sleep(0.2)
+        mixer.stop()
+        assert mixer.sink.samples > 0
+        assert mixer.underruns == 0
+
+def test_startup_imports():
+    """
+    Starting the game doesn't import numpy or other slow modules
+    """
+    import subprocess
+    import sys
+    code = "import sys, pytris.game; print(sorted({'numpy', 'configparser', 'secrets', 'sqlite3', 'pytris.bot'} & set(sys.modules)))"
+    out = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, check = True)
+    assert out.stdout.strip() == "[]"
+
+class TestLeaderboard():
+    """
+    Scores of all games are kept in SQLite, concurrent sessions don't lose any
+    """
+    def test_migrate(self, tmp_path):
+        from pytris.scores import Leaderboard
+        legacy = tmp_path / ".pytris_highscore"
+        legacy.write_text("alice\n120")
+        board = Leaderboard(tmp_path / "scores.db", legacy = legacy)
+        assert board.best()[:2] == ("alice", 120)
+        board.close()
+        # Only imported when the database is created
+        legacy.write_text("bob\n500")
+        board = Leaderboard(tmp_path / "scores.db", legacy = legacy)
+        assert [entry.user for entry in board.top()] == ["alice"]
+
+    def test_top(self, tmp_path):
+        from pytris.scores import Leaderboard
+        board = Leaderboard(tmp_path / "scores.db")
+        assert board.best() is None
+        for user, score in [("a", 10), ("b", 30), ("a", 20), ("b", 5), ("a", 40)]:
+            board.add(user, score, seed = 2 ** 64 - 1)
+        assert [entry.score for entry in board.top(3)] == [40, 30, 20]
+        assert [entry.score for entry in board.top(user = "b")] == [30, 5]
+        assert board.best().score == 40
+        # Games of other sessions show up after a refresh
+        other = Leaderboard(tmp_path / "scores.db")
+        other.add("c", 50)
+        assert board.best().score == 40
+        board.refresh()
+        assert board.best().user == "c"
+
+    def test_concurrent(self, tmp_path):
+        import threading
+        from pytris.scores import Leaderboard
+        path = tmp_path / "scores.db"
+        def play(user):
+            board = Leaderboard(path)
+            for score in range(50):
+                board.add(user, score)
+            board.close()
+        threads = [threading.Thread(target = play, args = (f"user{i}",)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(Leaderboard(path).top(1000)) == 400
+
+    def test_game(self, home):
+        from pytris.game import Game
+        game = Game(headless = True, seed = 0)
+        game.score, game.lines = 60, 3
+        game.write_highscore()
+        assert (game.username, game.highscore) == (game.leaderboard.best().user, 60)
+        assert (home / ".pytris.db").exists()
+        # Games with random moves are not recorded
+        game = Game(debug = True, headless = True)
+        game.score = 100
+        game.write_highscore()
+        assert game.leaderboard.best().score == 60
+
+class TestStats():
+    def test_histogram(self):
+        from pytris.stats import Histogram
+        h = Histogram()
+        for i in range(1, 101):
+            h.add(i / 1000)
+        assert h.count == 100
+        assert h.max == 0.1
+        # Percentiles are accurate to a bucket, about 12%
+        assert 0.05 <= h.percentile(50) <= 0.05 * 1.13
+        assert 0.099 <= h.percentile(99) <= 0.1
+        assert len(h.counts) == 141
+        merged = Histogram()
+        merged.merge(h)
+        merged.merge(h)
+        assert merged.count == 200 and merged.percentile(50) == h.percentile(50)
+
+    def test_profiler(self, window, tmp_path):
+        import json
+        from pytris.game import Game
+        from pytris.stats import Profiler
+        game = Game(screen = window, seed = 0)
+        profiler = Profiler(game).install()
+        window.keys = ["KEY_LEFT", "KEY_UP"]
+        game.screen.command()
+        game.act("gravity")
+        game.screen.flush()
+        # Nothing changed since, so this is no frame
+        game.screen.flush()
+        assert profiler.moves == 2
+        h = profiler.histograms
+        assert h["input"].count == h["gravity"].count == h["frame"].count == h["render"].count == 1
+        assert h["collision"].count == 3
+        profiler.dump(tmp_path / "stats.json")
+        summary = json.loads((tmp_path / "stats.json").read_text())
+        assert summary["phases"]["frame"]["count"] == 1
+        # Uninstalled, nothing is wrapped anymore
+        profiler.uninstall()
+        assert "flush" not in vars(game.screen)
+        assert "collision_at" not in vars(game.grid)
+
+    @pytest.mark.parametrize("engine", ["Grid", "BitGrid"])
+    def test_clone_profiled(self, window, engine):
+        from pytris import grid
+        from pytris.game import Game
+        from pytris.stats import Profiler
+        game = Game(screen = window, seed = 0, engine = getattr(grid, engine))
+        profiler = Profiler(game).install()
+        clone = game.clone()
+        # The clone uses its own methods, not the timed ones of the game
+        assert not {"act", "collision_at", "row_is_full"} & (set(vars(clone)) | set(vars(clone.grid)))
+        bottom = clone.grid.height - 1
+        clone.grid.set(1, [(x, bottom) for x in range(clone.grid.width)])
+        clone.grid.row_is_full()
+        assert clone.grid.masks()[bottom] == 0 and clone.grid.version > game.grid.version
+        clone.act("left")
+        assert profiler.moves == 0 and profiler.histograms["clear"].count == 0